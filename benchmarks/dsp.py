@@ -0,0 +1,76 @@
+"""
+Compares the numpy functions in src.dsp with the audioop functions
+StreamPlayer used before. audioop was removed in Python 3.13 so
+its timings are skipped when it isn't available.
+
+Usage:
+    python -m benchmarks.dsp [samplerate]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from src.dsp import Volume, Crossfade, rms, peak, leading_silence
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+
+def chunk(samplerate, seconds=0.25):
+    rnd = np.random.RandomState(0)
+    frames = int(samplerate * seconds)
+    return rnd.randint(-20000, 20000, frames * 2).astype(np.int16).tobytes()
+
+
+def run(name, func, seconds, number=500):
+    elapsed = timeit.timeit(func, number=number) / number
+    print('  {:<28} {:>9.1f} us {:>8.3f} % of real time'.format(
+        name, elapsed * 1e6, elapsed / seconds * 100))
+
+
+def main():
+    samplerate = int(sys.argv[1]) if len(sys.argv) > 1 else 48000
+    seconds = 0.25
+    data = chunk(samplerate, seconds)
+    print('{} Hz stereo, {} s chunks ({} bytes)'.format(samplerate, seconds, len(data)))
+
+    volume = Volume(0.5, samplerate)
+    ramp = Volume(0.5, samplerate)
+
+    def ramped():
+        ramp.gain = 0.4 if ramp.gain == 0.5 else 0.5
+        ramp.apply(data)
+
+    crossfade = Crossfade(samplerate, 3600)
+    silent = bytes(len(data) // 2) + data[len(data) // 2:]
+
+    print('volume')
+    if audioop:
+        run('audioop.mul', lambda: audioop.mul(data, 2, 0.5), seconds)
+    run('dsp.Volume.apply', lambda: volume.apply(data), seconds)
+    run('dsp.Volume.apply with ramp', ramped, seconds)
+
+    print('meters')
+    if audioop:
+        run('audioop.rms', lambda: audioop.rms(data, 2), seconds)
+        run('audioop.max', lambda: audioop.max(data, 2), seconds)
+    run('dsp.rms', lambda: rms(data), seconds)
+    run('dsp.peak', lambda: peak(data), seconds)
+    run('dsp.leading_silence', lambda: leading_silence(silent, 50), seconds)
+
+    print('mixing')
+    run('dsp.Crossfade.mix', lambda: crossfade.mix(data, data), seconds)
+
+    if audioop:
+        assert abs(rms(data) - audioop.rms(data, 2)) < 1
+        assert peak(data) == audioop.max(data, 2)
+        assert volume.apply(data) == audioop.mul(data, 2, 0.5) or \
+            np.abs(np.frombuffer(volume.apply(data), np.int16).astype(int) -
+                   np.frombuffer(audioop.mul(data, 2, 0.5), np.int16)).max() <= 1
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Shows the query plans and timings of the most common library queries
+before and after the schema migrations have been run.
+
+Usage:
+    python -m benchmarks.query_plans [song count]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from playhouse.apsw_ext import APSWDatabase
+
+from src.database import (_database, FullSong, Playlist, Tag, CoverArt, QueueSong,
+                          TempSong, Artist, AlbumArtist, Genre, Composer,
+                          EqualizerPreset, Album)
+from src.migrations import migrate
+
+
+def create_database(filename, songs):
+    db = APSWDatabase(filename, c_extensions=False, autorollback=True, autocommit=True)
+    _database.initialize(db)
+    db.connect()
+    db.create_tables([FullSong, Playlist, Tag, CoverArt, QueueSong, TempSong,
+                      Artist, AlbumArtist, Genre, Composer, EqualizerPreset,
+                      Playlist.songs.get_through_model(),
+                      Tag.songs.get_through_model(), Album])
+
+    rnd = random.Random(0)
+    tag_model = Tag.songs.get_through_model()
+    with db.atomic():
+        Artist.insert_many([{'name': 'Artist %d' % i} for i in range(songs // 10)]).execute()
+        Album.insert_many([{'name': 'Album %d' % i} for i in range(songs // 10)]).execute()
+        Tag.insert_many([{'name': 'Tag %d' % i} for i in range(20)]).execute()
+        Playlist.insert_many([{'name': 'Playlist %d' % i} for i in range(5)]).execute()
+
+        rows = [{'title': 'Song %d' % i, 'link': '/music/%d.mp3' % i,
+                 'artist': rnd.randint(1, songs // 10), 'album': rnd.randint(1, songs // 10)}
+                for i in range(songs)]
+        for idx in range(0, len(rows), 100):
+            FullSong.insert_many(rows[idx:idx + 100]).execute()
+
+        links = {(rnd.randint(1, 20), rnd.randint(1, songs)) for _ in range(songs)}
+        links = [{'tag': t, 'fullsong': s} for t, s in links]
+        for idx in range(0, len(links), 100):
+            tag_model.insert_many(links[idx:idx + 100]).execute()
+
+        queue = [{'metadata': rnd.randint(1, songs), 'sort_order': rnd.randint(0, songs)}
+                 for _ in range(songs // 2)]
+        for idx in range(0, len(queue), 100):
+            QueueSong.insert_many(queue[idx:idx + 100]).execute()
+
+    return db
+
+
+def queries():
+    tag_model = Tag.songs.get_through_model()
+    playlist_model = Playlist.songs.get_through_model()
+    return [
+        ('get_queue', FullSong.select().join(QueueSong)
+            .order_by(QueueSong.sort_order, QueueSong.id)),
+        ('select_by_tags', FullSong.select().join(tag_model)
+            .where(tag_model.tag_id.in_([1, 2, 3]))),
+        ('songs in playlist', FullSong.select(FullSong.id).join(playlist_model)
+            .where(playlist_model.playlist_id == 1)),
+        ('artist by name', Artist.select().where(Artist.name == 'Artist 5')),
+        ('album by name', Album.select().where((Album.name == 'Album 5') &
+                                               (Album.album_artist.is_null()))),
+    ]
+
+
+def report(db, title, repeat=5):
+    print(title)
+    for name, query in queries():
+        sql, params = query.sql()
+        plan = db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            list(db.execute_sql(sql, params))
+        elapsed = (time.perf_counter() - start) / repeat
+
+        print('  {:<20} {:>8.2f} ms'.format(name, elapsed * 1000))
+        for row in plan:
+            print('      ' + row[-1])
+
+    print()
+
+
+def main():
+    songs = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    fd, filename = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        db = create_database(filename, songs)
+        report(db, 'Before migrations ({} songs)'.format(songs))
+        migrate(db)
+        report(db, 'After migrations')
+        db.close()
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
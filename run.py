@@ -1,11 +1,13 @@
 from src.gui.gui import GUI
 from src.player import GUIPlayer
+from src.cache import get_art_cache
 from src.database import Database
 from src.keybinds import KB
 from src.session import SessionManager
 from src.settings import SettingsManager
 
 import logging
+import threading
 
 logger = logging.getLogger('debug')
 logger.setLevel(logging.DEBUG)
@@ -15,6 +17,7 @@ logger.addHandler(handler)
 
 session = SessionManager()
 db = Database(session)
+threading.Thread(target=db.collect_cover_art, args=(get_art_cache(),), daemon=True).start()
 settings = SettingsManager()
 player = GUIPlayer(None, None, None, session, settings, GUIPlayer.SHUFFLED, db, 0.2)
 keybinds = KB()
@@ -32,4 +35,4 @@ gui.main_window.metadata.stop()
 keybinds.stop()
 session.stop()
 session.wait_for_stop(10)
-db.database.close()
+db.close()
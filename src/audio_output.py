@@ -0,0 +1,223 @@
+import logging
+import threading
+
+import pyaudio
+
+from src.dsp import Volume, FRAME_WIDTH
+
+logger = logging.getLogger('debug')
+
+
+class RingBuffer:
+    """
+    Preallocated byte ring buffer for one writer thread and one reader
+    thread. The writer only moves the write counter and the reader only
+    moves the read counter so neither needs a lock. The counters are the
+    total amount of bytes written and read which makes full and empty
+    states unambiguous.
+
+    Args:
+        size:
+            Capacity in bytes
+    """
+    def __init__(self, size):
+        self.size = size
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._written = 0
+        self._read = 0
+        # Everything written before this is dropped by the reader
+        self._flush_to = 0
+
+    @property
+    def available(self):
+        return self._written - max(self._read, self._flush_to)
+
+    @property
+    def free(self):
+        return self.size - (self._written - self._read)
+
+    def write(self, data):
+        """
+        Writes as much of data as fits
+
+        Returns:
+            The amount of bytes written
+        """
+        count = min(len(data), self.free)
+        if count <= 0:
+            return 0
+
+        start = self._written % self.size
+        first = min(count, self.size - start)
+        self._view[start:start + first] = data[:first]
+        if count > first:
+            self._view[:count - first] = data[first:count]
+
+        self._written += count
+        return count
+
+    def read(self, size):
+        """
+        Returns:
+            Up to size bytes from the buffer
+        """
+        if self._flush_to > self._read:
+            self._read = self._flush_to
+
+        count = min(size, self._written - self._read)
+        if count <= 0:
+            return b''
+
+        start = self._read % self.size
+        first = min(count, self.size - start)
+        data = bytes(self._view[start:start + first])
+        if count > first:
+            data += bytes(self._view[:count - first])
+
+        self._read += count
+        return data
+
+    def flush(self):
+        """Drops the buffered data. Must not run at the same time as write"""
+        self._flush_to = self._written
+
+
+class CallbackOutput:
+    """
+    Audio output that uses PyAudio in callback mode. The decoder writes
+    to a ring buffer and PortAudio pulls from it every callback period
+    so pause, flush (used by seeking) and volume changes take effect on the
+    next callback instead of after the audio already written.
+
+    Songs written back to back play without a gap since the buffer is
+    shared by all of them. Every flush starts a new generation and writes
+    of an older generation are dropped, so a writer that was waiting for
+    space when a seek or skip flushed the buffer doesn't write stale audio.
+
+    Args:
+        pa:
+            pyaudio.PyAudio instance
+        samplerate:
+            Rate of the written audio
+        channels:
+            Channel count of the written audio
+        period:
+            Seconds of audio requested by one callback
+        buffer_seconds:
+            Capacity of the ring buffer
+        volume:
+            Initial volume
+    """
+    def __init__(self, pa, samplerate, channels=2, period=0.01, buffer_seconds=0.5, volume=1.0):
+        self.samplerate = samplerate
+        self.bytes_per_second = samplerate * FRAME_WIDTH
+        self.ring = RingBuffer(int(buffer_seconds * samplerate) * FRAME_WIDTH)
+        self._volume = Volume(volume, samplerate)
+        self._paused = False
+        self._closed = False
+        self._space = threading.Event()
+        # Keeps the ring single writer while a stopped song and the next one overlap
+        self._write_lock = threading.Lock()
+        self._generation = 0
+        self.played = 0
+        self.underruns = 0
+
+        self._stream = pa.open(format=pyaudio.paInt16, channels=channels, rate=samplerate,
+                               output=True, frames_per_buffer=max(int(samplerate * period), 1),
+                               stream_callback=self._callback)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        size = frame_count * FRAME_WIDTH
+        if self._paused:
+            return bytes(size), pyaudio.paContinue
+
+        data = self.ring.read(size)
+        self.played += len(data)
+        self._space.set()
+        if len(data) < size:
+            if data:
+                self.underruns += 1
+            data += bytes(size - len(data))
+
+        return self._volume.apply(data), pyaudio.paContinue
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def write(self, data, generation=None):
+        """
+        Writes the audio to the buffer. Blocks until all of it fits
+
+        Args:
+            data:
+                s16le audio
+            generation:
+                Generation the audio was produced for. The rest of the
+                audio is dropped when the buffer is flushed after this.
+                None writes to the current generation
+        """
+        if generation is None:
+            generation = self._generation
+
+        view = memoryview(data)
+        while view and not self._closed:
+            with self._write_lock:
+                if generation != self._generation:
+                    return
+
+                # Cleared before checking for space so a callback in between isn't missed
+                self._space.clear()
+                written = self.ring.write(view)
+
+            view = view[written:]
+            if view and not written:
+                self._space.wait(0.1)
+
+    @property
+    def buffered(self):
+        """Bytes written that haven't been played yet"""
+        return self.ring.available
+
+    def flush(self):
+        """
+        Drops the buffered audio and cancels the writes waiting for space
+
+        Returns:
+            The new generation
+        """
+        with self._write_lock:
+            self.ring.flush()
+            self._generation += 1
+            generation = self._generation
+
+        self._space.set()
+        return generation
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    @property
+    def paused(self):
+        return self._paused
+
+    @property
+    def volume(self):
+        return self._volume.gain
+
+    @volume.setter
+    def volume(self, value):
+        self._volume.gain = value
+
+    def close(self):
+        self._closed = True
+        self._space.set()
+        try:
+            self._stream.stop_stream()
+            self._stream.close()
+        except Exception:
+            logger.exception('Could not close the output stream')
@@ -0,0 +1,183 @@
+import bisect
+import logging
+import random
+import threading
+from collections import deque
+
+from peewee import fn
+from src.database import FullSong
+
+logger = logging.getLogger('debug')
+
+SEEK_SQL = """SELECT id FROM songs
+WHERE play_count = ? AND rating = ? AND id >= ?
+ORDER BY play_count, rating, id LIMIT ?"""
+
+IN_GROUP_SQL = "SELECT 1 FROM songs WHERE id = ? AND play_count = ? AND rating = ?"
+
+# How many random ids are tried before falling back to the next id after a random one
+SAMPLE_TRIES = 32
+
+
+class SongGroup:
+    __slots__ = ['play_count', 'rating', 'count', 'min_id', 'max_id']
+
+    def __init__(self, play_count, rating, count, min_id, max_id):
+        self.play_count = play_count
+        self.rating = rating
+        self.count = count
+        self.min_id = min_id
+        self.max_id = max_id
+
+
+class AutoDJ:
+    """
+    Picks random songs from the library so that songs with few plays and
+    high ratings are picked more often. Songs are grouped by
+    (play_count, rating) and a group is picked weighted by its size and
+    :func:`weight`. A random song in the group is picked by trying random
+    ids between the smallest and largest id of the group until one is in
+    the group, so every song in the group is equally likely no matter how
+    the ids are spread. Every try is a primary key lookup and the library
+    is never loaded to memory.
+
+    Group sizes are cached and refreshed every refresh_interval picks
+    since play counts change as songs are played.
+
+    Args:
+        no_repeat:
+            How many of the latest picked songs are excluded from the picks
+        refresh_interval:
+            After how many picks the group sizes are recounted
+        rng:
+            :class:`random.Random` instance used for picking. Mostly for testing
+    """
+    def __init__(self, no_repeat=50, refresh_interval=200, rng=None):
+        self.recent = deque(maxlen=no_repeat or 0)
+        self.refresh_interval = refresh_interval
+        self.rng = rng or random.Random()
+
+        self._groups = None
+        self._cumulative = None
+        self._picks = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def weight(play_count, rating, min_play_count):
+        """
+        Weight of a single song. Songs with the lowest play count weigh the
+        most and every extra play halves the weight. Every rating star
+        adds the weight of an unrated song
+        """
+        plays = max(play_count - min_play_count, 0)
+        return (1 + max(rating or 0, 0)) / 2 ** min(plays, 64)
+
+    def invalidate(self):
+        """Recounts the groups on the next pick. Call after the library changes"""
+        self._groups = None
+
+    def _load_groups(self):
+        query = (FullSong
+                 .select(FullSong.play_count, FullSong.rating, fn.COUNT(FullSong.id),
+                         fn.MIN(FullSong.id), fn.MAX(FullSong.id))
+                 .group_by(FullSong.play_count, FullSong.rating)
+                 .tuples())
+        groups = [SongGroup(*row) for row in query]
+        self._groups = groups
+        self._picks = 0
+        if not groups:
+            self._cumulative = []
+            return
+
+        min_play_count = min(g.play_count for g in groups)
+        total = 0
+        cumulative = []
+        for group in groups:
+            total += group.count * self.weight(group.play_count, group.rating, min_play_count)
+            cumulative.append(total)
+
+        self._cumulative = cumulative
+
+    def _pick_group(self, exclude):
+        total = self._cumulative[-1]
+        for _ in range(len(self._groups)):
+            idx = bisect.bisect_right(self._cumulative, self.rng.random() * total)
+            idx = min(idx, len(self._groups) - 1)
+            if idx not in exclude:
+                return idx
+
+        candidates = [i for i in range(len(self._groups)) if i not in exclude]
+        return candidates[0] if candidates else None
+
+    def _seek_ids(self, group, start, limit):
+        # Ordering by all of the index columns makes SQLite seek the
+        # index instead of scanning the rowids from start
+        return [row[0] for row in FullSong._meta.database.execute_sql(
+            SEEK_SQL, (group.play_count, group.rating, start, limit))]
+
+    def _pick_from(self, group, recent):
+        """
+        Picks a random song from the group that isn't in recent.
+        Random ids that aren't in the group are rejected so ids after
+        gaps aren't favoured. If no try hits a song, which is likely
+        only when the ids of the group are sparse, the first song after
+        a random id is used instead
+        """
+        for _ in range(SAMPLE_TRIES):
+            song_id = self.rng.randint(group.min_id, group.max_id)
+            if song_id in recent:
+                continue
+
+            cursor = FullSong._meta.database.execute_sql(
+                IN_GROUP_SQL, (song_id, group.play_count, group.rating))
+            if cursor.fetchone() is not None:
+                return FullSong.get_or_none(FullSong.id == song_id)
+
+        start = self.rng.randint(group.min_id, group.max_id)
+        limit = len(recent) + 1
+        # Wraps around to the smallest id of the group
+        for song_id in self._seek_ids(group, start, limit) + self._seek_ids(group, group.min_id, limit):
+            if song_id not in recent:
+                return FullSong.get_or_none(FullSong.id == song_id)
+
+    def _pick(self):
+        recent = set(self.recent)
+        exclude = set()
+        while True:
+            idx = self._pick_group(exclude)
+            if idx is None:
+                if not recent:
+                    return None
+
+                # Every song has been played recently
+                recent = set()
+                exclude.clear()
+                continue
+
+            song = self._pick_from(self._groups[idx], recent)
+            if song is not None:
+                return song
+
+            exclude.add(idx)
+
+    def get_random_song(self):
+        """
+        Returns:
+            A random :class:`FullSong` or None if the library is empty
+        """
+        with self._lock:
+            if self._groups is None or self._picks >= self.refresh_interval:
+                self._load_groups()
+
+            song = self._pick() if self._groups else None
+            if song is None and self._picks > 0:
+                # The cached groups might be out of date
+                self._load_groups()
+                song = self._pick() if self._groups else None
+
+            if song is None:
+                return None
+
+            self._picks += 1
+            self.recent.append(song.id)
+            return song
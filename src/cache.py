@@ -1,8 +1,16 @@
+import binascii
+import hashlib
 import os
 import ntpath
-from collections import deque
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
 import logging
 
+import apsw
+from PIL import Image
+
 
 logger = logging.getLogger('debug')
 
@@ -12,31 +20,27 @@ def name_from_path(path):
     return tail or ntpath.basename(head)
 
 
-class DirEntry:
-    def __init__(self, path):
-        self._path = path
-        self._name = name_from_path(path)
-        self._stat = None
-
-    @property
-    def path(self):
-        return self._path
-
-    def stat(self):
-        if self._stat is None:
-            self._stat = os.stat(self.path)
-        return self._stat
-
-    def __repr__(self):
-        return self._name
-
-    @property
-    def name(self):
-        return self._name
+class Cache:
+    """
+    Size limited cache folder that deletes the least recently used files
+    when it grows over max_size.
 
+    The files are kept in an OrderedDict from the least to the most
+    recently used one together with the total size, so adding and using
+    files doesn't touch the other entries. The sizes and access times are
+    saved in a SQLite file next to the folder so the folder is only
+    scanned when the index is created.
 
-class Cache:
-    def __init__(self, cache_folder, max_size=104857600):
+    Args:
+        cache_folder:
+            Folder of the cached files. Relative paths are relative to
+            the working directory
+        max_size:
+            Size budget of the folder in bytes
+        index_file:
+            Path of the SQLite index. Defaults to <cache_folder>_index.db
+    """
+    def __init__(self, cache_folder, max_size=104857600, index_file=None):
         self.max_size = max_size
         if os.path.isabs(cache_folder):
             self.folder = cache_folder
@@ -45,67 +49,394 @@ class Cache:
             if not os.path.exists(self.folder):
                 self.folder = os.path.normpath(self.folder)
 
-            if not os.path.exists(self.folder):
-                raise InvalidCacheFolder("Cache folder %s doesn't exist" % self.folder)
+        if not os.path.exists(self.folder):
+            raise InvalidCacheFolder("Cache folder %s doesn't exist" % self.folder)
+
+        if index_file is None:
+            index_file = os.path.normpath(self.folder) + '_index.db'
 
         self.curr_size = 0
-        self.files = self._sorted_by_modification_date()
+        self.files = OrderedDict()
+        self._lock = threading.RLock()
+        self._db = apsw.Connection(index_file)
+        self._load_index()
         self.delete_oldest()
 
-    def _get_size(self):
-        return sum(os.path.getsize(os.path.join(self.folder, f)) for f in os.listdir(self.folder))
+    def _execute(self, sql, bindings=()):
+        return self._db.cursor().execute(sql, bindings)
 
-    def _sorted_by_modification_date(self):
-        files = deque(os.scandir(self.folder))
-        return sorted(files, key=lambda x: x.stat().st_ctime, reverse=True)
+    def _load_index(self):
+        exists = self._execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='files'").fetchall()
+        if not exists:
+            with self._db:
+                self._execute('CREATE TABLE files (name TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                              'atime REAL NOT NULL)')
+                self._execute('CREATE INDEX files_atime ON files (atime)')
+                self._scan_folder()
+
+        for name, size in self._execute('SELECT name, size FROM files ORDER BY atime'):
+            self.files[name] = size
+            self.curr_size += size
+
+    def _scan_folder(self):
+        """Adds the files already in the folder to a new index"""
+        logger.debug('Creating cache index for %s' % self.folder)
+        for entry in os.scandir(self.folder):
+            if not entry.is_file():
+                continue
+
+            stat = entry.stat()
+            self._execute('INSERT OR REPLACE INTO files (name, size, atime) VALUES (?, ?, ?)',
+                          (entry.name, stat.st_size, stat.st_atime))
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
 
     @property
     def is_full(self):
         return self.curr_size > self.max_size
 
     def in_cache(self, path):
-        for e in self.files:
-            if e.path == path:
-                return True
+        return name_from_path(path) in self.files
+
+    def touch(self, path):
+        """
+        Marks the file as the most recently used one
+
+        Returns:
+            True if the file is in the cache
+        """
+        name = name_from_path(path)
+        with self._lock:
+            if name not in self.files:
+                return False
+
+            self.files.move_to_end(name)
+            self._execute('UPDATE files SET atime=? WHERE name=?', (time.time(), name))
+
+        return True
 
     def add_file(self, path):
-        if self.in_cache(path):
+        """
+        Adds a file that was written to the cache folder as the most
+        recently used one and deletes old files if the cache is full.
+        Files already in the cache are only touched
+        """
+        if self.touch(path):
             return
-        entry = DirEntry(path)
-        ctime = entry.stat().st_ctime
-        for idx, e in enumerate(self.files):
-            a = e.stat().st_ctime
-            if a < ctime:
-                self.files.insert(idx, entry)
-                break
 
-        self.delete_oldest()
+        name = name_from_path(path)
+        try:
+            size = os.path.getsize(self.path(name))
+        except OSError:
+            logger.exception('Could not add %s to the cache' % path)
+            return
+
+        with self._lock:
+            self.files[name] = size
+            self.curr_size += size
+            self._execute('INSERT OR REPLACE INTO files (name, size, atime) VALUES (?, ?, ?)',
+                          (name, size, time.time()))
+            self.delete_oldest()
+
+    def remove_file(self, path):
+        """Removes the file from the index. The file itself isn't deleted"""
+        name = name_from_path(path)
+        with self._lock:
+            size = self.files.pop(name, None)
+            if size is None:
+                return
+
+            self.curr_size -= size
+            self._execute('DELETE FROM files WHERE name=?', (name,))
 
     def delete_oldest(self):
-        self.curr_size = self._get_size()
-        if self.is_full:
-            logger.debug('Audiocache full deleting files')
-            for file in reversed(self.files):
-                path = file.path
-                size = os.path.getsize(path)
-                try:
-                    os.remove(path)
-                    logger.debug('Deleted %s' % path)
-                except OSError:
-                    continue
+        """Deletes the least recently used files until the cache isn't full"""
+        with self._lock:
+            if not self.is_full:
+                return
 
-                self.curr_size -= size
-                self.files.pop()
-                if not self.is_full:
-                    break
+            logger.debug('Cache %s full deleting files' % self.folder)
+            # Files that couldn't be deleted, e.g. because they are open
+            in_use = []
+            with self._db:
+                while self.is_full and self.files:
+                    name, size = self.files.popitem(last=False)
+                    path = self.path(name)
+                    try:
+                        os.remove(path)
+                        logger.debug('Deleted %s' % path)
+                    except FileNotFoundError:
+                        pass
+                    except OSError:
+                        in_use.append((name, size))
+                        self.curr_size -= size
+                        continue
+
+                    self.curr_size -= size
+                    self._execute('DELETE FROM files WHERE name=?', (name,))
+
+                # They are tried again the next time the cache is full
+                for name, size in reversed(in_use):
+                    self.files[name] = size
+                    self.files.move_to_end(name, last=False)
+                    self.curr_size += size
+
+    def close(self):
+        self._db.close()
 
 
 class ArtCache:
-    def __init__(self, root_folder, embed_folder, dl_folder):
+    """
+    Content addressed store of cover art. Images are saved once under the
+    SHA-1 of their data so the same art embedded in every song of an album
+    or downloaded twice is stored once. Scaled variants are made when the
+    art is added so showing it never decodes the full size image.
+
+    The full size images are in <root>/full/<digest>.<ext> and the variants
+    in <root>/<size>/<digest>.jpg, or .png for images with transparency.
+
+    Args:
+        root_folder:
+            Folder of the store
+    """
+    SMALL = 80
+    MEDIUM = 300
+    FULL = None
+    SIZES = (MEDIUM, SMALL)
+
+    FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'BMP': '.bmp',
+                         'WEBP': '.webp', 'TIFF': '.tif'}
+
+    def __init__(self, root_folder):
         self.root = root_folder
-        self.embedded = embed_folder
-        self.downloaded = dl_folder
+        self.full = os.path.join(root_folder, 'full')
+        for folder in [self.full] + [self._folder(size) for size in self.SIZES]:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+        # Digests of files outside the store that have been added
+        self._external = {}
+        self._lock = threading.Lock()
+
+    def _folder(self, size):
+        return os.path.join(self.root, str(size))
+
+    @staticmethod
+    def digest(path):
+        return os.path.splitext(name_from_path(path))[0]
+
+    def in_store(self, path):
+        return os.path.normpath(os.path.dirname(path)) == os.path.normpath(self.full)
+
+    def add(self, data):
+        """
+        Adds the image data to the store
+
+        Returns:
+            Path of the full size image or None if data isn't an image
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        try:
+            image = Image.open(BytesIO(data))
+            ext = self.FORMAT_EXTENSIONS.get(image.format, '.img')
+        except (OSError, ValueError) as e:
+            logger.debug('Could not add cover art. %s' % e)
+            return None
+
+        path = os.path.join(self.full, digest + ext)
+        if os.path.exists(path):
+            return path
+
+        with self._lock:
+            try:
+                self._make_variants(image, digest)
+            except (OSError, ValueError) as e:
+                logger.debug('Could not scale cover art. %s' % e)
+                return None
+
+            self._write(path, data)
+
+        return path
+
+    @staticmethod
+    def _write(path, data):
+        # Written to a temporary file first so an image is never seen half written
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+
+        os.replace(tmp, path)
+
+    def _variant_path(self, digest, size, alpha):
+        return os.path.join(self._folder(size), digest + ('.png' if alpha else '.jpg'))
+
+    def _make_variants(self, image, digest):
+        image.draft('RGB', (self.MEDIUM, self.MEDIUM))
+        alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+        image = image.convert('RGBA' if alpha else 'RGB')
+        for size in self.SIZES:
+            # Each variant is scaled from the previous larger one
+            image.thumbnail((size, size), Image.LANCZOS)
+            path = self._variant_path(digest, size, alpha)
+            buffer = BytesIO()
+            if alpha:
+                image.save(buffer, format='PNG')
+            else:
+                image.save(buffer, format='JPEG', quality=90)
+
+            self._write(path, buffer.getvalue())
+
+    def add_file(self, path):
+        """
+        Adds the image file to the store. Files already in it aren't read
+
+        Returns:
+            Path of the full size image in the store or None if the file
+            isn't an image
+        """
+        if self.in_store(path):
+            return path
+
+        with open(path, 'rb') as f:
+            return self.add(f.read())
+
+    def add_image(self, image, format='PNG'):
+        """Adds a PIL image to the store"""
+        buffer = BytesIO()
+        image.save(buffer, format=format)
+        return self.add(buffer.getvalue())
+
+    def add_b64(self, s):
+        """Adds a base64 encoded image as given by ExifTool"""
+        if s[:7] == 'base64:':
+            s = s[7:]
+
+        try:
+            data = binascii.a2b_base64(s)
+        except binascii.Error:
+            return None
+
+        return self.add(data)
+
+    @classmethod
+    def size_for(cls, pixels):
+        """
+        Returns:
+            The smallest variant that is at least pixels wide
+        """
+        for size in reversed(cls.SIZES):
+            if pixels <= size:
+                return size
+
+        return cls.FULL
+
+    def get(self, path, size=FULL):
+        """
+        Args:
+            path:
+                Path of the art. Files outside of the store, like cover
+                images in music folders, are added to it the first time
+            size:
+                SMALL, MEDIUM or FULL
+
+        Returns:
+            Path of the variant or None if the art doesn't exist
+        """
+        if path is None:
+            return None
+
+        if not self.in_store(path):
+            full = self._external.get(path)
+            if full is None:
+                try:
+                    full = self.add_file(path)
+                except OSError:
+                    return None
+
+                self._external[path] = full
+
+            path = full
+            if path is None:
+                return None
+
+        if size is self.FULL:
+            return path
+
+        digest = self.digest(path)
+        for alpha in (False, True):
+            variant = self._variant_path(digest, size, alpha)
+            if os.path.exists(variant):
+                return variant
+
+        # Deleted from outside the program. Made again from the full size image
+        try:
+            with self._lock:
+                self._make_variants(Image.open(path), digest)
+        except (OSError, ValueError):
+            logger.debug('Could not scale cover art %s' % path)
+            return None
+
+        return self.get(path, size)
+
+    def collect_garbage(self, used, min_age=0):
+        """
+        Deletes the art and its variants that aren't in used
+
+        Args:
+            used:
+                Paths of the art that is still used
+            min_age:
+                Seconds since the art was added before it can be deleted
+
+        Returns:
+            How many images were deleted
+        """
+        used = {self.digest(path) for path in used if path and self.in_store(path)}
+        added_before = time.time() - min_age
+        deleted = 0
+        with self._lock:
+            for folder in [self.full] + [self._folder(size) for size in self.SIZES]:
+                for entry in os.scandir(folder):
+                    if self.digest(entry.name) in used:
+                        continue
+
+                    try:
+                        if entry.stat().st_mtime > added_before:
+                            continue
+                    except OSError:
+                        continue
+
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        continue
+
+                    if folder == self.full:
+                        deleted += 1
+
+        logger.debug('Deleted %s unused cover arts' % deleted)
+        return deleted
+
+
+_art_cache = None
+_art_cache_lock = threading.Lock()
+
+
+def get_art_cache():
+    """
+    Returns:
+        The :class:`ArtCache` in cache/cover_art shared by the program
+    """
+    global _art_cache
+    if _art_cache is None:
+        # Called from the thumbnail workers and the cover art collector
+        with _art_cache_lock:
+            if _art_cache is None:
+                _art_cache = ArtCache(os.path.join(os.getcwd(), 'cache', 'cover_art', 'store'))
+
+    return _art_cache
 
 
 class InvalidCacheFolder(Exception):
-    pass
\ No newline at end of file
+    pass
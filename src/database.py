@@ -1,10 +1,15 @@
 import os
 import pathlib
+import queue
+import threading
 import time
+from array import array
 from collections import deque
+from concurrent.futures import Future
 import re
 from functools import wraps
 
+import apsw
 from apsw import SQLError
 from playhouse.apsw_ext import (APSWDatabase, Model, TextField, CharField,
                                 FloatField,
@@ -12,16 +17,36 @@ from playhouse.apsw_ext import (APSWDatabase, Model, TextField, CharField,
                                 ForeignKeyField,
                                 OperationalError, SQL, IntegrityError,
                                 DeferredForeignKey,
-                                DoesNotExist, Proxy)
-from peewee import ManyToManyField
+                                DoesNotExist, Proxy, BlobField)
+from peewee import ManyToManyField, JOIN
+from playhouse.pool import PooledDatabase
+from playhouse.sqlite_ext import FTS5Model, SearchField
 
-from src.exiftool import ExifTool
 from src.globals import GV
-from src.utils import (grouper, print_info, get_supported_formats, check_correct_extension,
-                       get_file_cover_art, b64_to_cover_art)
+from src.queues import IndexableSkipList
+from src.seek_index import SeekIndex
+from src.shuffle import ShuffleEngine
+from src.utils import check_correct_extension, parse_duration
 
 _database = Proxy()
 _database_stack = deque()
+_writer = None
+_write_buffer = None
+
+# Pragmas set on every connection. WAL lets readers run while a write
+# transaction is open and synchronous=NORMAL is durable enough with WAL
+DATABASE_PRAGMAS = (('journal_mode', 'wal'),
+                    ('synchronous', 'normal'),
+                    ('cache_size', -16000),  # 16 MB
+                    ('mmap_size', 128 * 1024 * 1024),
+                    ('temp_store', 'memory'))
+
+READER_PRAGMAS = (('cache_size', -8000),
+                  ('mmap_size', 128 * 1024 * 1024),
+                  ('query_only', 1))
+
+# How many seconds a connection waits for a lock before raising BusyError
+BUSY_TIMEOUT = 5
 
 
 import logging
@@ -92,6 +117,12 @@ class FullSong(BaseModel):
     folder = TextField(default=None, null=True)
     cover_art = ForeignKeyField(CoverArt, backref='songs', default=None,
                                 null=True)
+    # Seconds where the sound starts and ends. Cached by the player so
+    # the silence doesn't have to be scanned on every play
+    trim_start = FloatField(default=None, null=True)
+    trim_end = FloatField(default=None, null=True)
+    # Silence threshold in dBFS the trim positions were found with
+    trim_threshold = FloatField(default=None, null=True)
 
     added = DateTimeField(constraints=[SQL('DEFAULT CURRENT_TIMESTAMP')])
 
@@ -119,6 +150,57 @@ class QueueSong(BaseModel):
     sort_order = IntegerField(null=False)
 
 
+class QueueShuffle(BaseModel):
+    """
+    Shuffle of the queue saved by older versions. The queue rows keep their
+    order and the shuffled order is the permutation made by
+    :class:`ShuffleEngine` from the seed. New shuffles are saved to the
+    sort orders of the queue rows. See :func:`Database.shuffle_queue`
+    """
+    seed = IntegerField()
+    size = IntegerField()
+    permutation = BlobField()
+
+    class Meta:
+        db_table = 'queue_shuffle'
+
+
+class SongSeekIndex(BaseModel):
+    """Serialized :class:`SeekIndex` of the file of a song"""
+    song = ForeignKeyField(FullSong, unique=True, backref='seek_index', on_delete='CASCADE')
+    data = BlobField()
+
+    class Meta:
+        db_table = 'seek_index'
+
+
+class LibraryFile(BaseModel):
+    """
+    Fingerprint of a file in the library that is used to find new and
+    modified files without reading their metadata
+    """
+    path = TextField(unique=True)
+    folder = TextField()
+    size = IntegerField()
+    mtime_ns = IntegerField()
+    inode = IntegerField()
+
+    class Meta:
+        db_table = 'library_files'
+
+
+class LibraryFolder(BaseModel):
+    """
+    Modification time of a folder in the library. A folder whose mtime
+    hasn't changed has the same files as the last time it was listed
+    """
+    path = TextField(unique=True)
+    mtime_ns = IntegerField()
+
+    class Meta:
+        db_table = 'library_folders'
+
+
 class TempSong(BaseModel):
     cover_art = ForeignKeyField(CoverArt, backref='temp_songs',
                                 default=None, null=True)
@@ -133,6 +215,108 @@ class TempSong(BaseModel):
         db_table = 'temporary_songs'
 
 
+class SongSearch(FTS5Model):
+    """
+    Full-text index of songs. The rowid is the id of the song and the
+    table is kept in sync with SEARCH_TRIGGERS
+    """
+    title = SearchField()
+    artist = SearchField()
+    album = SearchField()
+    genre = SearchField()
+
+    class Meta:
+        database = _database
+        db_table = 'song_search'
+        # Prefix indexes make search as you type queries fast
+        options = {'tokenize': 'unicode61 remove_diacritics 2',
+                   'prefix': "'2 3'"}
+
+
+_SEARCH_COLUMNS = """
+    (SELECT name FROM artist WHERE id = new.artist_id),
+    (SELECT name FROM albums WHERE id = new.album_id),
+    (SELECT name FROM genres WHERE id = new.genre_id)"""
+
+SEARCH_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS song_search_insert AFTER INSERT ON songs BEGIN
+    INSERT INTO song_search (rowid, title, artist, album, genre)
+    VALUES (new.id, new.title, %s);
+END""" % _SEARCH_COLUMNS,
+    """CREATE TRIGGER IF NOT EXISTS song_search_delete AFTER DELETE ON songs BEGIN
+    DELETE FROM song_search WHERE rowid = old.id;
+END""",
+    """CREATE TRIGGER IF NOT EXISTS song_search_update
+AFTER UPDATE OF id, title, artist_id, album_id, genre_id ON songs BEGIN
+    DELETE FROM song_search WHERE rowid = old.id;
+    INSERT INTO song_search (rowid, title, artist, album, genre)
+    VALUES (new.id, new.title, %s);
+END""" % _SEARCH_COLUMNS,
+    """CREATE TRIGGER IF NOT EXISTS song_search_artist AFTER UPDATE OF name ON artist BEGIN
+    UPDATE song_search SET artist = new.name
+    WHERE rowid IN (SELECT id FROM songs WHERE artist_id = new.id);
+END""",
+    """CREATE TRIGGER IF NOT EXISTS song_search_album AFTER UPDATE OF name ON albums BEGIN
+    UPDATE song_search SET album = new.name
+    WHERE rowid IN (SELECT id FROM songs WHERE album_id = new.id);
+END""",
+    """CREATE TRIGGER IF NOT EXISTS song_search_genre AFTER UPDATE OF name ON genres BEGIN
+    UPDATE song_search SET genre = new.name
+    WHERE rowid IN (SELECT id FROM songs WHERE genre_id = new.id);
+END"""]
+
+SEARCH_REBUILD = """INSERT INTO song_search (rowid, title, artist, album, genre)
+SELECT songs.id, songs.title, artist.name, albums.name, genres.name FROM songs
+LEFT OUTER JOIN artist ON artist.id = songs.artist_id
+LEFT OUTER JOIN albums ON albums.id = songs.album_id
+LEFT OUTER JOIN genres ON genres.id = songs.genre_id"""
+
+SONG_ROWS_SQL = """SELECT songs.id, songs.title, artist.name, albums.name, albumartist.name,
+songs.duration, coverart.file FROM songs
+LEFT OUTER JOIN artist ON artist.id = songs.artist_id
+LEFT OUTER JOIN albums ON albums.id = songs.album_id
+LEFT OUTER JOIN albumartist ON albumartist.id = albums.album_artist_id
+LEFT OUTER JOIN coverart ON coverart.id = songs.cover_art_id
+WHERE songs.id IN ({})"""
+
+# Max amount of ids in a single IN (...) query
+ID_CHUNK_SIZE = 500
+
+
+def _chunked(ids, size=ID_CHUNK_SIZE):
+    ids = list(ids)
+    for idx in range(0, len(ids), size):
+        yield ids[idx:idx + size]
+
+
+class SongRow:
+    """
+    Read only copy of the columns of a song that are shown in lists.
+    The names of the related rows are stored instead of the rows so
+    reading them never queries the database
+    """
+    __slots__ = ['id', 'title', 'artist', 'album', 'album_artist', 'duration', 'cover_art']
+
+    def __init__(self, id, title, artist, album, album_artist, duration, cover_art):
+        self.id = id
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.album_artist = album_artist
+        self.duration = duration
+        self.cover_art = cover_art
+
+    def get_name_and_author(self):
+        return self.title, self.artist if self.artist is not None else 'Unknown'
+
+    @property
+    def duration_formatted(self):
+        if self.duration is None:
+            return '00:00'
+
+        return parse_duration(self.duration)
+
+
 def connect_database():
     if _database.is_closed():
         _database.connect()
@@ -164,77 +348,785 @@ def database_connection(func):
     return wrapper
 
 
+class PooledAPSWDatabase(PooledDatabase, APSWDatabase):
+    def _is_closed(self, conn):
+        try:
+            conn.total_changes()
+        except apsw.ConnectionClosedError:
+            return True
+        else:
+            return False
+
+
+class DatabaseWriter(threading.Thread):
+    """
+    A thread that runs every write in its own transaction one after
+    another so writes from different threads never contend for the
+    write lock. Works like :class:`src._database.ActionQueue` but
+    returns futures
+    """
+    def __init__(self, database, **kwargs):
+        kwargs.setdefault('daemon', True)
+        kwargs.setdefault('name', 'DatabaseWriter')
+        super().__init__(**kwargs)
+        self.database = database
+        self._queue = queue.Queue()
+
+    def submit(self, action, *args, **kwargs):
+        """
+        Non-blocking. Queues a function that will be run in a transaction
+        in the writer thread
+
+        Returns:
+            :class:`concurrent.futures.Future` with the return value of the function
+        """
+        future = Future()
+        if threading.current_thread() is self:
+            # Called from another write. Run it inside the current transaction
+            self._run(future, action, args, kwargs)
+        else:
+            self._queue.put((future, action, args, kwargs))
+
+        return future
+
+    def write(self, action, *args, **kwargs):
+        """
+        Blocking version of :func:`submit`
+
+        Returns:
+            Whatever action(*args, **kwargs) returns
+        """
+        return self.submit(action, *args, **kwargs).result()
+
+    def _run(self, future, action, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            with self.database.atomic():
+                res = action(*args, **kwargs)
+        except Exception as e:
+            logger.exception('Database write failed')
+            future.set_exception(e)
+        else:
+            future.set_result(res)
+
+    def run(self):
+        self.database.connect(reuse_if_open=True)
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+
+                self._run(*item)
+        finally:
+            self.database.close()
+
+    def stop(self, timeout=None):
+        """Runs the remaining writes and stops the thread"""
+        self._queue.put(None)
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+
+def submit_write(action, *args, **kwargs):
+    """
+    Runs the function in the writer thread of the open :class:`Database`.
+    If there isn't one the function is run immediately
+
+    Returns:
+        :class:`concurrent.futures.Future`
+    """
+    if _writer is not None and _writer.is_alive():
+        return _writer.submit(action, *args, **kwargs)
+
+    future = Future()
+    try:
+        future.set_result(action(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+
+    return future
+
+
+class WriteBehindBuffer:
+    """
+    Collects changed fields of saved model instances and writes them in
+    a single transaction. Changes to the same row are coalesced so only
+    the latest value of each field is written. The buffer is flushed
+    every interval seconds, when max_rows rows have changed and when
+    the database is closed.
+
+    Args:
+        writer:
+            :class:`DatabaseWriter` the flushes are run with
+        interval:
+            Max amount of seconds a change is kept in the buffer
+        max_rows:
+            How many changed rows cause an immediate flush
+    """
+    def __init__(self, writer, interval=1.0, max_rows=1000):
+        self.writer = writer
+        self.interval = interval
+        self.max_rows = max_rows
+        self._rows = {}
+        self._lock = threading.Lock()
+        self._flush_needed = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name='WriteBehindBuffer',
+                                        daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self, instance):
+        """
+        Queues the dirty fields of the instance to be written.
+        Instances that haven't been saved yet are saved immediately
+        """
+        if instance.get_id() is None:
+            return self.writer.submit(instance.save)
+
+        fields = instance.dirty_fields
+        if not fields:
+            return
+
+        key = (type(instance), instance.get_id())
+        with self._lock:
+            row = self._rows.setdefault(key, {})
+            for field in fields:
+                row[field] = instance.__data__.get(field.name)
+
+            instance._dirty.clear()
+            if len(self._rows) >= self.max_rows:
+                self._flush_needed.set()
+
+    def __len__(self):
+        return len(self._rows)
+
+    @staticmethod
+    def _write_rows(rows):
+        for (model, pk), fields in rows.items():
+            model.update(fields).where(model._meta.primary_key == pk).execute()
+
+    def flush(self):
+        """
+        Writes all buffered changes in one transaction
+
+        Returns:
+            :class:`concurrent.futures.Future` that is done when the changes
+            have been written
+        """
+        with self._lock:
+            rows = self._rows
+            self._rows = {}
+            self._flush_needed.clear()
+
+        if not rows:
+            future = Future()
+            future.set_result(None)
+            return future
+
+        return self.writer.submit(self._write_rows, rows)
+
+    def flush_instance(self, instance):
+        """
+        Writes the buffered changes of a single instance. Used before
+        reading the row back from the database
+
+        Returns:
+            :class:`concurrent.futures.Future` that is done when the changes
+            and every earlier flush have been written
+        """
+        key = (type(instance), instance.get_id())
+        with self._lock:
+            fields = self._rows.pop(key, None)
+
+        # Submitted even when nothing is buffered so the future also waits
+        # for a flush of the row that is already queued in the writer
+        return self.writer.submit(self._write_rows, {key: fields} if fields else {})
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._flush_needed.wait(self.interval)
+            self.flush()
+
+    def stop(self):
+        """Stops the flush timer and writes the remaining changes"""
+        self._stop.set()
+        self._flush_needed.set()
+        self._thread.join()
+        return self.flush()
+
+
+def mark_dirty(instance):
+    """
+    Saves the changed fields of a model instance with the write-behind
+    buffer of the open :class:`Database`. If there isn't one the
+    instance is saved immediately
+    """
+    if _write_buffer is not None:
+        return _write_buffer.mark_dirty(instance)
+
+    return submit_write(instance.save)
+
+
+def flush_dirty(instance):
+    """
+    Writes the buffered changes of the instance so reading its row
+    returns them
+
+    Returns:
+        :class:`concurrent.futures.Future`
+    """
+    if _write_buffer is not None:
+        return _write_buffer.flush_instance(instance)
+
+    return submit_write(lambda: None)
+
+
+class QueueStorage:
+    """
+    The queue kept in an :class:`IndexableSkipList` that mirrors the
+    queuesong table. Items are ordered by (sort_order, id) and new
+    sort orders are picked from the gap between the neighbouring items
+    so inserting or moving an item updates a single row. The whole queue
+    is renumbered only when two neighbours have no gap left between them.
+
+    Positions are 0 based and values are FullSong ids
+    """
+    GAP = 1 << 20
+
+    def __init__(self, database):
+        self.database = database
+        self.items = IndexableSkipList()
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        with self._lock:
+            self.items.clear()
+            self.items.extend(((sort_order, id_), song)
+                              for sort_order, id_, song in
+                              (QueueSong
+                               .select(QueueSong.sort_order, QueueSong.id, QueueSong.metadata)
+                               .order_by(QueueSong.sort_order, QueueSong.id)
+                               .tuples()))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __iter__(self):
+        return (song for _, song in self.items)
+
+    def song_ids(self):
+        """
+        Returns:
+            array of the FullSong ids in the stored order
+        """
+        with self._lock:
+            return array('q', (song for _, song in self.items))
+
+    def queue_id(self, index):
+        """Id of the QueueSong at index"""
+        return self.items.key(index)[1]
+
+    def _sort_order(self, index):
+        """
+        Sort order for an item inserted before the current item at index
+        """
+        size = len(self.items)
+        if size == 0:
+            return self.GAP
+
+        if index <= 0:
+            return self.items.key(0)[0] - self.GAP
+
+        if index >= size:
+            return self.items.key(-1)[0] + self.GAP
+
+        before = self.items.key(index - 1)[0]
+        after = self.items.key(index)[0]
+        if after - before < 2:
+            self.renumber()
+            return self._sort_order(index)
+
+        return (before + after) // 2
+
+    @staticmethod
+    def _write(action, *args):
+        # Changes run in the writer thread so they don't contend with
+        # the other writes. Nested writes run in the same transaction
+        return submit_write(action, *args).result()
+
+    def renumber(self):
+        """Spreads the sort orders evenly with GAP between the items"""
+        self._write(self._renumber)
+
+    def reorder(self, permutation):
+        """
+        Saves the items in the order of the permutation and removes the
+        stored shuffle. See :class:`src.shuffle.ShuffleEngine`
+        """
+        self._write(self._reorder, permutation)
+
+    def _reorder(self, permutation):
+        with self._lock:
+            items = list(self.items)
+            self._renumber([items[i] for i in permutation])
+            QueueShuffle.delete().execute()
+
+    def _renumber(self, items=None):
+        with self._lock:
+            if items is None:
+                items = list(self.items)
+
+            cursor = self.database.cursor()
+            cursor.executemany('UPDATE queuesong SET sort_order = ? WHERE id = ?',
+                               [((idx + 1) * self.GAP, key[1]) for idx, (key, _) in enumerate(items)])
+
+            self.items.clear()
+            self.items.extend((((idx + 1) * self.GAP, key[1]), song)
+                              for idx, (key, song) in enumerate(items))
+
+    def insert(self, index, song_id):
+        """
+        Inserts a song before the item at index
+
+        Returns:
+            Id of the created QueueSong
+        """
+        return self._write(self._insert, index, song_id)
+
+    def _apply_shuffle(self):
+        """
+        Saves a shuffle stored by an older version to the sort orders.
+        Positions of a stored shuffle only stay valid when items are appended
+        """
+        permutation = Database.get_queue_shuffle(len(self.items))
+        if permutation is not None:
+            self._reorder(permutation)
+        else:
+            QueueShuffle.delete().execute()
+
+    def _insert(self, index, song_id):
+        with self._lock:
+            self._apply_shuffle()
+            sort_order = self._sort_order(index)
+            queue_id = QueueSong.insert(metadata=song_id, sort_order=sort_order).execute()
+            self.items.insert((sort_order, queue_id), song_id)
+            return queue_id
+
+    def append(self, song_ids):
+        """
+        Adds songs to the end of the queue
+        """
+        self._write(self._append, list(song_ids))
+
+    def _append(self, song_ids):
+        with self._lock:
+            start = self._sort_order(len(self.items))
+            rows = [{'metadata': song_id, 'sort_order': start + idx * self.GAP}
+                    for idx, song_id in enumerate(song_ids)]
+            for idx in range(0, len(rows), 100):
+                QueueSong.insert_many(rows[idx:idx + 100]).execute()
+
+            self.items.extend(((sort_order, id_), song)
+                              for sort_order, id_, song in
+                              (QueueSong
+                               .select(QueueSong.sort_order, QueueSong.id, QueueSong.metadata)
+                               .where(QueueSong.sort_order >= start)
+                               .order_by(QueueSong.sort_order, QueueSong.id)
+                               .tuples()))
+
+    def remove(self, index):
+        """
+        Removes the item at index
+
+        Returns:
+            The FullSong id of the removed item
+        """
+        return self._write(self._remove, index)
+
+    def _remove(self, index):
+        with self._lock:
+            self._apply_shuffle()
+            key = self.items.key(index)
+            QueueSong.delete().where(QueueSong.id == key[1]).execute()
+            return self.items.remove(key)
+
+    def move(self, index, new_index):
+        """
+        Moves the item at index so that it will be at new_index
+        """
+        self._write(self._move, index, new_index)
+
+    def _move(self, index, new_index):
+        with self._lock:
+            self._apply_shuffle()
+            key = self.items.key(index)
+            song_id = self.items.remove(key)
+            try:
+                sort_order = self._sort_order(new_index)
+            except Exception:
+                self.items.insert(key, song_id)
+                raise
+
+            QueueSong.update(sort_order=sort_order).where(QueueSong.id == key[1]).execute()
+            self.items.insert((sort_order, key[1]), song_id)
+
+    def clear(self):
+        self._write(self._clear)
+
+    def _clear(self):
+        with self._lock:
+            QueueSong.delete().execute()
+            QueueShuffle.delete().execute()
+            self.items.clear()
+
+
 class Database:
-    def __init__(self, session=None, db_name=GV.DatabaseName):
-        self.database = APSWDatabase(db_name, c_extensions=False, autorollback=True, autocommit=True)
+    def __init__(self, session=None, db_name=GV.DatabaseName, readers=4):
+        global _writer, _write_buffer
+
+        self.database = APSWDatabase(db_name, c_extensions=False, autorollback=True,
+                                     autocommit=True, pragmas=DATABASE_PRAGMAS,
+                                     timeout=BUSY_TIMEOUT)
 
         _database.initialize(self.database)
         self.database.connect()
-        #self.database._local.conn.setbusytimeout(3000)
 
         self.session_manager = session
         self._database_stack = deque()
+        self.auto_dj = None
+        self._queue_storage = None
 
         try:
             self.database.create_tables(
                 [FullSong, Playlist, Tag, CoverArt, QueueSong, TempSong,
                  Artist, AlbumArtist, Genre, Composer, EqualizerPreset,
                  Playlist.songs.get_through_model(),
-                 Tag.songs.get_through_model(), Album])
+                 Tag.songs.get_through_model(), Album, LibraryFile,
+                 LibraryFolder, QueueShuffle, SongSeekIndex])
         except (OperationalError, SQLError) as e:
             print(e)
 
+        self._create_search_index()
+        self._migrate()
+
+        # Read only connections for queries that shouldn't wait behind writes.
+        # The main connection has to exist first so the database is in WAL mode
+        self.reader = PooledAPSWDatabase(db_name, max_connections=readers,
+                                         c_extensions=False, pragmas=READER_PRAGMAS,
+                                         flags=apsw.SQLITE_OPEN_READONLY)
+
+        self.writer = DatabaseWriter(self.database)
+        self.writer.start()
+        _writer = self.writer
+
+        self.write_buffer = WriteBehindBuffer(self.writer)
+        _write_buffer = self.write_buffer
+
+    def get_random_song(self, no_repeat=None):
+        """
+        Picks a random song weighted by play count and rating.
+        See :class:`src.autodj.AutoDJ`
+
+        Args:
+            no_repeat:
+                How many of the latest picks can't be picked again.
+                Changing this resets the picked songs
+
+        Returns:
+            :class:`FullSong` or None if the library is empty
+        """
+        from src.autodj import AutoDJ
+        if self.auto_dj is None or (no_repeat is not None and
+                                    no_repeat != self.auto_dj.recent.maxlen):
+            self.auto_dj = AutoDJ(no_repeat=50 if no_repeat is None else no_repeat)
+
+        return self.auto_dj.get_random_song()
+
+    def library_changed(self):
+        """
+        Makes AutoDJ recount the library. Call after songs are added or removed
+        """
+        auto_dj = self.auto_dj
+        if auto_dj is not None:
+            auto_dj.invalidate()
+
+    def read(self, query):
+        """
+        Runs a select query with one of the read only connections
+
+        Returns:
+            List of the results
+        """
+        query = query.clone().bind(self.reader)
+        if not self.reader.is_closed():
+            # Nested read in the same thread
+            return list(query)
+
+        with self.reader.connection_context():
+            return list(query)
+
+    def read_sql(self, sql, params=()):
+        """
+        Runs an SQL query with one of the read only connections
+
+        Returns:
+            List of the result rows
+        """
+        if not self.reader.is_closed():
+            return list(self.reader.execute_sql(sql, params))
+
+        with self.reader.connection_context():
+            return list(self.reader.execute_sql(sql, params))
+
+    def write(self, action, *args, **kwargs):
+        """
+        Runs the function in a transaction in the writer thread and
+        waits for it to finish
+        """
+        return self.writer.write(action, *args, **kwargs)
+
+    def close(self):
+        """
+        Finishes the buffered and queued writes and closes all connections
+        """
+        global _writer, _write_buffer
+
+        self.write_buffer.stop()
+        if _write_buffer is self.write_buffer:
+            _write_buffer = None
+
+        self.writer.stop()
+        if _writer is self.writer:
+            _writer = None
+
+        self.reader.close_all()
+        self.database.close()
+
+    def _migrate(self):
+        from src.migrations import migrate, optimize
+        try:
+            migrate(self.database)
+            optimize(self.database)
+        except (OperationalError, SQLError) as e:
+            logger.exception('Could not migrate the database. {}'.format(e))
+
+    def _create_search_index(self):
+        if not SongSearch.fts5_installed():
+            logger.info('FTS5 is not available. Library search is disabled')
+            return
+
+        try:
+            with self.database.atomic():
+                created = not SongSearch.table_exists()
+                SongSearch.create_table()
+                for trigger in SEARCH_TRIGGERS:
+                    self.database.execute_sql(trigger)
+
+                if created:
+                    # Index the songs that were added before the search index existed
+                    self.database.execute_sql(SEARCH_REBUILD)
+        except (OperationalError, SQLError) as e:
+            print(e)
+
+    @staticmethod
+    def search_expression(query):
+        """
+        Converts user input to an FTS5 query where every word has to
+        match the start of a word in the title, artist, album or genre
+        """
+        words = re.findall(r'\w+', query)
+        return ' '.join('"%s"*' % word for word in words)
+
+    @staticmethod
+    def search(query, limit=50, offset=0):
+        """
+        Searches songs from the full-text index.
+        Results are ordered by relevance
+
+        Args:
+            query:
+                Words the songs have to contain. The last word can be
+                incomplete so this can be used for search as you type
+            limit:
+                Max amount of songs returned
+            offset:
+                How many results are skipped
+
+        Returns:
+            List of FullSong
+        """
+        expression = Database.search_expression(query)
+        if not expression:
+            return []
+
+        # Matches in the title weigh the most
+        query = (FullSong
+                 .select()
+                 .join(SongSearch, on=(FullSong.id == SongSearch.rowid))
+                 .where(SongSearch.match(expression))
+                 .order_by(SongSearch.bm25(10.0, 5.0, 3.0, 1.0))
+                 .limit(limit)
+                 .offset(offset))
+        return list(Database.join_related(query))
+
+    @staticmethod
+    def join_related(query):
+        """
+        Selects the artist, album, album artist, genre and cover art of
+        the songs in a FullSong query in the same query. Reading them
+        from the returned songs won't query the database again
+
+        Args:
+            query:
+                FullSong select query
+
+        Returns:
+            The query with the related rows joined
+        """
+        return (query
+                .select_extend(Artist, Album, AlbumArtist, Genre, CoverArt)
+                .switch(FullSong).join(Artist, JOIN.LEFT_OUTER)
+                .switch(FullSong).join(Album, JOIN.LEFT_OUTER)
+                .join(AlbumArtist, JOIN.LEFT_OUTER)
+                .switch(FullSong).join(Genre, JOIN.LEFT_OUTER)
+                .switch(FullSong).join(CoverArt, JOIN.LEFT_OUTER)
+                .switch(FullSong))
+
+    def prefetch_songs(self, ids):
+        """
+        Fetches songs with their related rows joined with the read only
+        connections. Takes one query per 500 ids
+
+        Args:
+            ids:
+                Iterable of FullSong ids
+
+        Returns:
+            dict of id to FullSong. Ids not in the database are left out
+        """
+        songs = {}
+        for chunk in _chunked(ids):
+            query = Database.join_related(FullSong.select().where(FullSong.id.in_(chunk)))
+            for song in self.read(query):
+                songs[song.id] = song
+
+        return songs
+
+    def get_song_rows(self, ids):
+        """
+        Fetches the columns shown in song lists as :class:`SongRow`.
+        Cheaper than :meth:`prefetch_songs` since no models are created
+
+        Args:
+            ids:
+                Iterable of FullSong ids
+
+        Returns:
+            dict of id to SongRow. Ids not in the database are left out
+        """
+        rows = {}
+        for chunk in _chunked(ids):
+            sql = SONG_ROWS_SQL.format(', '.join('?' * len(chunk)))
+            for row in self.read_sql(sql, chunk):
+                rows[row[0]] = SongRow(*row)
+
+        return rows
+
     @staticmethod
     @database_connection
     def select_by_tags(*tags):
         tags = list(map(lambda t: t.id, tags))
         model = Tag.songs.get_through_model()
-        return FullSong.select().join(model).where(model.tag_id.in_(tags))
+        return Database.join_related(
+            FullSong.select().join(model).where(model.tag_id.in_(tags)))
 
     @staticmethod
     @database_connection
     def select_by_playlists(*playlists):
         playlists = list(map(lambda p: p.id, playlists))
         model = Playlist.songs.get_through_model()
-        return FullSong.select().join(model).where(
-            model.playlist_id.in_(playlists))
+        return Database.join_related(
+            FullSong.select().join(model).where(model.playlist_id.in_(playlists)))
+
+    @property
+    def queue_storage(self):
+        """
+        :class:`QueueStorage` of the queue. Loaded on first use
+        """
+        if self._queue_storage is None:
+            self._queue_storage = QueueStorage(self.database)
+
+        return self._queue_storage
 
     @database_connection
     def add_to_queue(self, songs, clear_before=False):
+        """
+        Args:
+            songs:
+                QueueSong rows with the FullSong id in metadata. They are
+                appended in the given order
+        """
         if clear_before:
             self.clear_queue()
 
-        for idx in range(0, len(songs), 100):
-            with self.database.atomic() as txn:
-                try:
-                    QueueSong.insert_many(songs[idx:idx + 100]).execute()
-                except Exception as e:
-                    txn.rollback()
-                    raise
+        self.queue_storage.append([song['metadata'] for song in songs])
 
     @database_connection
     def clear_queue(self):
-        with self.database.atomic() as txn:
-            try:
-                QueueSong.delete().execute()
-            except Exception as e:
-                txn.rollback()
-                raise
+        self.queue_storage.clear()
 
     def fullsongs_to_queue(self, songs, clear_before=False):
-        i = QueueSong.select().count()
-        s = []
-        for song in songs:
-            s.append({'metadata': song.id, 'sort_order': i})
-            i += 1
+        if clear_before:
+            self.clear_queue()
 
-        self.add_to_queue(s, clear_before=clear_before)
+        self.queue_storage.append([song.id for song in songs])
+
+    def insert_to_queue(self, index, song_id):
+        """
+        Inserts the song before the item at index of the queue
+        """
+        self.queue_storage.insert(index, song_id)
+
+    def remove_from_queue(self, index):
+        """
+        Returns:
+            FullSong id of the removed item
+        """
+        return self.queue_storage.remove(index)
+
+    def move_in_queue(self, index, new_index):
+        self.queue_storage.move(index, new_index)
 
     @database_connection
     def get_queue(self):
-        return list(FullSong.select()
-                    .join(QueueSong)
-                    .group_by(QueueSong.sort_order, QueueSong.id))
+        queue = list(self.join_related(FullSong.select().join(QueueSong))
+                     .order_by(QueueSong.sort_order, QueueSong.id))
+
+        permutation = self.get_queue_shuffle(len(queue))
+        if permutation is not None:
+            queue = ShuffleEngine.apply(queue, permutation)
+
+        return queue
+
+    def get_queue_ids(self):
+        """
+        Returns:
+            array of the FullSong ids in the queue in the current queue order
+        """
+        ids = self.queue_storage.song_ids()
+
+        permutation = self.get_queue_shuffle(len(ids))
+        if permutation is not None:
+            ids = array('q', (ids[i] for i in permutation))
+
+        return ids
 
     @staticmethod
     def get_item_type(item_link):
@@ -293,14 +1185,149 @@ class Database:
             return os.path.realpath(name)
         return name
 
-    @database_connection
-    def shuffle_queue(self):
+    def shuffle_queue(self, seed=None):
+        """
+        Shuffles the queue from the order of the queue rows. The shuffled
+        order is saved to the sort orders once in the writer thread so the
+        edits after it still update a single row.
+        A shuffle stored by an older version is discarded
+
+        Args:
+            seed:
+                Seed of the shuffle. A random one is used by default
+
+        Returns:
+            The permutation. See :class:`ShuffleEngine`
+        """
+        if seed is None:
+            seed = ShuffleEngine.new_seed()
+
+        return self.write(self._shuffle_queue, seed)
+
+    def _shuffle_queue(self, seed):
+        storage = self.queue_storage
+        permutation = ShuffleEngine.permutation(len(storage), seed)
+        storage.reorder(permutation)
+        return permutation
+
+    @staticmethod
+    def get_queue_shuffle(size=None):
+        """
+        Args:
+            size:
+                The current length of the queue. Songs added after the
+                shuffle are kept at the end in the order they were added
+
+        Returns:
+            The permutation of the current shuffle or None if the queue
+            isn't shuffled or was shortened after the shuffle
+        """
+        shuffle = QueueShuffle.select().first()
+        if shuffle is None:
+            return None
+
+        permutation = ShuffleEngine.from_bytes(shuffle.permutation)
+        if size is None:
+            return permutation
+
+        if size < len(permutation):
+            return None
+
+        return ShuffleEngine.extend(permutation, size)
+
+    @staticmethod
+    def get_seek_index(song_id):
+        """
+        Returns:
+            :class:`SeekIndex` of the song or None if it hasn't been built
+        """
+        row = SongSeekIndex.get_or_none(SongSeekIndex.song == song_id)
+        if row is None:
+            return None
+
+        return SeekIndex.from_bytes(bytes(row.data))
+
+    @staticmethod
+    def save_seek_index(song_id, index):
+        return submit_write(lambda: SongSeekIndex
+                            .insert(song=song_id, data=index.to_bytes())
+                            .on_conflict_replace()
+                            .execute())
+
+    @staticmethod
+    def _relink_cover_art(paths):
+        """
+        Points cover art rows to the copy of their image in the cover art store
+
+        Args:
+            paths:
+                dict of cover art ids and their paths in the store
         """
-        Updates sort_order value for each QueueSong by selecting a random integer
-        between 0 and the current row count. Duplicate values will exist because of this 
-        but the results randomness shouldn't be affected much because of this"""
-        length = QueueSong.select().count()
-        self.database.execute_sql('UPDATE queuesong SET sort_order=ABS(RANDOM() % {})'.format(length))
+        for art_id, path in paths.items():
+            with _database.atomic():
+                # File names are unique so songs are moved to the row
+                # that already has the stored copy
+                existing = CoverArt.get_or_none(CoverArt.file == path)
+                if existing is None:
+                    CoverArt.update(file=path).where(CoverArt.id == art_id).execute()
+                    continue
+
+                FullSong.update(cover_art=existing.id).where(FullSong.cover_art == art_id).execute()
+                TempSong.update(cover_art=existing.id).where(TempSong.cover_art == art_id).execute()
+                CoverArt.delete().where(CoverArt.id == art_id).execute()
+
+    @staticmethod
+    def collect_cover_art(art_cache, min_age=3600):
+        """
+        Deletes the cover art in art_cache that no song uses and the rows
+        of cover art files that don't exist anymore
+
+        Args:
+            art_cache:
+                :class:`src.cache.ArtCache` the art is deleted from
+            min_age:
+                Seconds art has to be in the cache before it's deleted.
+                Art of new songs can be added before the song is saved
+        """
+        used = list(CoverArt.select(CoverArt.id, CoverArt.file)
+                    .where(CoverArt.id.in_(FullSong.select(FullSong.cover_art)) |
+                           CoverArt.id.in_(TempSong.select(TempSong.cover_art))))
+
+        # Folder images and art saved before the store are copied to it when
+        # they are shown. The rows are pointed to the copy so it isn't
+        # deleted as unused and imported again every session
+        stored = {}
+        for row in used:
+            if art_cache.in_store(row.file) or not os.path.exists(row.file):
+                continue
+
+            try:
+                path = art_cache.add_file(row.file)
+            except OSError:
+                logger.exception('Could not add %s to the cover art store' % row.file)
+                continue
+
+            if path is not None:
+                stored[row.id] = path
+
+        if stored:
+            submit_write(Database._relink_cover_art, stored).result()
+            used = [row for row in used if row.id not in stored] + [CoverArt(file=path) for path in stored.values()]
+
+        art_cache.collect_garbage([row.file for row in used], min_age=min_age)
+
+        unused = (CoverArt.select(CoverArt.id, CoverArt.file)
+                  .where(CoverArt.id.not_in(FullSong.select(FullSong.cover_art)
+                                            .where(FullSong.cover_art.is_null(False))) &
+                         CoverArt.id.not_in(TempSong.select(TempSong.cover_art)
+                                            .where(TempSong.cover_art.is_null(False)))))
+        missing = [row.id for row in unused if not os.path.exists(row.file)]
+        if missing:
+            submit_write(lambda: CoverArt.delete().where(CoverArt.id.in_(missing)).execute())
+
+    @staticmethod
+    def unshuffle_queue():
+        submit_write(lambda: QueueShuffle.delete().execute()).result()
 
     @database_connection
     def get_temp_song(self, name, link, item_type='link', **kwargs):
@@ -321,6 +1348,99 @@ class Database:
 
         return song
 
+    @staticmethod
+    def get_file_index(root):
+        """
+        Returns:
+            dict of path -> (size, mtime_ns, inode) for every indexed file
+            inside the root folder
+        """
+        root = os.path.join(root, '')
+        query = (LibraryFile
+                 .select(LibraryFile.path, LibraryFile.size,
+                         LibraryFile.mtime_ns, LibraryFile.inode)
+                 .where(LibraryFile.path.startswith(root))
+                 .tuples())
+
+        return {path: (size, mtime_ns, inode) for path, size, mtime_ns, inode in query}
+
+    def update_file_index(self, fingerprints):
+        """
+        Args:
+            fingerprints:
+                dict of path -> (size, mtime_ns, inode)
+        """
+        rows = [{'path': path, 'folder': os.path.dirname(path), 'size': size,
+                 'mtime_ns': mtime_ns, 'inode': inode}
+                for path, (size, mtime_ns, inode) in fingerprints.items()]
+
+        def insert():
+            for idx in range(0, len(rows), 100):
+                LibraryFile.insert_many(rows[idx:idx + 100]).on_conflict_replace().execute()
+
+        self.write(insert)
+
+    @staticmethod
+    def get_folder_index(root):
+        """
+        Returns:
+            dict of path -> mtime_ns for the root folder and every indexed
+            folder inside it
+        """
+        query = (LibraryFolder
+                 .select(LibraryFolder.path, LibraryFolder.mtime_ns)
+                 .where((LibraryFolder.path == root) |
+                        LibraryFolder.path.startswith(os.path.join(root, '')))
+                 .tuples())
+
+        return dict(query)
+
+    def update_folder_index(self, folders, removed=()):
+        """
+        Args:
+            folders:
+                dict of path -> mtime_ns
+            removed:
+                Paths of folders that no longer exist
+        """
+        rows = [{'path': path, 'mtime_ns': mtime_ns} for path, mtime_ns in folders.items()]
+        removed = list(removed)
+
+        def update():
+            for idx in range(0, len(rows), 100):
+                LibraryFolder.insert_many(rows[idx:idx + 100]).on_conflict_replace().execute()
+
+            for idx in range(0, len(removed), 500):
+                LibraryFolder.delete().where(LibraryFolder.path.in_(removed[idx:idx + 500])).execute()
+
+        self.write(update)
+
+    def remove_files(self, paths):
+        """
+        Removes files from the file index and the songs and queue items
+        that point to them
+        """
+        self.write(self._remove_files, list(paths))
+        self.library_changed()
+        if self._queue_storage is not None:
+            # Queue items of the removed songs were deleted
+            self._queue_storage.load()
+
+    @staticmethod
+    def _remove_files(paths):
+        for idx in range(0, len(paths), 500):
+            chunk = paths[idx:idx + 500]
+            songs = (FullSong
+                     .select(FullSong.id)
+                     .where((FullSong.file_type == 'file') & FullSong.link.in_(chunk)))
+
+            for model in (Playlist.songs.get_through_model(), Tag.songs.get_through_model()):
+                model.delete().where(model.fullsong.in_(songs)).execute()
+
+            QueueSong.delete().where(QueueSong.metadata.in_(songs)).execute()
+            FullSong.delete().where(FullSong.id.in_(songs)).execute()
+            LibraryFile.delete().where(LibraryFile.path.in_(chunk)).execute()
+
     def add_songs(self, cls, songs, step=100, on_error=None):
         for idx in range(0, len(songs), step):
             with self.database.atomic() as txn:
@@ -381,128 +1501,123 @@ class Database:
 
         self.add_songs(FullSong, songs, on_error=on_error)
 
-    def add_from_folder(self, dir, subfolders=False):
-        formats = get_supported_formats()
-        exiftool = ExifTool()
-        song_files = {}
-        for root, dirs, files in os.walk(dir):
-            path = root
-            # Only include files and folder that are not hidden -> they don't start with "."
-            song_files[path] = Dir(path, [f for f in files if not f[0] == '.'])
-            dirs[:] = [d for d in dirs if not d[0] == '.']
-
-            if not subfolders:
-                break
-
-        exiftool.start()
-        i = 0
-        total = 0
-        for folder in song_files.values():
-            folder.filter_files(formats)
-            total += len(folder.files)
-
-        for folder in song_files.values():
-            for files in grouper(folder.files, 20):
-                if files[-1] is None:
-                    # Remove all the None entries created by grouper
-                    files = filter(None, files)
-
-                # Get full filenames
-                files = [os.path.join(folder.folder, f) for f in files]
-                metadata = exiftool.get_metadata(*files)
-
-                pictures = None
-                if folder.cover_art is None:
-                    pictures = exiftool.get_cover_art(*files)
-
-                for idx, mt in enumerate(metadata):
-                    i += 1
-                    song = self.from_metadata(mt)
-
-                    cover = None
-                    if folder.cover_art:
-                        cover, c = CoverArt.get_or_create(file=folder.cover_art)
-                    elif pictures:
-                        cover = pictures[idx].get('Picture')
-                        if cover is not None:
-                            cover = b64_to_cover_art(cover)
-                            cover, c = CoverArt.get_or_create(file=cover)
-
-                    song.cover_art = cover
-                    if song:
-                        try:
-                            song.save()
-                        except Exception as e:
-                            _mt = mt.copy()
-                            if 'Picture' in _mt:
-                                del _mt['Picture']
-
-                            logger.debug("Could not add {} because of an error.\n{}".format(_mt, e))
-                    else:
-                        logger.debug('[Exception] Skipped {}'.format(mt))
-
-                    print_info(i, total, no_duration=True)
-
-        exiftool.terminate()
+    def add_from_folder(self, dir, subfolders=False, workers=None, on_progress=None):
+        """
+        Adds all supported files in a folder to the database.
+        See :class:`src.importer.LibraryImporter` for the import pipeline
+
+        Args:
+            dir:
+                The folder that is imported
+            subfolders:
+                Whether subfolders are imported too
+            workers:
+                How many ExifTool processes are used. Defaults to the cpu count
+            on_progress:
+                Callable that is called with an :class:`src.importer.ImportProgress`
+                as the import advances
+
+        Returns:
+            The last ImportProgress or None if nothing was imported
+        """
+        from src.importer import LibraryImporter
+
+        importer = LibraryImporter(self, workers=workers, on_progress=on_progress)
+        progress = None
+        for progress in importer.import_folder(dir, subfolders):
+            pass
+
+        return progress
 
     @staticmethod
     def from_metadata(mt):
+        mt = parse_metadata(mt)
         if mt is None:
-            logger.debug('Metadata is None')
             return
 
-        name = mt.get('Title', mt.get('FileName'))
-        file = mt.get('SourceFile')
-
-        if name is None or file is None:
-            logger.debug('[ERROR] Name and filepath must be specified')
-            return
-
-        band = mt.get('Band')
+        band = mt.pop('album_artist')
         if band is not None:
             band, c = AlbumArtist.get_or_create(name=band)
 
-        album = mt.get('Album')
+        album = mt['album']
         if album is not None:
-            if len(album) > 0:
-                album, c = Album.get_or_create(name=album, album_artist=band)
-            else:
-                album = None
+            mt['album'], c = Album.get_or_create(name=album, album_artist=band)
 
-        artist = mt.get('Artist')
+        artist = mt['artist']
         if artist is not None:
-            artist, c = Artist.get_or_create(name=artist)
+            mt['artist'], c = Artist.get_or_create(name=artist)
 
-        track = mt.get('Track')
-        if track is not None:
-            try:
-                track = int(track)
-            except (ValueError, TypeError):
-                match = re.match(r'(\d+)(?:[/\\])(?:\d+)', track)
-                if match is None:
-                    logger.debug("Could not extract track number %s from %s" % (name, track))
-                    track = None
-                else:
-                    track = match.groups([None])[0]
+        genre = mt['genre']
+        if genre is not None:
+            mt['genre'], c = Genre.get_or_create(name=genre)
 
-        year = mt.get('Year')
-        if year is not None:
-            if isinstance(year, str):
-                if len(year) > 0:
-                    year = int(year)
-                else:
-                    year = None
+        return FullSong(**mt)
 
-        song = FullSong(title=name,
-                        link=file,
-                        file_type='file',
-                        album=album,
-                        track=track,
-                        artist=artist,
-                        year=year,
-                        duration=mt.get('Duration', 0.0))
 
-        return song
+def _metadata_name(value):
+    if value is None:
+        return
+
+    # ExifTool gives numbers for values like "311" because of the -n flag
+    value = str(value)
+    if len(value) == 0:
+        return
+
+    return value
+
+
+def parse_metadata(mt):
+    """
+    Parses ExifTool metadata into FullSong field values. Related entities
+    (artist, album, album_artist and genre) are given as names
+
+    Returns:
+        dict or None if the metadata was invalid
+    """
+    if mt is None:
+        logger.debug('Metadata is None')
+        return
+
+    name = mt.get('Title', mt.get('FileName'))
+    file = mt.get('SourceFile')
+
+    if name is None or file is None:
+        logger.debug('[ERROR] Name and filepath must be specified')
+        return
+
+    track = mt.get('Track')
+    if track is not None:
+        try:
+            track = int(track)
+        except (ValueError, TypeError):
+            match = re.match(r'(\d+)(?:[/\\])(?:\d+)', str(track))
+            if match is None:
+                logger.debug("Could not extract track number %s from %s" % (name, track))
+                track = None
+            else:
+                track = int(match.group(1))
+
+    year = mt.get('Year')
+    if year is not None:
+        if isinstance(year, str):
+            if len(year) > 0:
+                year = int(year)
+            else:
+                year = None
+
+    return {'title': str(name),
+            'link': file,
+            'file_type': 'file',
+            'album': _metadata_name(mt.get('Album')),
+            'album_artist': _metadata_name(mt.get('Band')),
+            'artist': _metadata_name(mt.get('Artist')),
+            'genre': _metadata_name(mt.get('Genre')),
+            'track': track,
+            'year': year,
+            'duration': mt.get('Duration', 0.0)}
+
+
+COVER_ART_NAMES = ['cover.jpg', 'cover.png', 'folder.jpg', 'folder.png']
 
 
 class Dir:
@@ -511,11 +1626,17 @@ class Dir:
         self.files = files
         self.cover_art = None
 
-    def filter_files(self, formats):
-        cover_art = list(filter(lambda f: f.lower() in ['cover.jpg', 'cover.png', 'folder.jpg', 'folder.png'], self.files))
+    def find_cover_art(self, files):
+        cover_art = list(filter(lambda f: f.lower() in COVER_ART_NAMES, files))
         if cover_art:
             self.cover_art = os.path.join(self.folder, cover_art[0])
 
+        return self.cover_art
+
+    def filter_files(self, formats):
+        if self.cover_art is None:
+            self.find_cover_art(self.files)
+
         self.files = list(filter(lambda f: check_correct_extension(f, formats), self.files))
 
 
@@ -0,0 +1,239 @@
+"""
+Processing of the raw s16le PCM the players write to the output stream.
+Chunks are viewed as numpy arrays of shape (frames, channels) with
+numpy.frombuffer so reading them doesn't copy the data.
+"""
+import numpy as np
+
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+FRAME_WIDTH = SAMPLE_WIDTH * CHANNELS
+
+INT16_MIN = -32768
+INT16_MAX = 32767
+
+LINEAR = 'linear'
+EQUAL_POWER = 'equal_power'
+
+
+def to_frames(data, channels=CHANNELS):
+    """
+    Returns:
+        Read only int16 view of the chunk with the shape (frames, channels)
+    """
+    return np.frombuffer(data, dtype=np.int16, count=len(data) // SAMPLE_WIDTH).reshape(-1, channels)
+
+
+def to_bytes(samples):
+    """Clips float samples to the int16 range and returns them as s16le"""
+    np.clip(samples, INT16_MIN, INT16_MAX, out=samples)
+    return samples.astype(np.int16).tobytes()
+
+
+def dbfs_to_amplitude(dbfs):
+    """
+    Returns:
+        The sample value of the given level relative to full scale
+    """
+    return (INT16_MAX + 1) * 10 ** (dbfs / 20)
+
+
+def amplitude_to_dbfs(amplitude):
+    if amplitude <= 0:
+        return float('-inf')
+
+    return 20 * np.log10(amplitude / (INT16_MAX + 1))
+
+
+def rms(data):
+    """
+    Returns:
+        Root mean square of all samples of the chunk
+    """
+    samples = np.frombuffer(data, dtype=np.int16, count=len(data) // SAMPLE_WIDTH)
+    if not len(samples):
+        return 0.0
+
+    samples = samples.astype(np.float32)
+    return float(np.sqrt(np.dot(samples, samples) / len(samples)))
+
+
+def peak(data):
+    """
+    Returns:
+        The largest absolute sample value of the chunk
+    """
+    samples = np.frombuffer(data, dtype=np.int16, count=len(data) // SAMPLE_WIDTH)
+    if not len(samples):
+        return 0
+
+    # abs(-32768) doesn't fit in int16
+    return max(int(samples.max()), -int(samples.min()))
+
+
+def _loud_frames(data, threshold):
+    frames = to_frames(data)
+    # Comparing both bounds avoids abs which overflows with -32768
+    return ((frames > threshold) | (frames < -threshold)).any(axis=1)
+
+
+def leading_silence(data, threshold):
+    """
+    Returns:
+        How many frames at the start of the chunk have no sample
+        louder than threshold
+    """
+    loud = _loud_frames(data, threshold)
+    if not loud.any():
+        return len(loud)
+
+    return int(loud.argmax())
+
+
+def trailing_silence(data, threshold):
+    """
+    Returns:
+        How many frames at the end of the chunk have no sample
+        louder than threshold
+    """
+    loud = _loud_frames(data, threshold)
+    if not loud.any():
+        return len(loud)
+
+    return int(loud[::-1].argmax())
+
+
+class Volume:
+    """
+    Scales the samples by a gain. When the gain is changed it ramps to
+    the new value linearly instead of jumping, which would click.
+
+    Args:
+        gain:
+            Initial gain
+        samplerate:
+            Sample rate of the chunks
+        ramp:
+            Seconds it takes to reach a new gain
+    """
+    def __init__(self, gain=1.0, samplerate=44100, ramp=0.05):
+        self._current = float(gain)
+        self._target = float(gain)
+        self._ramp_frames = max(int(samplerate * ramp), 1)
+        self._step = 0.0
+        self._remaining = 0
+
+    @property
+    def gain(self):
+        return self._target
+
+    @gain.setter
+    def gain(self, value):
+        self._target = float(value)
+        self._step = (self._target - self._current) / self._ramp_frames
+        self._remaining = self._ramp_frames
+
+    def apply(self, data):
+        """
+        Returns:
+            The chunk scaled by the gain as s16le
+        """
+        samples = to_frames(data)
+        if not self._remaining:
+            if self._current == 1.0:
+                return data
+
+            return to_bytes(samples * np.float32(self._current))
+
+        count = min(len(samples), self._remaining)
+        gains = np.full((len(samples), 1), self._target, dtype=np.float32)
+        gains[:count, 0] = self._current + self._step * np.arange(1, count + 1, dtype=np.float32)
+
+        self._remaining -= count
+        self._current = self._target if not self._remaining else float(gains[count - 1, 0])
+        return to_bytes(samples * gains)
+
+
+def fade_curves(length, curve=EQUAL_POWER):
+    """
+    Args:
+        length:
+            Length of the fade in frames
+        curve:
+            EQUAL_POWER keeps the loudness of uncorrelated songs constant
+            during the fade. LINEAR keeps the amplitude constant
+
+    Returns:
+        tuple of float32 gains (fade_in, fade_out) with the shape (length, 1)
+    """
+    t = np.linspace(0, 1, length, endpoint=False, dtype=np.float32)
+    if curve == LINEAR:
+        fade_in = t
+        fade_out = 1 - t
+    else:
+        fade_in = np.sin(t * np.float32(np.pi / 2))
+        fade_out = np.cos(t * np.float32(np.pi / 2))
+
+    return fade_in.reshape(-1, 1), fade_out.reshape(-1, 1)
+
+
+class Crossfade:
+    """
+    Mixes the end of a song with the start of the next one chunk by
+    chunk. The position in the fade is kept between calls so the fade can
+    be spread over any number of chunks of any size.
+
+    Args:
+        samplerate:
+            Sample rate of both songs
+        seconds:
+            Length of the fade
+        curve:
+            Shape of the fade. See :func:`fade_curves`
+    """
+    def __init__(self, samplerate, seconds, curve=EQUAL_POWER):
+        self.length = max(int(samplerate * seconds), 1)
+        self._fade_in, self._fade_out = fade_curves(self.length, curve)
+        self.position = 0
+
+    @property
+    def finished(self):
+        return self.position >= self.length
+
+    def _gains(self, gains, frames, fill):
+        start = min(self.position, self.length)
+        gains = gains[start:start + frames]
+        if len(gains) < frames:
+            gains = np.concatenate((gains, np.full((frames - len(gains), 1), fill, dtype=np.float32)))
+
+        return gains
+
+    def mix(self, outgoing, incoming):
+        """
+        Mixes two s16le chunks. The shorter chunk is padded with silence
+
+        Returns:
+            The mixed chunk as s16le
+        """
+        a = to_frames(outgoing)
+        b = to_frames(incoming)
+        frames = max(len(a), len(b))
+
+        mixed = np.zeros((frames, CHANNELS), dtype=np.float32)
+        mixed[:len(a)] = a * self._gains(self._fade_out, len(a), 0)
+        mixed[:len(b)] += b * self._gains(self._fade_in, len(b), 1)
+        self.position += frames
+        return to_bytes(mixed)
+
+    def fade_in(self, incoming):
+        """
+        Applies the rest of the fade in to a chunk of the next song.
+        Used when the previous song ended before the fade finished
+        """
+        if self.finished:
+            return incoming
+
+        b = to_frames(incoming)
+        faded = b * self._gains(self._fade_in, len(b), 1)
+        self.position += len(b)
+        return to_bytes(faded)
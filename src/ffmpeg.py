@@ -1,11 +1,11 @@
 import shlex
 import subprocess
-import re
 
 
 class FFmpeg:
     __slots__ = ['ffmpeg', 'file', 'channels', 'samplerate', '_process',
-                 'running', 'filters', 'before_options', '_cmd']
+                 'running', 'filters', 'before_options', '_cmd', 'seek_position',
+                 'seek_index']
 
     def __init__(self, file=None, path='ffmpeg', before_options='', channels=2,
                  samplerate=44100):
@@ -18,6 +18,10 @@ class FFmpeg:
         self.filters = ''
         self.before_options = before_options
         self._cmd = ''
+        # Second the decoding starts from
+        self.seek_position = None
+        # src.seek_index.SeekIndex of the file if it has been built
+        self.seek_index = None
 
     def add_filter(self, filter, arguments=None):
         if not self.filters:
@@ -40,31 +44,49 @@ class FFmpeg:
 
         return self._process
 
+    def _seek_options(self):
+        """
+        Returns:
+            tuple of the seek options placed before and after the input
+        """
+        if not self.seek_position:
+            return '', ''
+
+        input_format = None
+        if self.seek_index is not None:
+            input_format = self.seek_index.input_format(self.file)
+
+        if input_format is None:
+            return ' -ss {}'.format(round(self.seek_position, 3)), ''
+
+        # Skip to the indexed packet before the position and decode the
+        # rest. Timestamps start from 0 after the skipped bytes
+        time, offset = self.seek_index.lookup(self.seek_position)
+        before = ' -f {} -skip_initial_bytes {}'.format(input_format, offset)
+        after = ''
+        if self.seek_position > time:
+            after = ' -ss {}'.format(round(self.seek_position - time, 3))
+
+        return before, after
+
     def create_command(self):
         before_opts = ''
-        if isinstance(self.before_options, str):
-            before_opts = ' ' + self.before_options
-            before_opts = before_opts.replace('  ', ' ')
+        if isinstance(self.before_options, str) and self.before_options:
+            before_opts = ' ' + self.before_options.strip()
 
-        cmd = '{}{} -i "{}" -vn -f s16le -ar {} -ac {} -loglevel warning{} pipe:1'.format(self.ffmpeg, before_opts, self.file,
-                                                                                        self.samplerate, self.channels, self.filters)
+        seek_before, seek_after = self._seek_options()
+        cmd = '{}{}{} -i "{}"{} -vn -f s16le -ar {} -ac {} -loglevel warning{} pipe:1'.format(
+            self.ffmpeg, before_opts, seek_before, self.file, seek_after,
+            self.samplerate, self.channels, self.filters)
 
         self._cmd = cmd
         return self._cmd
 
     def reset_seek(self):
-        if '-ss' in self.before_options:
-            self.before_options = re.sub('(-ss \d+\.\d*)|(-ss \d+:\d+:\d+\.\d*)',
-                                         '', self.before_options)
-            self.before_options = self.before_options.strip()
+        self.seek_position = None
 
     def seek(self, seconds):
-        seek_str = '-ss {}'.format(round(seconds, 3))
-        if '-ss ' in self.before_options:
-            self.before_options = re.sub('(-ss \d+\.\d*)|(-ss \d+:\d+:\d+\.\d*)', seek_str, self.before_options)
-        else:
-            self.before_options += ' ' + seek_str
-
+        self.seek_position = seconds
         self.kill()
 
         self.create_command()
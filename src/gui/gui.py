@@ -11,6 +11,7 @@ from src.gui.media_controls import MediaControls
 from src.gui.nowplaying import NowPlaying
 from src.gui.style import ProxyStyle
 from src.gui.settings import SettingsWindow
+from src.gui.table_view import PeeweeTableModel, SongTable, song_columns
 from src.metadata import MetadataUpdater
 
 class MainWindow(QMainWindow):
@@ -33,7 +34,11 @@ class MainWindow(QMainWindow):
         self.metadata.start()
         self.metadata.add_to_update(self.session.queues[0], forced=True)
 
-        self.tabs.insertWidget(-1, self.now_playing)
+        self.now_playing_index = self.tabs.insertWidget(-1, self.now_playing)
+
+        # Rows are fetched in pages as the table is scrolled
+        self.library = SongTable(PeeweeTableModel(database, song_columns()))
+        self.library_index = self.tabs.insertWidget(-1, self.library)
         self.setCentralWidget(self.tabs)
 
         self.bottom_dock = QDockWidget(self)
@@ -53,9 +58,17 @@ class MainWindow(QMainWindow):
         menu = self.menuBar().addMenu(Icons.Menu, 'Preferences')
         action = menu.addAction('Settings')
         action.triggered.connect(lambda x: SettingsWindow(self.settings_manager, self.session).exec_())
+        action = menu.addAction('Library')
+        action.triggered.connect(self.change_tab)
 
         self.restore_position_settings()
 
+    def change_tab(self, checked=False):
+        if self.tabs.currentIndex() == self.library_index:
+            self.tabs.setCurrentIndex(self.now_playing_index)
+        else:
+            self.tabs.setCurrentIndex(self.library_index)
+
     # http://stackoverflow.com/a/8736705/6046713
     def save_position_settings(self):
         settings = self.settings_manager.get_unique_settings_inst()
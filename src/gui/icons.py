@@ -1,7 +1,12 @@
+import logging
 import os
 
-from PyQt5.QtGui import QPixmap, QIcon
-from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QPixmap, QIcon, QImage, QImageReader
+from PyQt5.QtCore import Qt, QSize, QObject, QRunnable, QThreadPool, pyqtSignal
+
+from src.cache import ArtCache, get_art_cache
+
+logger = logging.getLogger('debug')
 
 
 class Icons:
@@ -24,28 +29,150 @@ class Icons:
         Icons.Menu = QIcon(os.path.join(Icons.IconDir, 'menu.png'))
 
 
+class CancelToken:
+    __slots__ = ['cancelled']
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ThumbnailSignals(QObject):
+    # img, CancelToken of the task, QImage
+    finished = pyqtSignal(object, object, object)
+
+
+class ThumbnailTask(QRunnable):
+    """
+    Decodes and scales one icon in a thread of the pool. Only a QImage is
+    made here since QPixmaps can only be created in the GUI thread
+    """
+    def __init__(self, img, size, token, signals):
+        super().__init__()
+        # The manager keeps the task so it can be taken back from the queue
+        self.setAutoDelete(False)
+        self.img = img
+        self.size = size
+        self.token = token
+        self.signals = signals
+
+    def run(self):
+        if self.token.cancelled:
+            return
+
+        image = QImage()
+        try:
+            # The thumbnail of the art is already scaled so the full image is never decoded
+            variant = ArtCache.size_for(max(self.size.width(), self.size.height()))
+            reader = QImageReader(get_art_cache().get(self.img, variant) or self.img)
+            source_size = reader.size()
+            if source_size.width() > self.size.width() or source_size.height() > self.size.height():
+                reader.setScaledSize(source_size.scaled(self.size, Qt.KeepAspectRatio))
+
+            image = reader.read()
+        except Exception:
+            logger.exception('Could not load icon %s' % self.img)
+
+        if not self.token.cancelled:
+            self.signals.finished.emit(self.img, self.token, image)
+
+
+class PendingIcon:
+    __slots__ = ['token', 'task', 'count', 'callbacks']
+
+    def __init__(self, token, task):
+        self.token = token
+        self.task = task
+        self.count = 0
+        self.callbacks = []
+
+
 class IconManager:
-    def __init__(self, icons, default_size=(80, 80)):
+    """
+    Reference counted icons of cover art. Icons are decoded in a thread
+    pool so scrolling through a long list doesn't block the GUI thread.
+    Icons unloaded before they're decoded are cancelled.
+
+    Args:
+        icons:
+            dict of already loaded icons
+        default_size:
+            Size of the icons when load_icon isn't given one
+        max_threads:
+            How many icons are decoded at the same time
+    """
+    def __init__(self, icons, default_size=(80, 80), max_threads=2):
         self.icons = icons or {}
         self.default_size = default_size
+        self._pending = {}
+        self._pool = QThreadPool()
+        self._pool.setMaxThreadCount(max_threads)
+        self._signals = ThumbnailSignals()
+        self._signals.finished.connect(self._on_finished)
 
-    def load_icon(self, img, size=None):
-        icon = self.icons.get(img)
-        if icon is None:
-            pixmap = QPixmap(img)
-            if size is None:
-                size = self.default_size
+    def load_icon(self, img, size=None, callback=None):
+        """
+        Every call has to be matched with a call to unload_icon
 
-            pixmap = pixmap.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            icon = QIcon(pixmap)
-            self.icons[img] = (icon, 1)
-            return icon
+        Args:
+            img:
+                Path of the image
+            size:
+                QSize the icon is scaled to fit in
+            callback:
+                Called in the GUI thread with img and the icon when an icon
+                that wasn't loaded has been decoded
 
-        else:
+        Returns:
+            The icon or None if it's being decoded
+        """
+        icon = self.icons.get(img)
+        if icon is not None:
             self.icons[img] = (icon[0], icon[1] + 1)
             return icon[0]
 
+        pending = self._pending.get(img)
+        if pending is None:
+            if size is None:
+                size = QSize(*self.default_size)
+
+            token = CancelToken()
+            pending = PendingIcon(token, ThumbnailTask(img, size, token, self._signals))
+            self._pending[img] = pending
+            self._pool.start(pending.task)
+
+        pending.count += 1
+        if callback is not None:
+            pending.callbacks.append(callback)
+
+    def _on_finished(self, img, token, image):
+        pending = self._pending.get(img)
+        # Cancelled or loaded again after cancelling
+        if pending is None or pending.token is not token:
+            return
+
+        del self._pending[img]
+        icon = QIcon(QPixmap.fromImage(image))
+        self.icons[img] = (icon, pending.count)
+        for callback in pending.callbacks:
+            callback(img, icon)
+
     def unload_icon(self, img):
+        if img is None:
+            return
+
+        pending = self._pending.get(img)
+        if pending is not None:
+            pending.count -= 1
+            if pending.count <= 0:
+                pending.token.cancel()
+                self._pool.tryTake(pending.task)
+                del self._pending[img]
+
+            return
+
         icon = self.icons.get(img)
         if icon is None:
             return print('icon not loaded')
@@ -1,4 +1,4 @@
-from threading import Lock, Thread
+from threading import Event, Thread
 
 from PyQt5 import QtCore, QtGui
 from PyQt5.QtCore import QSize, pyqtSignal, QRectF, Qt, QPoint, QTimer
@@ -178,8 +178,12 @@ class MediaControls(QHBoxLayout):
         self.session = session
         self.player.duration_fn = self.update_duration
         self.player.on_start = self.player_start
-        self.seek_lock = Lock()
         self.playing = False
+        # Latest (slider value, slider maximum) to seek to
+        self._seek_target = None
+        self._seek_requested = Event()
+        self._seek_worker = Thread(target=self._seek_loop, daemon=True)
+        self._seek_worker.start()
         self.current = None
 
         size_policy = QSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
@@ -290,21 +294,26 @@ class MediaControls(QHBoxLayout):
         if self.player.not_playing.is_set():
             return
 
-        if self.seek_lock.acquire(False):
-            t = Thread(target=self._seek, args=(slider, self.seek_lock))
-            t.start()
+        # Positions requested while a seek is running are coalesced so only
+        # the latest one is seeked to after it
+        self._seek_target = (slider.value(), slider.maximum())
+        self._seek_requested.set()
 
-    def _seek(self, slider, lock):
+    def _seek_loop(self):
+        while True:
+            self._seek_requested.wait()
+            self._seek_requested.clear()
+            target = self._seek_target
+            if target is not None:
+                self._seek(*target)
+
+    def _seek(self, value, maximum):
         try:
-            print(slider.value(), slider.maximum())
-            if slider.value() == slider.maximum():
+            if value == maximum:
                 return self.player.play_next_song()
 
             total = self.player.current.duration
-            seconds = slider.value()/slider.maximum()*total
-            print(total, seconds)
+            seconds = value/maximum*total
             self.player.stream_player.seek(seconds, self.player.current.ffmpeg)
         except Exception as e:
             print('Seeking exception. %s' % e)
-        finally:
-            lock.release()
@@ -1,18 +1,20 @@
 from PyQt5 import QtCore, QtGui
-from PyQt5.QtCore import QRect, QSize, pyqtSignal, QRectF, Qt, QPoint, QTimer
-from PyQt5.QtGui import QIcon, QPixmap, QPainter, QImage, QColor, QPen, QBrush
+from PyQt5.QtCore import (QRect, QSize, pyqtSignal, QRectF, Qt, QPoint, QTimer,
+                          QAbstractListModel, QModelIndex)
+from PyQt5.QtGui import QPixmap, QPainter, QImage, QColor, QPen, QBrush
 from PyQt5.QtWidgets import (QWidget, QLabel, QPushButton, QApplication,
                              QSizePolicy, QHBoxLayout, QSlider, QGridLayout,
                              QGraphicsDropShadowEffect, QGraphicsPixmapItem,
-                             QGraphicsScene, QListWidget, QListWidgetItem, QStyledItemDelegate,
+                             QGraphicsScene, QListView, QStyledItemDelegate,
                              QMenu, QDialog, QLineEdit, QVBoxLayout, QFrame, QMessageBox,
                              QMainWindow, QProxyStyle, QStyle, QDockWidget,
                              QStackedWidget)
 
-from src.queues import ScrollingIconPage
+from src.shuffle import ShuffleEngine
 from src.gui.icons import IconManager
 from src.globals import GV
 from src.song import Song
+from src.queue_view import QueueView
 import sys
 import os
 import logging
@@ -20,86 +22,189 @@ import logging
 logger = logging.getLogger('debug')
 
 
-class BaseListWidget(QListWidget):
+class QueueModel(QAbstractListModel):
+    """
+    List model of the songs of a queue. The queue can be a
+    :class:`QueueView` or a list of :class:`Song`. Rows are read from the
+    queue when the view paints them so nothing is created per row when
+    the queue is loaded or reordered.
+
+    Icons are only loaded for the rows near the visible part of the list.
+    See :func:`set_visible_rows`
+
+    Rows whose data changed are signaled with row_changed instead of
+    dataChanged since QListView lays out every row again on dataChanged
+    """
+    Size = QSize(150, 80)
+    IconSize = QSize(80, 80)
+
     unchecked_color = QBrush(QColor(0, 0, 0, 0))
     checked_color = QBrush(QColor('#304FFE'))
     hover_color = QBrush(QColor(48, 79, 254, 150))
 
-    def __init__(self, parent=None):
-        super().__init__(parent=parent)
-        self.hovered = None
-        self.currently_selected = None
+    # Emitted from the thread that changed the song
+    song_updated = pyqtSignal(object)
+    row_changed = pyqtSignal(int)
 
-        self.setMouseTracking(True)
-        self.setUniformItemSizes(True)
+    def __init__(self, icon_manager, queue=None, parent=None):
+        super().__init__(parent)
+        self.icon_manager = icon_manager
+        self.queue = queue if queue is not None else []
+        self.selected = -1
+        self.hovered = -1
+        # Rows with a loaded icon and their cover art
+        self._icons = {}
+        self.song_updated.connect(self._on_song_updated)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+
+        return len(self.queue)
+
+    def set_queue(self, queue):
+        """Shows another queue or the same queue after it was reordered"""
+        self.beginResetModel()
+        self._unload_icons(list(self._icons))
+        self.queue = queue if queue is not None else []
+        self.selected = -1
+        self.hovered = -1
+        self.endResetModel()
+
+    def _info(self, row):
+        """
+        Returns:
+            The song or the :class:`src.database.SongRow` of the row
+            whose columns are shown. None if the song has been deleted
+        """
+        if isinstance(self.queue, QueueView):
+            song = self.queue.loaded_song(row)
+            if song is None:
+                # Only the columns shown are needed so no song is created for this
+                return self.queue.row(row)
+        else:
+            song = self.queue[row]
+            song.index = row
 
-    def mouseMoveEvent(self, event):
-        self._change_hovered(event)
+        # The callbacks can be called from other threads
+        song.on_cover_art_changed = self.song_updated.emit
+        song.after_download = self.song_updated.emit
+        return song
 
-    def _change_hovered(self, event):
-        item = self.itemAt(event.pos())
-        if item == self.hovered:
-            return
+    def data(self, index, role=Qt.DisplayRole):
+        row = index.row()
+        if not index.isValid() or not 0 <= row < len(self.queue):
+            return None
+
+        if role == Qt.DisplayRole:
+            info = self._info(row)
+            if info is None:
+                return '\r\n'
+
+            return '{}\r\n{}'.format(*info.get_name_and_author())
+
+        if role == Qt.UserRole:
+            info = self._info(row)
+            return '' if info is None else info.duration_formatted
 
-        self.change_hovered(item)
+        if role == Qt.DecorationRole:
+            icon = self.icon_manager.icons.get(self._icons.get(row))
+            return None if icon is None else icon[0]
 
-    def change_hovered(self, item):
-        def set_hovered(_item):
-            self.hovered = _item
-            if _item.checkState() == Qt.Checked:
-                return
-            _item.setBackground(self.hover_color)
+        if role == Qt.BackgroundRole:
+            if row == self.selected:
+                return self.checked_color
 
-        if item is None:
-            if self.hovered is None:
-                return
+            if row == self.hovered:
+                return self.hover_color
 
-            color = self.checked_color if self.hovered.checkState() == Qt.Checked else self.unchecked_color
-            self.hovered.setBackground(color)
-            self.hovered = None
+            return self.unchecked_color
+
+        if role == Qt.SizeHintRole:
+            return self.Size
+
+        return None
+
+    def song(self, row):
+        """
+        Returns:
+            :class:`Song` of the row
+        """
+        return self.queue[row]
+
+    def refresh_row(self, row):
+        """Shows the current info and cover art of the row"""
+        if not 0 <= row < len(self.queue):
+            return
+
+        if row in self._icons:
+            self._unload_icons([row])
+            self._load_icons([row])
+
+        self.row_changed.emit(row)
+
+    def _on_song_updated(self, song):
+        row = getattr(song, 'index', -1)
+        if not 0 <= row < len(self.queue):
             return
 
-        if self.hovered is None:
-            set_hovered(item)
+        if isinstance(self.queue, QueueView):
+            current = self.queue.loaded_song(row)
         else:
-            color = self.checked_color if self.hovered.checkState() == Qt.Checked else self.unchecked_color
-            self.hovered.setBackground(color)
-            set_hovered(item)
+            current = self.queue[row]
 
-    def wheelEvent(self, event):
-        super().wheelEvent(event)
-        self._change_hovered(event)
+        if current is song:
+            self.refresh_row(row)
 
-    def leaveEvent(self, event):
-        self.change_hovered(None)
-
-    def change_selected(self, item):
-        if self.currently_selected is not None:
-            self.currently_selected.setBackground(self.unchecked_color)
-            self.currently_selected.setCheckState(Qt.Unchecked)
-
-        self.currently_selected = item
-        if item is not None:
-            item.setCheckState(Qt.Checked)
-            item.setBackground(self.checked_color)
-
-    def on_item_clicked(self, item):
-        if item is not None:
-            if item.checkState() == Qt.Unchecked:
-                self.change_selected(item)
-            else:
-                if self.currently_selected is item:
-                    return
+    def _set_row(self, attr, row):
+        old = getattr(self, attr)
+        setattr(self, attr, row)
+        for changed in {old, row}:
+            if 0 <= changed < len(self.queue):
+                self.row_changed.emit(changed)
+
+    def set_selected(self, row):
+        self._set_row('selected', row)
 
-                item.setCheckState(Qt.Unchecked)
-                item.setBackground(self.unchecked_color)
+    def set_hovered(self, row):
+        if row != self.hovered:
+            self._set_row('hovered', row)
 
-                if self.currently_selected is not None:
-                    self.currently_selected.setCheckState(Qt.Unchecked)
-                    self.currently_selected = None
+    def _cover_art(self, row):
+        info = self._info(row)
+        return None if info is None else info.cover_art
 
+    def _load_icons(self, rows):
+        for row in rows:
+            img = self._cover_art(row)
+            self._icons[row] = img
+            if img is None:
+                continue
 
-class SongQueue(BaseListWidget):
+            icon = self.icon_manager.load_icon(img, size=self.IconSize, callback=self._icon_loaded)
+            if icon is not None:
+                self.row_changed.emit(row)
+
+    def _unload_icons(self, rows):
+        for row in rows:
+            self.icon_manager.unload_icon(self._icons.pop(row, None))
+
+    def _icon_loaded(self, img, icon):
+        for row, row_img in self._icons.items():
+            if row_img == img:
+                self.row_changed.emit(row)
+
+    def set_visible_rows(self, first, last, margin=10):
+        """
+        Loads the icons of the rows from first to last and margin rows
+        around them and unloads the icons of the other rows
+        """
+        rows = range(max(first - margin, 0), min(last + margin + 1, len(self.queue)))
+        self._unload_icons([row for row in self._icons if row not in rows])
+        self._load_icons([row for row in rows if row not in self._icons])
+
+
+class SongQueue(QListView):
     def __init__(self, player, session, settings, database, parent=None):
         super().__init__(parent)
         self.settings_manager = settings
@@ -107,10 +212,18 @@ class SongQueue(BaseListWidget):
         self.player = player
         self.session = session
 
+        self.setMouseTracking(True)
+        self.setUniformItemSizes(True)
+
+        self.icon_manager = IconManager(None)
+        self.queue_model = QueueModel(self.icon_manager, parent=self)
+        self.queue_model.row_changed.connect(self.update_row)
+        self.setModel(self.queue_model)
+
         self.last_doubleclicked = None
         self.setItemDelegate(SongItemDelegate(parent=self, paint_icons=self.settings.value('paint_icons', True)))
-        self.itemClicked.connect(self.on_item_clicked)
-        self.itemDoubleClicked.connect(self.on_doubleclick)
+        self.clicked.connect(self.on_item_clicked)
+        self.doubleClicked.connect(self.on_doubleclick)
         self.verticalScrollBar().valueChanged.connect(self.on_scroll)
 
         self.current_queue = self.settings.value('queue', GV.MainQueue)
@@ -123,71 +236,79 @@ class SongQueue(BaseListWidget):
         self.icon_timer.setSingleShot(True)
         self.icon_timer.timeout.connect(self.load_current_index)
 
-        self.pages = ScrollingIconPage(None)
-        self.icon_manager = IconManager(None)
-
     @property
     def settings(self):
         return self.settings_manager.get_settings_instance()
 
-    def on_doubleclick(self, item):
-        if item is not None:
-            self.song_timer.stop()
-            self.last_doubleclicked = item
-            self.song_timer.start(200)
+    def count(self):
+        return self.queue_model.rowCount()
 
-    def load_songs(self, queue):
-        _queue = []
-        for item in queue:
-            _queue.append(self.add_list_item(item))
+    def mouseMoveEvent(self, event):
+        super().mouseMoveEvent(event)
+        self.queue_model.set_hovered(self.indexAt(event.pos()).row())
 
-        return _queue
+    def wheelEvent(self, event):
+        super().wheelEvent(event)
+        self.queue_model.set_hovered(self.indexAt(event.pos()).row())
 
-    def load_current_queue(self):
-        self.clear_items()
-        q = self.session.queues[self.current_queue]
-        for song in q:
-            self.add_list_item(song)
+    def leaveEvent(self, event):
+        self.queue_model.set_hovered(-1)
+
+    def update_row(self, row):
+        self.update(self.queue_model.index(row))
 
+    def change_selected(self, row):
+        self.queue_model.set_selected(-1 if row is None else row)
+
+    def on_item_clicked(self, index):
+        if index.isValid():
+            self.change_selected(index.row())
+
+    def on_doubleclick(self, index):
+        if index.isValid():
+            self.song_timer.stop()
+            self.last_doubleclicked = index.row()
+            self.song_timer.start(200)
+
+    def load_current_queue(self):
+        self.queue_model.set_queue(self.session.queues[self.current_queue])
         self.load_current_index()
         self.player.update_queue(self.current_queue)
 
     def load_current_index(self):
-        try:
-            page_index = int(self.verticalScrollBar().value() / self.pages.part_length)
-            self.pages.load_pages(page_index)
-        except Exception as e:
-            print('dawdad', e)
+        """Loads the icons of the visible rows"""
+        # indexAt doesn't find the rows until the pending layout is done
+        self.executeDelayedItemsLayout()
+        rect = self.viewport().rect()
+        first = self.indexAt(rect.topLeft()).row()
+        if first < 0:
+            # The top of the view can be in the spacing between rows
+            first = self.indexAt(rect.topLeft() + QPoint(self.spacing(), self.spacing())).row()
+
+        if first < 0:
+            return
+
+        last = first + rect.height() // QueueModel.Size.height() + 1
+        self.queue_model.set_visible_rows(first, last)
 
     def clear_current_queue(self):
         # TODO Might not be used
-        self.clear_items()
-        current = self.current_queue
-        queue = self.session.queues.get(current, [])
+        queue = self.session.queues.get(self.current_queue, [])
         queue.clear()
+        self.queue_model.set_queue(queue)
 
     def clear_items(self):
-        self.currently_selected = None
-        self.pages.clear_pages()
-        self.pages.set_collection(None)
-        while self.count() > 0:
-            self.takeItem(0)
+        self.queue_model.set_queue(None)
 
     def scroll_to_selected(self):
         current = self.player.current
-        if current is not None:
-            self.scroll_to_item(current)
+        if current is not None and current.index >= 0:
+            self.scroll_to_row(current.index)
 
-    def scroll_to_item(self, item):
-        self.scrollToItem(item)
-        self.pages.load_pages(item.song.index)
-
-    def item_list(self, list_type=list):
-        q = list_type()
-        for i in range(self.count()):
-            q.append(self.item(i))
-
-        return q
+    def scroll_to_row(self, row):
+        if 0 <= row < self.count():
+            self.scrollTo(self.queue_model.index(row))
+            self.load_current_index()
 
     def load_last_queue(self):
         self.change_selected(None)
@@ -204,24 +325,68 @@ class SongQueue(BaseListWidget):
 
         self.settings.setValue('queue', self.current_queue)
         self.load_current_queue()
-        self.player.skip_to(index, self.item(index))
-        self.pages.load_pages(index)
-        self.scrollToItem(self.item(index))
+        self.player.skip_to(index)
+        self.scroll_to_row(index)
 
     def shuffle_queue(self):
-        self.session.database.shuffle_queue()
-
-        self.clear_items()
         queue = self.session.queues[self.current_queue]
-        queue = sorted(queue, key=lambda i: i.sort_order)
+        if isinstance(queue, QueueView):
+            self.db.shuffle_queue()
+            queue.load()
+            self.remap_items(queue)
+            return
+
+        if self.current_queue == GV.MainQueue:
+            # The main queue is shuffled from its original order in the database
+            old = self.db.get_queue_shuffle(len(queue))
+            if old is not None:
+                queue = ShuffleEngine.unapply(queue, old)
+
+            permutation = self.db.shuffle_queue()
+        else:
+            permutation = ShuffleEngine.permutation(len(queue), ShuffleEngine.new_seed())
+
+        if len(permutation) != len(queue):
+            logger.info('Queue out of sync with the database. Reloading it')
+            queue = [Song(item, self.session.downloader, idx)
+                     for idx, item in enumerate(self.db.get_queue())]
+        else:
+            queue = ShuffleEngine.apply(queue, permutation)
+
         self.session.queues[self.current_queue] = queue
-        self.load_current_queue()
+        self.remap_items(queue)
+
+    def remap_items(self, queue):
+        """
+        Shows the reordered queue. The rows are read again when they're painted
+        """
+        current = self.player.current
+        if isinstance(queue, QueueView):
+            if current is not None:
+                try:
+                    queue.adopt(current)
+                except ValueError:
+                    current.index = -1
+        else:
+            for row, song in enumerate(queue):
+                song.index = row
+
+            if current is not None and current not in queue:
+                current.index = -1
+
+        self.queue_model.set_queue(queue)
+        if current is not None and current.index >= 0:
+            self.change_selected(current.index)
+            self.session.index = current.index
+
+        self.load_current_index()
+        self.player.update_queue(self.current_queue, self.session.index)
 
     def change_song(self):
         if self.last_doubleclicked is not None:
             settings = self.settings
-            index = self.indexFromItem(self.last_doubleclicked).row()
-            self.player.skip_to(index, self.last_doubleclicked)
+            index = self.last_doubleclicked
+            self.player.skip_to(index)
             self.session.index = index
             settings.setValue('index', index)
 
@@ -232,93 +397,14 @@ class SongQueue(BaseListWidget):
                 self.session.secondary_index = index
                 settings.setValue('secondary_index', index)
 
-    def addItem(self, item, *args):
-        super().addItem(item, *args)
-        if self.currently_selected is None:
-            self.currently_selected = item
-            item.setBackground(self.checked_color)
-            item.setCheckState(Qt.Checked)
-
-    def _add_item(self, item, is_selected=False):
-        song = item.song
-        name, author = song.get_name_and_author()
-
-        item.setText('{}\r\n{}'.format(name, author))
-        item.setData(Qt.UserRole, song.duration_formatted)
-
-        if is_selected:
-            item.setCheckState(Qt.Checked)
-            item.setBackground(self.checked_color)
-            self.change_selected(item)
-
-        song.index = self.count()
-        self.addItem(item)
-        self.pages.append_item(item)
-        return item
-
     def on_scroll(self, value):
         self.icon_timer.stop()
-        self.icon_timer.start(250)
-
-    def add_from_item(self, item, is_selected=False):
-        return self._add_item(item, is_selected)
-
-    def add_list_item(self, song, is_selected=False):
-        item = SongItem(song, self.icon_manager)
-        return self._add_item(item, is_selected)
-
-
-class SongItem(QListWidgetItem):
-    Background = QBrush(QColor(167, 218, 245, 0))
-    Size = QSize(150, 80)
-
-    def __init__(self, song, icon_manager, icon_displayed=False, *args):
-        super().__init__(*args)
-        self.setFlags(self.flags() | Qt.ItemIsUserCheckable)
-        self.setCheckState(Qt.Unchecked)
-        self.setBackground(self.Background)
-        self.setSizeHint(self.Size)
-
-        self.song = song
-        self.icon_manager = icon_manager
-        self.img = None
-        self.icon_displayed = icon_displayed
-
-        self.song.on_cover_art_changed = self.update_icon
-        self.song.after_download = self.update_info
-        self.loaded = False
-
-    def _load_icon(self):
-        img = self.song.cover_art
-        if img is None or self.img == img:
-            return
-
-        self._unload_icon(self.img)
-        self.img = img
-        icon = self.icon_manager.load_icon(self.img, size=QSize(80, 80))
-        self.setIcon(icon)
+        # Icons are decoded in the background so they can be requested soon after scrolling
+        self.icon_timer.start(100)
 
-    def load_icon(self):
-        self._load_icon()
-        self.loaded = True
-
-    def _unload_icon(self, img):
-        self.setIcon(QIcon())
-        self.icon_manager.unload_icon(img)
-
-    def unload_icon(self):
-        self.loaded = False
-        self._unload_icon(self.img)
-        self.img = None
-
-    def update_icon(self, song=None):
-        if self.loaded:
-            self._load_icon()
-
-    def update_info(self, song=None):
-        self.setText('{}\r\n{}'.format(*self.song.get_name_and_author()))
-        self.setData(Qt.UserRole, self.song.duration_formatted)
-        self.update_icon()
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.icon_timer.start(100)
 
 
 class SongItemDelegate(QStyledItemDelegate):
@@ -367,7 +453,7 @@ class SongItemDelegate(QStyledItemDelegate):
             if icon is not None:
                 painter.setPen(QPen(Qt.NoPen))
                 pixmap = icon.pixmap(QSize(height, height))
-                pixmap_y = y + (height - pixmap.height())/2
+                pixmap_y = y + (height - pixmap.height()) // 2
                 painter.drawPixmap(QPoint(x, pixmap_y), pixmap)
                 pixmap_width = pixmap.width()
 
@@ -396,14 +482,22 @@ class CoverArt(QLabel):
     def __init__(self, *args):
         super().__init__(*args)
         self.pixmap = QPixmap(GV.DefaultCoverArt)
+        # The pixmap is only scaled again when it or the size of the widget changes
+        self._scaled = None
+
+    def _scaled_pixmap(self, size):
+        if self._scaled is None or self._scaled[0] != size:
+            self._scaled = (size, self.pixmap.scaled(size, QtCore.Qt.KeepAspectRatio,
+                                                     QtCore.Qt.SmoothTransformation))
+
+        return self._scaled[1]
 
     def paintEvent(self, event):
         try:
             size = self.size()
             painter = QPainter(self)
             point = QPoint(0, 0)
-            scaledPix = self.pixmap.scaled(size, QtCore.Qt.KeepAspectRatio,
-                                           QtCore.Qt.SmoothTransformation)
+            scaledPix = self._scaled_pixmap(size)
 
             point.setX((size.width() - scaledPix.width())/2)
             point.setY((size.height() - scaledPix.height())/2)
@@ -417,6 +511,7 @@ class CoverArt(QLabel):
             img = self.default_image
 
         self.pixmap = QPixmap(img)
+        self._scaled = None
 
         if update:
             self.update()
@@ -424,6 +519,7 @@ class CoverArt(QLabel):
     def change_pixmap_from_data(self, data, update=True):
         self.pixmap = QPixmap()
         self.pixmap.loadFromData(data)
+        self._scaled = None
 
         if update:
             self.update()
@@ -512,32 +608,28 @@ class NowPlaying(QWidget):
 
         index = self.settings.value('index', 0)
         queue_mode = self.settings.value('queue_mode', self.player.IN_ORDER)
-        queue = self.db.get_queue()
-
-        songs = []
-        for idx, item in enumerate(queue):
-            songs.append((Song(item, self.session.downloader, idx)))
+        songs = QueueView(self.db, self.session.downloader)
 
         self.song_queue.current_queue = self.settings.value('queue', GV.MainQueue)
         self.session.queues[self.song_queue.current_queue] = songs
         self.song_queue.load_current_queue()
         self.player.update_queue(self.song_queue.current_queue, index)
 
-        try:
-            item = self.song_queue.item(index)
-        except IndexError:
-            pass
-        else:
-            if item is not None:
-                self.song_queue.scroll_to_item(item)
-                self.song_queue.change_selected(item)
+        if 0 <= index < self.song_queue.count():
+            try:
+                song = self.song_queue.queue_model.song(index)
+            except IndexError:
+                logger.debug('Song at index %s was deleted' % index)
+            else:
+                self.song_queue.scroll_to_row(index)
+                self.song_queue.change_selected(index)
                 logger.debug('Scrolled to index %s' % index)
-                if item.song.cover_art is not None:
-                    self.cover_art.change_pixmap(item.song.cover_art)
+                if song.cover_art is not None:
+                    self.cover_art.change_pixmap(song.cover_art)
 
-                self.media_controls.song_changed(item.song)
-                self.song_info.update_info(item.song)
-                self.player.skip_to(index, item)
+                self.media_controls.song_changed(song)
+                self.song_info.update_info(song)
+                self.player.skip_to(index)
 
         self.song_box = QVBoxLayout()
         self.song_box.addWidget(self.song_queue)
@@ -563,29 +655,24 @@ class NowPlaying(QWidget):
         if index is None:
             return
 
-        item1 = self.player.current
-        item2 = self.song_queue.item(index)
-        if item1 is not None and item1 is item2:
-            item1.song.rating = score
+        current = self.player.current
+        if current is not None and current.index == index:
+            current.song.rating = score
 
     def on_change(self, song, in_list=False, index=0, force_repaint=True):
         logger.debug('start')
         song.set_cover_art()
-        item = None
+        in_list = in_list and 0 <= index < self.song_queue.count()
 
         if in_list:
-            item = self.song_queue.item(index)
-            if item is not None and item != 0:
-                encoding = sys.stdout.encoding or 'utf-8'
-                print(index, song.index, song.title.encode('utf-8').decode(encoding, errors='replace'))
-
-                self.song_queue.change_selected(item)
+            encoding = sys.stdout.encoding or 'utf-8'
+            print(index, song.index, song.title.encode('utf-8').decode(encoding, errors='replace'))
 
-                item.setData(Qt.UserRole, song.duration_formatted)
-                item.setText('{}\r\n{}'.format(*song.get_name_and_author()))
+            self.song_queue.change_selected(index)
+            self.song_queue.queue_model.refresh_row(index)
 
-                self.session.index = index
-                self.settings.setValue('index', index)
+            self.session.index = index
+            self.settings.setValue('index', index)
 
         self.media_controls.song_changed(song)
         self.song_info.update_info(song)
@@ -613,8 +700,8 @@ class NowPlaying(QWidget):
             logger.debug('Updating window')
             self.update()
 
-        # scrollToItem has to be called after self.update() or the program crashes
-        if self.settings.value('scroll_on_change', True) and item is not None:
-            self.song_queue.scrollToItem(item)
+        # scrollTo has to be called after self.update() or the program crashes
+        if self.settings.value('scroll_on_change', True) and in_list:
+            self.song_queue.scroll_to_row(index)
 
         logger.debug('Items added and cover art changed')
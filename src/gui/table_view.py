@@ -1,5 +1,9 @@
-from PyQt5.QtCore import QAbstractTableModel, QVariant, Qt, QTimer, pyqtSlot, pyqtSignal
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, QVariant, Qt, QTimer, pyqtSlot, pyqtSignal
 from PyQt5.QtWidgets import QMessageBox, QTableView, QLineEdit
+from peewee import JOIN
+
+from src.database import FullSong, Artist, Album, AlbumArtist, Genre, flush_dirty
+from src.song import SongBase
 
 
 class Column:
@@ -145,6 +149,255 @@ class SQLAlchemyTableModel(QAbstractTableModel):
         self.refresh()
 
 
+def song_columns(names=None):
+    """
+    Creates the :class:`Column` objects used by :class:`PeeweeTableModel`
+    for songs. The name of the column is the :class:`SongBase` attribute
+    that is set when the cell is edited
+    """
+    columns = [Column('id', FullSong.id, 'id'),
+               Column('title', FullSong.title, 'title', editable=True),
+               Column('artist', Artist.name, 'artist', editable=True),
+               Column('album', Album.name, 'album', editable=True),
+               Column('band', AlbumArtist.name, 'album_artist'),
+               Column('genre', Genre.name, 'genre'),
+               Column('duration', FullSong.duration, 'duration', editable=True),
+               Column('track', FullSong.track, 'track', editable=True),
+               Column('year', FullSong.year, 'year', editable=True),
+               Column('play_count', FullSong.play_count, 'play_count', editable=True),
+               Column('rating', FullSong.rating, 'rating', editable=True)]
+
+    if names is not None:
+        columns = [c for c in columns if c.header in names]
+
+    return columns
+
+
+def song_query(columns):
+    """
+    Base query for :class:`PeeweeTableModel`. Selects only the columns that
+    are shown with the song id always as the first value
+    """
+    return (FullSong
+            .select(FullSong.id, *[c.sql_column for c in columns])
+            .join(Artist, JOIN.LEFT_OUTER, on=(FullSong.artist == Artist.id))
+            .switch(FullSong)
+            .join(Album, JOIN.LEFT_OUTER, on=(FullSong.album == Album.id))
+            .join(AlbumArtist, JOIN.LEFT_OUTER, on=(Album.album_artist == AlbumArtist.id))
+            .switch(FullSong)
+            .join(Genre, JOIN.LEFT_OUTER, on=(FullSong.genre == Genre.id)))
+
+
+class PeeweeTableModel(QAbstractTableModel):
+    """
+    Table model that loads the rows of a peewee query lazily. Rows are
+    fetched in pages when the view scrolls near the end of the loaded rows.
+    Pages are located with keyset pagination on (sort column, song id)
+    so fetching a page costs the same no matter how far the view has
+    been scrolled. Rows are kept as tuples.
+
+    The first row is reserved for the filter widgets like in
+    :class:`SQLAlchemyTableModel`
+    """
+    set_filter = pyqtSignal(str, int, bool)
+
+    def __init__(self, db, columns, query=None, page_size=256):
+        super().__init__()
+
+        self.db = db
+        self.fields = columns
+        self.query = query if query is not None else song_query(columns)
+        self.page_size = page_size
+        self.results = []
+
+        self._exhausted = False
+        self._sort = None
+        self._filters = [Filter(column=i) for i in range(0, self.columnCount())]
+        self.set_filter.connect(self._set_filter)
+
+        self.refresh()
+
+    def headerData(self, col, orientation, role=None):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return QVariant(self.fields[col].header)
+        else:
+            return QVariant()
+
+    def flags(self, index):
+        if index.row() == 0:
+            return Qt.ItemIsEnabled
+
+        _flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+        if self.fields[index.column()].editable:
+            _flags |= Qt.ItemIsEditable
+
+        return _flags
+
+    @pyqtSlot(str, int, bool)
+    def _set_filter(self, keyword, column, refresh=True):
+        if keyword is None or keyword == '':
+            self._filters[column].remove_filter()
+        else:
+            self._filters[column].set_filter(keyword)
+
+        if refresh:
+            self.refresh()
+
+    def rowCount(self, parent=None, **kwargs):
+        return len(self.results) + 1
+
+    def columnCount(self, parent=None, **kwargs):
+        return len(self.fields)
+
+    def _sort_column(self):
+        if self._sort is None:
+            return None, Qt.AscendingOrder
+
+        col, order = self._sort
+        return self.fields[col].sql_column, order
+
+    def _filtered_query(self):
+        q = self.query
+        for filter_ in self._filters:
+            keyword, column = filter_.keyword_and_column()
+            if keyword is None:
+                continue
+
+            column = self.fields[column].sql_column
+            q = q.where(column.contains(keyword))
+
+        return q
+
+    def _after(self, col, order, last):
+        """
+        Condition for the rows that come after the last loaded row.
+        SQLite sorts NULL values first in ascending order and last in
+        descending order
+        """
+        last_id = last[0]
+        if col is None:
+            return FullSong.id > last_id
+
+        value = last[-1]
+        if order == Qt.DescendingOrder:
+            if value is None:
+                return col.is_null() & (FullSong.id < last_id)
+
+            return ((col < value) | ((col == value) & (FullSong.id < last_id)) |
+                    col.is_null())
+
+        if value is None:
+            return (col.is_null() & (FullSong.id > last_id)) | col.is_null(False)
+
+        return (col > value) | ((col == value) & (FullSong.id > last_id))
+
+    def _fetch_page(self):
+        col, order = self._sort_column()
+        q = self._filtered_query()
+
+        if col is None:
+            q = q.order_by(FullSong.id)
+        else:
+            # The sort value is selected last so it can be used as the key of the next page
+            q = q.select_extend(col.alias('_sort_key'))
+            if order == Qt.DescendingOrder:
+                q = q.order_by(col.desc(), FullSong.id.desc())
+            else:
+                q = q.order_by(col, FullSong.id)
+
+        if self.results:
+            q = q.where(self._after(col, order, self.results[-1]))
+
+        # Read with the read only connections so scrolling doesn't wait behind writes
+        rows = self.db.read(q.limit(self.page_size).tuples())
+        if len(rows) < self.page_size:
+            self._exhausted = True
+
+        return rows
+
+    def canFetchMore(self, parent=None):
+        return not self._exhausted
+
+    def fetchMore(self, parent=None):
+        if self._exhausted:
+            return
+
+        rows = self._fetch_page()
+        if not rows:
+            return
+
+        start = len(self.results) + 1
+        self.beginInsertRows(QModelIndex(), start, start + len(rows) - 1)
+        self.results.extend(rows)
+        self.endInsertRows()
+
+    @pyqtSlot()
+    def refresh(self):
+        self.beginResetModel()
+        self.results = []
+        self._exhausted = False
+        self.results = self._fetch_page()
+        self.endResetModel()
+
+    def _row_id(self, row):
+        return self.results[row - 1][0]
+
+    def data(self, index, role=None):
+        if not index.isValid():
+            return QVariant()
+
+        elif role not in (Qt.DisplayRole, Qt.EditRole):
+            return QVariant()
+
+        if index.row() == 0:
+            return ''
+
+        # The first value of the row is the song id
+        return self.results[index.row() - 1][index.column() + 1]
+
+    def _reload_row(self, row):
+        """
+        Replaces a single loaded row with its current values in the database.
+        The row keeps its position until the next refresh
+        """
+        old = self.results[row - 1]
+        q = self.query.where(FullSong.id == old[0])
+        if self._sort is not None:
+            q = q.select_extend(self._sort_column()[0].alias('_sort_key'))
+
+        new = self.db.read(q.limit(1).tuples())
+        if not new:
+            return
+
+        new = new[0]
+
+        self.results[row - 1] = new
+        self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
+
+    def setData(self, index, value, role=None):
+        if index.row() == 0 or role != Qt.EditRole:
+            return False
+
+        name = self.fields[index.column()].name
+
+        try:
+            song = SongBase(FullSong.get_by_id(self._row_id(index.row())))
+            setattr(song, name, value)
+            # The change is in the write-behind buffer until it's flushed
+            flush_dirty(song.song).result()
+        except Exception as e:
+            QMessageBox.critical(None, 'SQL error', str(e))
+            return False
+
+        self._reload_row(index.row())
+        return True
+
+    def sort(self, col, order=None):
+        self._sort = col, order
+        self.refresh()
+
+
 class SongTable(QTableView):
     def __init__(self, model, parent=None):
         super().__init__(parent=parent)
@@ -0,0 +1,478 @@
+import logging
+import os
+import queue
+import threading
+from collections import namedtuple
+
+from src.database import (Dir, FullSong, CoverArt, Artist, AlbumArtist, Album,
+                          Genre, parse_metadata)
+from src.exiftool import ExifTool
+from src.utils import get_supported_formats, b64_to_cover_art, grouper
+
+logger = logging.getLogger('debug')
+
+ImportProgress = namedtuple('ImportProgress', ['done', 'total', 'failed'])
+
+# Columns written for every imported song. insert_many needs every row to
+# have the same keys
+SONG_FIELDS = ('title', 'link', 'file_type', 'folder', 'artist', 'album',
+               'genre', 'track', 'year', 'duration', 'cover_art')
+
+# Columns that are overwritten when an existing song is imported again.
+# Play count, rating and the rest of the user data is kept
+UPDATED_FIELDS = (FullSong.title, FullSong.file_type, FullSong.folder,
+                  FullSong.artist, FullSong.album, FullSong.genre,
+                  FullSong.track, FullSong.year, FullSong.duration,
+                  FullSong.cover_art)
+
+# Max amount of values in a single IN clause
+MAX_VARIABLES = 500
+
+
+class ImportBatch:
+    __slots__ = ['folder', 'files', 'metadata', 'covers']
+
+    def __init__(self, folder, files):
+        self.folder = folder
+        self.files = files
+        self.metadata = []
+        self.covers = {}
+
+
+class ExifToolWorker(threading.Thread):
+    """
+    Reads metadata for batches of files with its own ExifTool -stay_open
+    process. Finished batches are put to the results queue and None is put
+    there when the worker exits.
+    """
+    def __init__(self, tasks, results, **kwargs):
+        super().__init__(**kwargs)
+        self.tasks = tasks
+        self.results = results
+        self._exiftool = ExifTool()
+
+    def _read_batch(self, batch):
+        batch.metadata = self._exiftool.get_metadata(*batch.files) or []
+
+        if batch.folder.cover_art is not None:
+            return batch
+
+        pictures = self._exiftool.get_cover_art(*batch.files) or []
+        for pic in pictures:
+            cover = pic.get('Picture')
+            if cover is None:
+                continue
+
+            try:
+                batch.covers[pic.get('SourceFile')] = b64_to_cover_art(cover)
+            except Exception as e:
+                logger.debug('Could not save cover art of {}. {}'.format(pic.get('SourceFile'), e))
+
+        return batch
+
+    def run(self):
+        self._exiftool.start()
+        try:
+            while True:
+                batch = self.tasks.get()
+                if batch is None:
+                    break
+
+                try:
+                    self._read_batch(batch)
+                except Exception:
+                    logger.exception('Exception while reading metadata of {}'.format(batch.files))
+
+                self.results.put(batch)
+        finally:
+            self._exiftool.terminate()
+            self.results.put(None)
+
+
+class EntityResolver:
+    """
+    Import scoped cache for the ids of artists, album artists, albums,
+    genres and cover art. Existing name -> id maps are loaded once and
+    entities that are not found are inserted in bulk by :func:`flush`,
+    so a batch of songs costs a few statements instead of several
+    get_or_create calls per song.
+
+    Usage:
+        for mt in metadata:
+            resolver.add(mt)
+        resolver.flush()
+        resolver.artists[name]
+    """
+    def __init__(self):
+        self.album_artists = self._load(AlbumArtist, AlbumArtist.name)
+        self.artists = self._load(Artist, Artist.name)
+        self.genres = self._load(Genre, Genre.name)
+        self.covers = self._load(CoverArt, CoverArt.file)
+        self.albums = {}
+        for album_id, name, album_artist in (Album
+                                             .select(Album.id, Album.name, Album.album_artist)
+                                             .order_by(Album.id.desc())
+                                             .tuples()):
+            self.albums[(name, album_artist)] = album_id
+
+        self._album_artists = set()
+        self._artists = set()
+        self._genres = set()
+        self._covers = set()
+        self._albums = set()
+
+    @staticmethod
+    def _load(model, field):
+        # Iterate newest first so duplicate names map to the oldest row
+        return {name: id_ for id_, name in (model
+                                            .select(model.id, field)
+                                            .order_by(model.id.desc())
+                                            .tuples())}
+
+    def add(self, song, cover=None):
+        """
+        Marks the related entities of a song parsed with
+        :func:`src.database.parse_metadata` to be resolved
+        """
+        if song['album_artist'] is not None and song['album_artist'] not in self.album_artists:
+            self._album_artists.add(song['album_artist'])
+
+        if song['album'] is not None:
+            self._albums.add((song['album'], song['album_artist']))
+
+        if song['artist'] is not None and song['artist'] not in self.artists:
+            self._artists.add(song['artist'])
+
+        if song['genre'] is not None and song['genre'] not in self.genres:
+            self._genres.add(song['genre'])
+
+        if cover is not None and cover not in self.covers:
+            self._covers.add(cover)
+
+    @staticmethod
+    def _insert(model, field, values, cache):
+        if not values:
+            return
+
+        new = list(values)
+        values.clear()
+        for idx in range(0, len(new), MAX_VARIABLES):
+            chunk = new[idx:idx + MAX_VARIABLES]
+            model.insert_many([{field.name: v} for v in chunk]).on_conflict_ignore().execute()
+            for id_, name in (model
+                              .select(model.id, field)
+                              .where(field.in_(chunk))
+                              .order_by(model.id.desc())
+                              .tuples()):
+                cache[name] = id_
+
+    def _insert_albums(self):
+        # Album artist names are resolved to ids only after they have been inserted
+        albums = {}
+        for name, band in self._albums:
+            band = self.album_artists.get(band) if band is not None else None
+            if (name, band) not in self.albums:
+                albums[(name, band)] = None
+
+        self._albums.clear()
+        if not albums:
+            return
+
+        albums = list(albums)
+        for idx in range(0, len(albums), 100):
+            Album.insert_many([{'name': name, 'album_artist': band}
+                               for name, band in albums[idx:idx + 100]]).on_conflict_ignore().execute()
+
+        names = list({name for name, band in albums})
+        for idx in range(0, len(names), MAX_VARIABLES):
+            for album_id, name, band in (Album
+                                         .select(Album.id, Album.name, Album.album_artist)
+                                         .where(Album.name.in_(names[idx:idx + MAX_VARIABLES]))
+                                         .order_by(Album.id.desc())
+                                         .tuples()):
+                self.albums[(name, band)] = album_id
+
+    def flush(self):
+        """
+        Inserts all entities added after the last flush. Has to be called
+        inside the same transaction as the songs are inserted
+        """
+        self._insert(AlbumArtist, AlbumArtist.name, self._album_artists, self.album_artists)
+        self._insert_albums()
+        self._insert(Artist, Artist.name, self._artists, self.artists)
+        self._insert(Genre, Genre.name, self._genres, self.genres)
+        self._insert(CoverArt, CoverArt.file, self._covers, self.covers)
+
+    def album(self, name, album_artist):
+        if name is None:
+            return
+
+        if album_artist is not None:
+            album_artist = self.album_artists.get(album_artist)
+
+        return self.albums.get((name, album_artist))
+
+    def to_row(self, song, cover=None):
+        """
+        Converts a song added with :func:`add` to a row that can be
+        inserted after :func:`flush` has been called
+        """
+        row = {field: song.get(field) for field in SONG_FIELDS}
+        row['album'] = self.album(song['album'], song['album_artist'])
+        row['artist'] = self.artists.get(song['artist'])
+        row['genre'] = self.genres.get(song['genre'])
+        row['cover_art'] = self.covers.get(cover)
+        return row
+
+
+class LibraryImporter:
+    """
+    Staged import pipeline. Files are split into batches that are read by
+    several ExifTool processes in parallel and the results are written by
+    the thread iterating :func:`run` with bulk inserts.
+
+    Args:
+        db:
+            :class:`Database` instance the songs are added to
+        workers:
+            How many ExifTool processes are run. Defaults to the cpu count
+        batch_size:
+            How many files are given to ExifTool at once
+        commit_size:
+            How many songs are inserted in a single transaction
+        on_progress:
+            Callable that is called with an :class:`ImportProgress` after
+            every committed transaction
+        update_existing:
+            If True songs that are already in the database are updated with
+            the new metadata. Otherwise they are skipped
+    """
+    def __init__(self, db, workers=None, batch_size=20, commit_size=500,
+                 on_progress=None, update_existing=False):
+        self.db = db
+        self.update_existing = update_existing
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.commit_size = commit_size
+        self.on_progress = on_progress
+        self.formats = get_supported_formats()
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    @staticmethod
+    def walk(directory, subfolders=False):
+        folders = []
+        for root, dirs, files in os.walk(directory):
+            # Only include files and folder that are not hidden -> they don't start with "."
+            folders.append(Dir(root, [f for f in files if not f[0] == '.']))
+            dirs[:] = [d for d in dirs if not d[0] == '.']
+
+            if not subfolders:
+                break
+
+        return folders
+
+    def import_folder(self, directory, subfolders=False):
+        """
+        Walks the directory and imports all supported files in it
+
+        Returns:
+            Iterator of :class:`ImportProgress`
+        """
+        return self.run(self.walk(directory, subfolders))
+
+    def import_files(self, files):
+        """
+        Imports the given files. Cover art files are searched from the
+        folders of the files
+
+        Returns:
+            Iterator of :class:`ImportProgress`
+        """
+        folders = {}
+        for file in files:
+            folder, name = os.path.split(file)
+            if folder not in folders:
+                folders[folder] = Dir(folder, [])
+
+            folders[folder].files.append(name)
+
+        for folder in folders.values():
+            try:
+                folder.find_cover_art(os.listdir(folder.folder))
+            except OSError:
+                pass
+
+        return self.run(list(folders.values()))
+
+    def _batches(self, folders):
+        for folder in folders:
+            for files in grouper(folder.files, self.batch_size):
+                # Remove all the None entries created by grouper and get full filenames
+                files = [os.path.join(folder.folder, f) for f in files if f is not None]
+                yield ImportBatch(folder, files)
+
+    def _feed(self, folders, tasks, cancel):
+        try:
+            for batch in self._batches(folders):
+                if self._stop.is_set() or cancel.is_set():
+                    break
+
+                tasks.put(batch)
+        finally:
+            for _ in range(self.workers):
+                tasks.put(None)
+
+    def _write(self, batches, resolver):
+        songs = []
+        failed = 0
+        for batch in batches:
+            for mt in batch.metadata:
+                try:
+                    song = parse_metadata(mt)
+                except Exception as e:
+                    song = None
+                    logger.debug('Could not add {} because of an error.\n{}'.format(mt.get('SourceFile'), e))
+
+                if song is None:
+                    failed += 1
+                    logger.debug('[Exception] Skipped {}'.format(mt.get('SourceFile')))
+                    continue
+
+                song['folder'] = batch.folder.folder
+                cover = batch.folder.cover_art or batch.covers.get(song['link'])
+                resolver.add(song, cover)
+                songs.append((song, cover))
+
+        # Written by the database writer so the import doesn't contend with
+        # the other writes for the write lock
+        self.db.write(self._insert_songs, songs, resolver)
+        self.db.library_changed()
+        return failed
+
+    def _insert_songs(self, songs, resolver):
+        resolver.flush()
+        rows = [resolver.to_row(song, cover) for song, cover in songs]
+        for idx in range(0, len(rows), 100):
+            query = FullSong.insert_many(rows[idx:idx + 100])
+            if self.update_existing:
+                query = query.on_conflict(conflict_target=[FullSong.link],
+                                          preserve=UPDATED_FIELDS)
+            else:
+                query = query.on_conflict_ignore()
+
+            query.execute()
+
+    def run(self, folders):
+        """
+        Imports the given :class:`Dir` objects
+
+        Returns:
+            Iterator of :class:`ImportProgress`. The import advances only
+            while the iterator is consumed
+        """
+        total = 0
+        for folder in folders:
+            folder.filter_files(self.formats)
+            total += len(folder.files)
+
+        if total == 0:
+            return
+
+        tasks = queue.Queue(maxsize=self.workers * 2)
+        results = queue.Queue(maxsize=self.workers * 4)
+        workers = [ExifToolWorker(tasks, results, daemon=True) for _ in range(self.workers)]
+        for worker in workers:
+            worker.start()
+
+        # Stops the feeder when the import ends early. Not self._stop
+        # since that would stop the next import too
+        cancel = threading.Event()
+        feeder = threading.Thread(target=self._feed, args=(folders, tasks, cancel), daemon=True)
+        feeder.start()
+
+        resolver = EntityResolver()
+        done = 0
+        failed = 0
+        running = len(workers)
+        pending = []
+        pending_songs = 0
+        try:
+            while running > 0:
+                batch = results.get()
+                if batch is None:
+                    running -= 1
+                else:
+                    pending.append(batch)
+                    pending_songs += len(batch.files)
+
+                if pending and (pending_songs >= self.commit_size or running == 0):
+                    try:
+                        failed += self._write(pending, resolver)
+                    except Exception:
+                        logger.exception('Failed to write {} songs'.format(pending_songs))
+                        failed += pending_songs
+                        # The ids the resolver cached in the rolled back
+                        # transaction were never committed
+                        resolver = EntityResolver()
+
+                    done += pending_songs
+                    pending = []
+                    pending_songs = 0
+
+                    progress = ImportProgress(done, total, failed)
+                    if callable(self.on_progress):
+                        self.on_progress(progress)
+
+                    yield progress
+        finally:
+            # Runs also when the iterator is closed or on_progress raises
+            cancel.set()
+            self._shutdown(feeder, workers, tasks, results, running)
+
+    @staticmethod
+    def _drain(q):
+        """
+        Removes everything from the queue
+
+        Returns:
+            How many of the removed items were None
+        """
+        nones = 0
+        while True:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                return nones
+
+            if item is None:
+                nones += 1
+
+    def _shutdown(self, feeder, workers, tasks, results, running):
+        """
+        Stops the feeder and the workers of an import that ended early and
+        waits for them to exit. Unread batches are discarded
+
+        Args:
+            running:
+                How many workers haven't put None to results yet
+        """
+        # The feeder and the workers might be blocked on a full queue
+        while feeder.is_alive():
+            self._drain(tasks)
+            running -= self._drain(results)
+            feeder.join(0.05)
+
+        # The Nones put by the feeder might have been drained
+        self._drain(tasks)
+        for _ in range(running):
+            tasks.put(None)
+
+        while running > 0:
+            if results.get() is None:
+                running -= 1
+
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,197 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+
+import logging
+logger = logging.getLogger('debug')
+
+# Flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o0004000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+
+    return _libc
+
+
+def inotify_available():
+    if not sys.platform.startswith('linux'):
+        return False
+
+    try:
+        return hasattr(_get_libc(), 'inotify_init1')
+    except OSError:
+        return False
+
+
+class WatchLimitReached(OSError):
+    """Raised when fs.inotify.max_user_watches has been exhausted"""
+    pass
+
+
+class InotifyEvent:
+    __slots__ = ['path', 'mask', 'cookie']
+
+    def __init__(self, path, mask, cookie):
+        self.path = path
+        self.mask = mask
+        self.cookie = cookie
+
+    @property
+    def is_dir(self):
+        return bool(self.mask & IN_ISDIR)
+
+    def __repr__(self):
+        return '<InotifyEvent {} {:#x}>'.format(self.path, self.mask)
+
+
+class InotifyWatcher:
+    """
+    Minimal ctypes wrapper around the Linux inotify api
+    """
+    def __init__(self):
+        libc = _get_libc()
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self._watches = {}
+        self._paths = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise WatchLimitReached(err, 'inotify watch limit reached while adding %s' % path)
+
+            raise OSError(err, os.strerror(err), path)
+
+        self._watches[wd] = path
+        self._paths[path] = wd
+        return wd
+
+    def add_tree(self, path, recursive=True):
+        """
+        Watches a folder and all of its non hidden subfolders
+
+        Returns:
+            List of the folders that were added
+        """
+        added = []
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not d[0] == '.']
+            if root in self._paths:
+                continue
+
+            try:
+                self.add_watch(root)
+            except WatchLimitReached:
+                raise
+            except OSError as e:
+                logger.debug('Could not watch {}. {}'.format(root, e))
+                continue
+
+            added.append(root)
+            if not recursive:
+                break
+
+        return added
+
+    def remove_tree(self, path):
+        prefix = os.path.join(path, '')
+        for watched in [p for p in self._paths if p == path or p.startswith(prefix)]:
+            wd = self._paths.pop(watched)
+            self._watches.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """
+        Waits for events for at most timeout seconds
+
+        Returns:
+            List of :class:`InotifyEvent`
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                events.append(InotifyEvent(None, mask, cookie))
+                continue
+
+            folder = self._watches.get(wd)
+            if mask & IN_IGNORED:
+                # The watch was removed because the folder was deleted
+                if folder is not None:
+                    self._watches.pop(wd, None)
+                    self._paths.pop(folder, None)
+                continue
+
+            if folder is None:
+                continue
+
+            path = os.path.join(folder, os.fsdecode(name)) if name else folder
+            events.append(InotifyEvent(path, mask, cookie))
+
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+        self._watches.clear()
+        self._paths.clear()
+
+    @property
+    def watch_count(self):
+        return len(self._watches)
@@ -1,4 +1,5 @@
 import threading
+import time
 import os
 from os.path import join
 import csv
@@ -6,9 +7,12 @@ import pickle
 from src.utils import get_supported_audio_formats, get_supported_formats
 
 from src.database import FullSong
+from src.importer import LibraryImporter
+from src.library_updater.inotify import (InotifyWatcher, WatchLimitReached, inotify_available,
+                                         IN_CREATE, IN_MOVED_TO, IN_MOVED_FROM, IN_DELETE,
+                                         IN_DELETE_SELF, IN_CLOSE_WRITE)
 from src.metadata import update_song, get_file_metadata
 from src.utils import path_leaf
-from src.exiftool import ExifTool
 from src.song import SongBase
 
 import logging
@@ -46,18 +50,107 @@ class DirDump:
         return True
 
 
+class ChangeBatch:
+    """
+    Coalesces file system events into a single update. The batch is ready
+    once no events have come for debounce seconds or max_delay seconds
+    have passed since the first event
+    """
+    def __init__(self, debounce=2.0, max_delay=30.0):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.changed = set()
+        self.deleted = set()
+        self.folders = set()
+        self.deleted_folders = set()
+        self.full_rescan = False
+        self._first = None
+        self._last = None
+
+    def _touch(self):
+        self._last = time.monotonic()
+        if self._first is None:
+            self._first = self._last
+
+    def file_changed(self, path):
+        self.deleted.discard(path)
+        self.changed.add(path)
+        self._touch()
+
+    def file_deleted(self, path):
+        self.changed.discard(path)
+        self.deleted.add(path)
+        self._touch()
+
+    def folder_changed(self, path):
+        self.deleted_folders.discard(path)
+        self.folders.add(path)
+        self._touch()
+
+    def folder_deleted(self, path):
+        self.folders.discard(path)
+        self.deleted_folders.add(path)
+        self._touch()
+
+    def rescan(self):
+        self.full_rescan = True
+        self._touch()
+
+    def ready(self):
+        if self._last is None:
+            return False
+
+        now = time.monotonic()
+        return now - self._last >= self.debounce or now - self._first >= self.max_delay
+
+    def timeout(self):
+        """Seconds until the batch might be ready"""
+        if self._last is None:
+            return None
+
+        return max(0.0, self.debounce - (time.monotonic() - self._last))
+
+    def clear(self):
+        self.changed.clear()
+        self.deleted.clear()
+        self.folders.clear()
+        self.deleted_folders.clear()
+        self.full_rescan = False
+        self._first = None
+        self._last = None
+
+
 class LibraryUpdater(threading.Thread):
-    def __init__(self, session, db, **kwargs):
+    """
+    Keeps the library in sync with the library directories.
+
+    Args:
+        session:
+            The session manager
+        db:
+            :class:`src.database.Database` instance
+        watch:
+            If False the directories are scanned once. Otherwise the thread
+            keeps running and watches the directories with inotify. If
+            inotify isn't available or the watch limit is reached the
+            directories are scanned incrementally every scan_interval seconds
+        scan_interval:
+            Seconds between scans when inotify can't be used
+        debounce:
+            Seconds without new events before changes are applied
+    """
+    def __init__(self, session, db, watch=False, scan_interval=300, debounce=2.0, **kwargs):
         super().__init__(**kwargs)
         self.session = session
         self.db = db
         self.dirdump = DirDump()
         self.dirdump.load_dirs()
         self.formats = get_supported_formats()
-        self._exif = None
         self.stop_ = threading.Event()
-        self.deleted = []
-        self.new = []
+        self._importer = None
+        self.watch = watch
+        self.scan_interval = scan_interval
+        self.debounce = debounce
 
     def check_correct_extension(self, file):
         ext = path_leaf(file).split('.')
@@ -71,32 +164,65 @@ class LibraryUpdater(threading.Thread):
         if ext in self.formats:
             return True
         else:
-            print('Skipping file %s' % file)
+            logger.debug('Skipping file %s' % file)
             return False
 
-    def _updater_loop(self):
-        # Do not call this outside of run
-        for directory in self.dirdump.dirs:
+    def import_files(self, files):
+        """
+        Reads the metadata of new and modified files and adds or updates
+        them in the database
+        """
+        self._importer = LibraryImporter(self.db, update_existing=True)
+        for progress in self._importer.import_files(files):
+            logger.debug('Library update {0.done}/{0.total}'.format(progress))
+
+        self._importer = None
+
+    def update_directory(self, directory, full_scan=False):
+        """
+        Updates the songs of a library directory
+
+        Args:
+            directory:
+                :class:`Dir` that is updated
+            full_scan:
+                If True every folder is listed even if its mtime hasn't
+                changed
+        """
+        index = self.db.get_file_index(directory.directory)
+        folder_index = self.db.get_folder_index(directory.directory)
+        changed, deleted, fingerprints, folders = directory.check_changes(
+            index, self.check_correct_extension,
+            folder_index=None if full_scan else folder_index)
+        logger.debug('{} changed and {} deleted files in {}'.format(len(changed), len(deleted), directory.directory))
+
+        if deleted:
+            self.db.remove_files(deleted)
+
+        if changed and not self.stop_.is_set():
+            self.import_files(changed)
+
             if self.stop_.is_set():
-                break
+                # Folders are listed again on the next scan
+                return
 
-            new_deleted, files = directory.check_changes()
-            new, deleted = new_deleted
-            self.new.append(new)
-            self.deleted.append(deleted)
+            self.db.update_file_index({path: fingerprints[path] for path in changed})
 
-            directory.old = files
+        if not directory.include_subdirs:
+            folder_index = {directory.directory: folder_index.get(directory.directory)}
 
-        self._exif = ExifTool()
-        self._exif.start()
-        for files in self.new:
-            files = list(filter(self.check_correct_extension, files))
+        removed = [path for path in folder_index if path not in folders]
+        self.db.update_folder_index({path: mtime_ns for path, mtime_ns in folders.items()
+                                     if folder_index.get(path) != mtime_ns},
+                                    removed)
 
-            mt = self._exif.get_metadata(*files)
-            mt = list(filter(lambda x: 'audio' in x.get('MIMEType', '') or 'video' in x.get('MIMEType', ''), mt))
-            print(mt)
+    def _updater_loop(self):
+        # Do not call this outside of run
+        for directory in self.dirdump.dirs:
+            if self.stop_.is_set():
+                break
 
-        self._exif.terminate()
+            self.update_directory(directory)
 
     def k(self):
         query = FullSong.select().where(FullSong.file_type == 'file')
@@ -122,44 +248,296 @@ class LibraryUpdater(threading.Thread):
                 update_song(item, exiftool=self._exif)
         """
 
+    def _is_watched_recursively(self, path):
+        for directory in self.dirdump.dirs:
+            if directory.include_subdirs and path.startswith(join(directory.directory, '')):
+                return True
+
+        return False
+
+    def _start_watcher(self):
+        if not inotify_available():
+            logger.info('inotify not available. Falling back to periodic library scans')
+            return
+
+        watcher = None
+        try:
+            watcher = InotifyWatcher()
+            for directory in self.dirdump.dirs:
+                watcher.add_tree(directory.directory, directory.include_subdirs)
+        except OSError as e:
+            logger.info('Could not watch library. Falling back to periodic library scans. %s' % e)
+            if watcher is not None:
+                watcher.close()
+            return
+
+        return watcher
+
+    def _handle_event(self, event, batch, watcher):
+        if event.path is None:
+            # Queue overflowed and events were lost
+            batch.rescan()
+            return
+
+        if path_leaf(event.path)[0] == '.':
+            return
+
+        if event.is_dir or event.mask & IN_DELETE_SELF:
+            if event.mask & (IN_CREATE | IN_MOVED_TO):
+                if self._is_watched_recursively(event.path):
+                    # Raises WatchLimitReached
+                    watcher.add_tree(event.path)
+                    batch.folder_changed(event.path)
+
+            elif event.mask & (IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF):
+                watcher.remove_tree(event.path)
+                batch.folder_deleted(event.path)
+
+            return
+
+        if event.mask & (IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO):
+            if self.check_correct_extension(event.path):
+                batch.file_changed(event.path)
+
+        elif event.mask & (IN_MOVED_FROM | IN_DELETE):
+            batch.file_deleted(event.path)
+
+    def apply_changes(self, batch):
+        """
+        Updates the index and the songs of the paths in a :class:`ChangeBatch`
+        """
+        if batch.full_rescan:
+            self._updater_loop()
+            return
+
+        deleted = set(batch.deleted)
+        removed_folders = []
+        for folder in batch.deleted_folders:
+            deleted.update(self.db.get_file_index(folder))
+            removed_folders.extend(self.db.get_folder_index(folder))
+
+        changed = {}
+        for path in batch.changed:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                deleted.add(path)
+                continue
+
+            changed[path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+        if deleted:
+            self.db.remove_files(deleted)
+
+        if removed_folders:
+            self.db.update_folder_index({}, removed_folders)
+
+        for folder in batch.folders:
+            if self.stop_.is_set():
+                return
+
+            self.update_directory(Dir(folder, include_subdirs=True))
+
+        if changed and not self.stop_.is_set():
+            self.import_files(list(changed))
+            if self.stop_.is_set():
+                return
+
+            self.db.update_file_index(changed)
+
+        # Everything inside these folders is now up to date
+        folders = {}
+        for parent in {os.path.dirname(path) for path in changed.keys() | deleted}:
+            try:
+                folders[parent] = os.stat(parent).st_mtime_ns
+            except OSError:
+                continue
+
+        if folders:
+            self.db.update_folder_index(folders)
+
+    def _watch_loop(self, watcher):
+        batch = ChangeBatch(self.debounce)
+        try:
+            while not self.stop_.is_set():
+                timeout = batch.timeout()
+                timeout = 1.0 if timeout is None else min(timeout, 1.0)
+
+                try:
+                    for event in watcher.read_events(timeout):
+                        self._handle_event(event, batch, watcher)
+                except WatchLimitReached as e:
+                    logger.info('Falling back to periodic library scans. %s' % e)
+                    break
+
+                if batch.ready():
+                    self.apply_changes(batch)
+                    batch.clear()
+            else:
+                return
+        finally:
+            watcher.close()
+
+        # Watching failed. Catch up on the changes and keep scanning
+        self._updater_loop()
+        self._poll_loop()
+
+    def _poll_loop(self):
+        while not self.stop_.wait(self.scan_interval):
+            self._updater_loop()
+
     def run(self):
+        watcher = self._start_watcher() if self.watch else None
+
+        # Watches are added before the first scan so no changes are missed between them
         self._updater_loop()
 
+        if watcher is not None:
+            self._watch_loop(watcher)
+        elif self.watch:
+            self._poll_loop()
+
     def stop(self):
         self.stop_.set()
+        if self._importer is not None:
+            self._importer.stop()
 
 
 class Dir:
-    def __init__(self, directory, include_subdirs=False, old: set=None):
+    def __init__(self, directory, include_subdirs=False):
         self.directory = directory
         self.include_subdirs = include_subdirs
-        self.old = set() if old is None else old
-        self.new = None
 
-    def check_changes(self):
-        current = set()
-        if not os.path.exists(self.directory):
-            return current, self.old, set()
+    @staticmethod
+    def _list_folder(folder, file_filter):
+        """
+        Lists the non hidden files and folders in a folder with os.scandir
 
-        for root, dirs, files in os.walk(self.directory):
-            path = root
-            [current.add(join(path, f)) for f in files if not f[0] == '.']
-            dirs[:] = [d for d in dirs if not d[0] == '.']
+        Returns:
+            tuple of (list of (path, (size, mtime_ns, inode)), list of subfolders)
+        """
+        files = []
+        subfolders = []
+        try:
+            entries = os.scandir(folder)
+        except OSError as e:
+            logger.debug('Could not list {}. {}'.format(folder, e))
+            return files, subfolders
 
-            if not self.include_subdirs:
-                break
+        with entries:
+            for entry in entries:
+                if entry.name[0] == '.':
+                    continue
 
-        return self.compare_sets(current, self.old), current
+                try:
+                    if entry.is_dir():
+                        subfolders.append(entry.path)
+                        continue
 
-    @staticmethod
-    def compare_sets(current: set, old: set):
-        deleted = old.difference(current)
-        added = current.difference(old)
+                    if file_filter is not None and not file_filter(entry.path):
+                        continue
+
+                    stat = entry.stat()
+                    files.append((entry.path, (stat.st_size, stat.st_mtime_ns, entry.inode())))
+                except OSError as e:
+                    logger.debug('Could not stat {}. {}'.format(entry.path, e))
+
+        return files, subfolders
+
+    def check_changes(self, index, file_filter=None, folder_index=None):
+        """
+        Compares the files in the directory to the file index.
+        Folders whose mtime is the same as in folder_index aren't listed
+        because no files have been added, removed or renamed in them. Only
+        their indexed files are stat'd to find files modified in place and
+        their indexed subfolders are still checked. Pass no folder_index to
+        list every folder.
+
+        Args:
+            index:
+                dict of path -> (size, mtime_ns, inode) of the files that
+                were found the last time
+            file_filter:
+                Callable that is called with the path of the file. If it
+                returns False the file is skipped
+            folder_index:
+                dict of path -> mtime_ns of the folders that were listed
+                the last time
+
+        Returns:
+            tuple of (new and modified paths, deleted paths, dict of
+            path -> fingerprint for all current files, dict of
+            path -> mtime_ns for all current folders)
+        """
+        if not os.path.exists(self.directory):
+            # Don't remove the files of a directory that might just be unmounted
+            return [], [], {}, {}
+
+        folder_index = folder_index or {}
+        indexed_files = {}
+        indexed_folders = {}
+        if folder_index:
+            for path in index:
+                indexed_files.setdefault(os.path.dirname(path), []).append(path)
+
+            for path in folder_index:
+                indexed_folders.setdefault(os.path.dirname(path), []).append(path)
+
+        current = {}
+        changed = []
+        folders = {}
+        stack = [self.directory]
+        while stack:
+            folder = stack.pop()
+            try:
+                # Stat before listing so changes made during the listing are seen next time
+                mtime_ns = os.stat(folder).st_mtime_ns
+            except OSError as e:
+                logger.debug('Could not stat {}. {}'.format(folder, e))
+                continue
+
+            folders[folder] = mtime_ns
+            if folder_index.get(folder) == mtime_ns:
+                # Editing tags in place doesn't change the folder mtime so
+                # the indexed files are still stat'd
+                for path in indexed_files.get(folder, ()):
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+
+                    fingerprint = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                    current[path] = fingerprint
+                    if index[path] != fingerprint:
+                        changed.append(path)
+
+                if self.include_subdirs:
+                    stack.extend(indexed_folders.get(folder, ()))
+
+                continue
+
+            files, subfolders = self._list_folder(folder, file_filter)
+            for path, fingerprint in files:
+                current[path] = fingerprint
+                if index.get(path) != fingerprint:
+                    changed.append(path)
+
+            if self.include_subdirs:
+                stack.extend(subfolders)
+
+        if self.include_subdirs:
+            deleted = [path for path in index if path not in current]
+        else:
+            deleted = [path for path in index if path not in current and
+                       os.path.dirname(path) == self.directory]
 
-        return added, deleted
+        return changed, deleted, current, folders
 
     def __getstate__(self):
-        return self.__dict__
+        return {'directory': self.directory,
+                'include_subdirs': self.include_subdirs}
 
     def __setstate__(self, d):
-        self.__dict__ = d
+        # Older versions pickled the set of every file in the directory
+        self.directory = d['directory']
+        self.include_subdirs = d.get('include_subdirs', False)
@@ -0,0 +1,151 @@
+"""
+Schema migrations for the song database.
+
+The schema version is stored in PRAGMA user_version. Every function in
+MIGRATIONS upgrades the schema by one version and is run only once.
+New migrations are appended to the end of the list.
+"""
+import logging
+
+logger = logging.getLogger('debug')
+
+# Entity tables whose names are made unique and the columns that reference them
+ENTITY_REFERENCES = {
+    'artist': ('name', [('songs', 'artist_id'), ('temporary_songs', 'artist_id')]),
+    'albumartist': ('name', [('albums', 'album_artist_id'),
+                             ('temporary_songs', 'album_artist_id')]),
+    'genres': ('name', [('songs', 'genre_id'), ('temporary_songs', 'genre_id')]),
+    'composers': ('name', [('songs', 'composer_id'), ('temporary_songs', 'composer_id')]),
+    'coverart': ('file', [('songs', 'cover_art_id'), ('temporary_songs', 'cover_art_id')]),
+}
+
+
+def _merge_duplicates(db, table, keys, references):
+    """
+    Points all references of duplicate rows to the oldest row with the
+    same keys and deletes the duplicates
+    """
+    db.execute_sql('CREATE TEMP TABLE _merged (old INTEGER PRIMARY KEY, new INTEGER)')
+    try:
+        db.execute_sql("""INSERT INTO _merged
+                          SELECT id, new FROM
+                          (SELECT id, MIN(id) OVER (PARTITION BY {keys}) AS new FROM {table})
+                          WHERE id != new""".format(table=table, keys=', '.join(keys)))
+        for ref_table, column in references:
+            db.execute_sql("""UPDATE {t} SET {c} = (SELECT new FROM _merged WHERE old = {t}.{c})
+                              WHERE {c} IN (SELECT old FROM _merged)""".format(t=ref_table, c=column))
+
+        db.execute_sql('DELETE FROM {} WHERE id IN (SELECT old FROM _merged)'.format(table))
+    finally:
+        db.execute_sql('DROP TABLE _merged')
+
+
+def _merge_duplicate_links(db, table, left, right):
+    db.execute_sql("""DELETE FROM {t} WHERE id NOT IN
+                      (SELECT MIN(id) FROM {t} GROUP BY {l}, {r})""".format(t=table, l=left, r=right))
+
+
+def add_indexes(db):
+    """
+    Indexes for the queue order, playlist and tag lookups and unique
+    names for artists, album artists, albums, genres, composers and cover art
+    """
+    db.execute_sql('CREATE INDEX IF NOT EXISTS queuesong_sort_order_id '
+                   'ON queuesong (sort_order, id)')
+
+    # peewee creates these for new databases. Older databases might not have them
+    _merge_duplicate_links(db, 'tag_songs_through', 'tag_id', 'fullsong_id')
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS tagfullsongthrough_tag_id_fullsong_id '
+                   'ON tag_songs_through (tag_id, fullsong_id)')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS tagfullsongthrough_fullsong_id '
+                   'ON tag_songs_through (fullsong_id)')
+    _merge_duplicate_links(db, 'playlist_songs_through', 'playlist_id', 'fullsong_id')
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS playlistfullsongthrough_playlist_id_fullsong_id '
+                   'ON playlist_songs_through (playlist_id, fullsong_id)')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS playlistfullsongthrough_fullsong_id '
+                   'ON playlist_songs_through (fullsong_id)')
+
+    # Album artists are merged first because albums are identified by
+    # both the name and the album artist
+    for table, (key, references) in ENTITY_REFERENCES.items():
+        _merge_duplicates(db, table, [key], references)
+        db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS {0}_{1}_unique ON {0} ({1})'.format(table, key))
+
+    # NULL values are never equal in unique indexes so albums without an
+    # album artist are indexed with 0 instead
+    _merge_duplicates(db, 'albums', ['name', 'album_artist_id'],
+                      [('songs', 'album_id'), ('temporary_songs', 'album_id')])
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS albums_name_album_artist_unique '
+                   'ON albums (name, IFNULL(album_artist_id, 0))')
+
+    db.execute_sql('ANALYZE')
+
+
+def add_play_count_index(db):
+    """
+    Index used by :class:`src.autodj.AutoDJ` to seek to a random song
+    with a given play count and rating
+    """
+    db.execute_sql('CREATE INDEX IF NOT EXISTS songs_play_count_rating_id '
+                   'ON songs (play_count, rating, id)')
+    db.execute_sql('ANALYZE songs')
+
+
+def _add_column(db, table, column, definition):
+    # New databases are created with the column already in them
+    columns = [row[1] for row in db.execute_sql('PRAGMA table_info(%s)' % table)]
+    if column not in columns:
+        db.execute_sql('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, definition))
+
+
+def add_trim_columns(db):
+    """
+    Columns where the player caches the positions of the silence at
+    the start and end of songs
+    """
+    _add_column(db, 'songs', 'trim_start', 'REAL')
+    _add_column(db, 'songs', 'trim_end', 'REAL')
+
+
+def add_trim_threshold_column(db):
+    """
+    Silence threshold the cached trim positions were found with so
+    they are scanned again when the threshold is changed
+    """
+    _add_column(db, 'songs', 'trim_threshold', 'REAL')
+
+
+MIGRATIONS = [add_indexes, add_play_count_index, add_trim_columns, add_trim_threshold_column]
+
+
+def get_version(db):
+    return db.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(db):
+    """
+    Runs the migrations that haven't been run on the database yet.
+    Each migration is run in its own transaction.
+
+    Returns:
+        True if any migrations were run
+    """
+    version = get_version(db)
+    if version >= len(MIGRATIONS):
+        return False
+
+    for idx, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info('Migrating database to version {} with {}'.format(idx, migration.__name__))
+        with db.atomic():
+            migration(db)
+            db.execute_sql('PRAGMA user_version = %d' % idx)
+
+    return True
+
+
+def optimize(db):
+    """
+    Updates the query planner statistics of the tables that need it.
+    Cheap enough to be run every time the database is opened
+    """
+    db.execute_sql('PRAGMA optimize')
@@ -0,0 +1,277 @@
+import hashlib
+import logging
+import mmap
+import os
+
+from src.cache import Cache
+
+logger = logging.getLogger('debug')
+
+EXTENSION = '.pcm'
+# Songs whose decoded length differs from their duration by more than
+# this many seconds were cut short and aren't cached
+DURATION_TOLERANCE = 2
+
+
+def cache_key(song, samplerate, channels=2):
+    """
+    Returns:
+        Name of the cache entry of the song decoded with the given settings.
+        Files include their size and modification time so edited files
+        are decoded again
+    """
+    parts = [song.link, str(samplerate), str(channels), song.ffmpeg.filters]
+    if song.is_file:
+        try:
+            stat = os.stat(song.file)
+        except OSError:
+            return None
+
+        parts += [str(stat.st_size), str(stat.st_mtime_ns)]
+
+    return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+class MappedReader:
+    """
+    File like object that reads decoded audio from a memory mapped cache
+    file. Reads return memoryviews of the mapping so nothing is copied
+    until the audio is written to the output.
+    Has to be closed since a mapped file can't be deleted on Windows
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._view = memoryview(self._map)
+        self.size = len(self._map)
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._map is None
+
+    def read(self, size):
+        view = self._view
+        if view is None:
+            return b''
+
+        start = self.position
+        self.position = min(start + size, self.size)
+        try:
+            return view[start:self.position]
+        except ValueError:
+            # Closed by another thread
+            return b''
+
+    def seek(self, offset):
+        self.position = max(min(offset, self.size), 0)
+
+    def close(self):
+        """Unmaps the file. Data returned by read can't be used after this"""
+        view, mapping = self._view, self._map
+        self._view = self._map = None
+        if mapping is None:
+            return
+
+        view.release()
+        try:
+            mapping.close()
+        except BufferError:
+            # Something still references data that was read. The mapping
+            # is closed when that is garbage collected
+            logger.debug('Cached song closed while its data is in use')
+
+
+class CacheWriter:
+    """
+    Reads the output of a decoder and writes a copy of it to the cache.
+    The copy is added to the cache when the decoder exits successfully
+    after writing the whole song. Otherwise it's discarded
+
+    Args:
+        cache:
+            :class:`PCMCache` the copy is added to
+        key:
+            Name of the cache entry
+        process:
+            The decoder process
+        expected_size:
+            Size of the decoded song in bytes or None if it's not known
+    """
+    def __init__(self, cache, key, process, expected_size=None):
+        self.cache = cache
+        self.key = key
+        self.process = process
+        self.pipe = process.stdout
+        self.expected_size = expected_size
+        self.path = cache.tmp_path(key)
+        self._file = open(self.path, 'wb')
+        self.size = 0
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def read(self, size):
+        data = self.pipe.read(size)
+        if self._file is None:
+            return data
+
+        if data:
+            try:
+                self._file.write(data)
+                self.size += len(data)
+                if self.size > self.cache.max_entry_size:
+                    logger.debug('Song %s too large for the PCM cache' % self.key)
+                    self.close()
+            except OSError:
+                logger.exception('Could not write to the PCM cache')
+                self.close()
+        else:
+            self._finish()
+
+        return data
+
+    def drain(self):
+        """Reads the rest of the decoder output to the cache"""
+        while not self.closed:
+            if not self.read(self.cache.bytes_per_second):
+                break
+
+    def _finish(self):
+        try:
+            returncode = self.process.wait(timeout=5)
+        except Exception:
+            returncode = None
+
+        complete = returncode == 0 and self.size > 0
+        if complete and self.expected_size is not None:
+            complete = abs(self.size - self.expected_size) <= self.cache.tolerance
+
+        if not complete:
+            self.close()
+            return
+
+        self._file.close()
+        self._file = None
+        self.cache.add(self.key, self.path)
+
+    def close(self):
+        """Discards the copy if it hasn't been added to the cache"""
+        f = self._file
+        self._file = None
+        if f is None:
+            return
+
+        f.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class PCMCache:
+    """
+    Cache of decoded songs stored as raw s16le files. Played songs are
+    decoded to the cache while they're played and replays are read from
+    it with mmap so they don't start a decoder at all.
+    The least recently played songs are deleted when the cache grows
+    over max_size.
+
+    Args:
+        folder:
+            Folder of the cache files
+        max_size:
+            Size budget of the cache in bytes
+        bytes_per_second:
+            Size of one second of the decoded audio
+    """
+    def __init__(self, folder, max_size, bytes_per_second=44100 * 4):
+        self.folder = folder
+        # Songs being decoded are written here and moved to folder when complete
+        self.tmp_folder = os.path.join(folder, 'tmp')
+        # One song can't push out most of the cache
+        self.max_entry_size = max_size // 4
+        self.bytes_per_second = bytes_per_second
+        self.tolerance = DURATION_TOLERANCE * bytes_per_second
+
+        if not os.path.isdir(self.tmp_folder):
+            os.makedirs(self.tmp_folder)
+
+        # Left over from songs that were playing when the player closed
+        for entry in os.scandir(self.tmp_folder):
+            self._remove(entry.path)
+
+        self.files = Cache(folder, max_size)
+
+    def path(self, key):
+        return os.path.join(self.folder, key + EXTENSION)
+
+    def tmp_path(self, key):
+        return os.path.join(self.tmp_folder, key + EXTENSION)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            logger.debug('Could not delete %s' % path)
+
+    def get(self, key):
+        """
+        Returns:
+            :class:`MappedReader` of the cached song or None if it's not cached
+        """
+        if key is None:
+            return None
+
+        path = self.path(key)
+        if not self.files.touch(path):
+            return None
+
+        try:
+            return MappedReader(path)
+        except (OSError, ValueError):
+            logger.exception('Could not open cached song %s' % key)
+            self.files.remove_file(path)
+            return None
+
+    def writer(self, key, process, duration=None):
+        """
+        Returns:
+            :class:`CacheWriter` that copies the output of the decoder
+            to the cache or None if the song shouldn't be cached
+        """
+        if key is None:
+            return None
+
+        expected_size = None
+        if duration:
+            expected_size = int(duration * self.bytes_per_second)
+            if expected_size > self.max_entry_size:
+                return None
+
+        try:
+            return CacheWriter(self, key, process, expected_size)
+        except OSError:
+            logger.exception('Could not create PCM cache file')
+            return None
+
+    def add(self, key, tmp_path):
+        path = self.path(key)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception('Could not add %s to the PCM cache' % key)
+            self._remove(tmp_path)
+            return
+
+        self.files.add_file(path)
+        logger.debug('Added %s to the PCM cache' % key)
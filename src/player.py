@@ -1,4 +1,3 @@
-import audioop
 import logging
 import os
 import shlex
@@ -11,10 +10,15 @@ from collections import deque
 
 import pyaudio
 
+from src.audio_output import CallbackOutput
 from src.downloader import DownloaderPool
+from src.dsp import (Crossfade, Volume, FRAME_WIDTH, leading_silence, trailing_silence,
+                     dbfs_to_amplitude)
 from src.globals import GV
+from src.pcm_cache import PCMCache, MappedReader, cache_key
 from src.queues import LockedQueue
-from src.song import Song
+from src.seek_index import SeekIndex
+from src.song import Song, PA
 from src.utils import print_info, get_duration
 
 logger = logging.getLogger('debug')
@@ -24,6 +28,23 @@ FORMAT = pyaudio.paInt16
 CHANNELS = 2
 WIDTH = 4
 
+# GUIPlayer decodes every song to this rate so consecutive songs are
+# written to the same output stream without reopening it
+OUTPUT_RATE = 44100
+# How many seconds before the end of a song the next song starts decoding
+PREROLL_LEAD = 10
+# How many seconds of the next song are decoded before it starts
+PREROLL_SECONDS = 3
+# Samples quieter than this many dBFS are silence when trimming the start and end of songs
+SILENCE_THRESHOLD = -56
+# Chunks are written to the stream in this many parts so volume changes
+# take effect sooner
+WRITE_PARTS = 4
+# Seconds of decoded audio kept in memory for seeking without restarting ffmpeg
+SEEK_WINDOW = 30
+# Default size of the decoded audio cache in megabytes
+PCM_CACHE_SIZE = 1024
+
 
 def get_columns():
     try:
@@ -42,25 +63,130 @@ class Deque(deque):
         return len(self) == self.maxlen
 
 
+class PCMWindow:
+    """
+    The latest decoded audio of a song. Seeks inside the window are
+    served from memory instead of restarting the decoder
+
+    Args:
+        max_size:
+            How many bytes are kept
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._chunks = deque()
+        self.start = 0
+        self.size = 0
+
+    @property
+    def end(self):
+        return self.start + self.size
+
+    def append(self, offset, data):
+        """
+        Adds a chunk that starts from offset. If offset isn't where the
+        window ends the old data is dropped
+        """
+        if offset != self.end or not self._chunks:
+            self.clear()
+            self.start = offset
+
+        self._chunks.append(data)
+        self.size += len(data)
+        while self.size - len(self._chunks[0]) >= self.max_size:
+            removed = self._chunks.popleft()
+            self.start += len(removed)
+            self.size -= len(removed)
+
+    def read_from(self, offset):
+        """
+        Returns:
+            list of the chunks from offset to the end of the window or
+            None if offset is outside of the window
+        """
+        if not self.start <= offset < self.end:
+            return None
+
+        chunks = []
+        position = self.start
+        for chunk in self._chunks:
+            if position + len(chunk) > offset:
+                chunks.append(chunk[max(offset - position, 0):])
+            position += len(chunk)
+
+        return chunks
+
+    def clear(self):
+        self._chunks.clear()
+        self.size = 0
+
+
 class StreamPlayer(threading.Thread):
     def __init__(self, buff, stream, rate, volume=1.0, after=None, on_write_frame=None,
                  remove_start_silence=False, remove_end_silence=False, on_pause=None,
-                 on_resume=None, **kwargs):
+                 on_resume=None, position=0, trim=None, on_trim=None,
+                 silence_threshold=SILENCE_THRESHOLD, seek_window=SEEK_WINDOW, **kwargs):
+        """
+        Args:
+            position:
+                The second of the song buff starts from
+            trim:
+                tuple of the seconds where the sound of the song starts and
+                ends. Either can be None. Known values are used instead of
+                scanning for silence
+            on_trim:
+                Called with the start and end seconds of the sound when
+                either is found by scanning. The value not found is None
+            silence_threshold:
+                dBFS under which the audio is silence when trimming
+            seek_window:
+                Seconds of the latest decoded audio kept for seeking
+        """
 
         super().__init__(**kwargs)
         self.buff = buff
         self.rate = rate
         self._audio_buffer = Deque(maxlen=10)
-        self._volume = volume
+        self._volume = Volume(volume, rate)
         self._resume = threading.Event()
         self._resume.set()
         self._stream_finished = threading.Event()
         self._end = threading.Event()
         self.seeking = threading.Event()
+        # Set when no seek is in progress. Waiting on seeking itself would
+        # return immediately while seeking is set
+        self._seek_done = threading.Event()
+        self._seek_done.set()
+        # Held while reading from buff so seeking can't swap it in the middle of a read
+        self._read_lock = threading.Lock()
+        self._seeks = 0
         self.stream = stream
+        # Callback outputs do their own volume, pausing and buffering
+        self._callback_output = isinstance(stream, CallbackOutput)
+        # Writes of this stream are dropped once the output is flushed
+        self._generation = None
+        if self._callback_output:
+            stream.volume = volume
+            self._generation = stream.generation
         self.after = after
-        self._loops = 0
-        self._bytes_per_second = self.rate * (16 / 8) * CHANNELS
+        self._bytes_per_second = self.rate * FRAME_WIDTH
+        # Offsets in bytes from the start of the song. _position is the part
+        # that has been played or trimmed and _read_position the part read from buff
+        self._position = self._read_position = self._start = self._to_bytes(position)
+        start, end = trim or (None, None)
+        self._sound_start = None if start is None else self._to_bytes(start)
+        self._sound_end = None if end is None else self._to_bytes(end)
+        self.on_trim = on_trim
+        self._silence = dbfs_to_amplitude(silence_threshold)
+        self._window = PCMWindow(self._to_bytes(seek_window))
+        # Cached songs are seeked by moving in the mapped file
+        self._mapped = buff if isinstance(buff, MappedReader) else None
+        # Closed when the stream ends. The reader of a song that started
+        # during a crossfade is wrapped in a FadeInReader
+        reader = buff.reader if isinstance(buff, FadeInReader) else buff
+        self._cached_reader = reader if isinstance(reader, MappedReader) else None
+        self.crossfade = None
+        self._incoming = None
         self.remove_start_silence = remove_start_silence
         self.remove_end_silence = remove_end_silence
         self.on_pause = on_pause
@@ -71,52 +197,129 @@ class StreamPlayer(threading.Thread):
         else:
             self._on_write = None
 
+    def _to_bytes(self, seconds):
+        return int(round(seconds * self.rate)) * FRAME_WIDTH
+
+    def _read(self):
+        size = self.rate
+        if self.remove_end_silence and self._sound_end is not None:
+            # The silence at the end is never read
+            size = min(size, max(self._sound_end - self._read_position, 0))
+            if not size:
+                return b''
+
+        offset = self._read_position
+        d = self.buff.read(size)
+        self._read_position += len(d)
+        # Data replayed from the window after seeking is already in it
+        if d and self._mapped is None and offset >= self._window.end:
+            self._window.append(offset, d)
+
+        return d
+
     def _buffer_next(self):
-        if not self._stream_finished.is_set() and not self._audio_buffer.full() and not self.seeking.is_set():
-            d = self.buff.read(self.rate)
+        with self._read_lock:
+            if self._stream_finished.is_set() or self._audio_buffer.full() or self.seeking.is_set():
+                return
+
+            d = self._read()
 
             if len(d) > 0:
                 self._audio_buffer.append(d)
             else:
-                if self.remove_end_silence:
-                    removed = 0
-                    buffer = list(self._audio_buffer)
-                    buffer.reverse()
-                    for data in buffer:
-                        rms = audioop.rms(data, 2)
-                        if rms <= 50:
-                            removed += 1
-                            self._audio_buffer.pop()
-                            self._loops += 1
-                        else:
-                            break
-
-                    logger.debug('Removed %s loops' % removed)
+                # The pipe of the previous decoder closes when seeking
+                if self.remove_end_silence and self._sound_end is None and not self.seeking.is_set():
+                    self._trim_end()
 
                 self._stream_finished.set()
 
+    def _report_trim(self, start=None, end=None):
+        if callable(self.on_trim):
+            self.on_trim(None if start is None else start / self.bytes_per_second,
+                         None if end is None else end / self.bytes_per_second)
+
+    def _trim_end(self):
+        """Removes the silent frames from the end of the buffered audio"""
+        removed = 0
+        while self._audio_buffer:
+            data = self._audio_buffer.pop()
+            silent = trailing_silence(data, self._silence) * FRAME_WIDTH
+            removed += silent
+            if silent < len(data):
+                self._audio_buffer.append(data[:len(data) - silent])
+                break
+
+        self._position += removed
+        self._sound_end = self._read_position - removed
+        logger.debug('Removed %s bytes of silence from the end' % removed)
+        self._report_trim(end=self._sound_end)
+
+    def _skip_start(self):
+        """Skips to the known start of the sound without scanning it"""
+        skip = self._sound_start - self._read_position
+        while skip > 0 and not self._end.is_set():
+            d = self.buff.read(min(skip, self.rate))
+            if not d:
+                self._stream_finished.set()
+                break
+
+            skip -= len(d)
+            self._read_position += len(d)
+
+        self._position = self._read_position
+
+    def _trim_start(self):
+        """Drops the silent frames from the start of the stream"""
+        if self._sound_start is not None:
+            self._skip_start()
+            return
+
+        start = self._read_position
+        while not self._end.is_set():
+            d = self._read()
+            if len(d) == 0:
+                self._stream_finished.set()
+                break
+
+            silent = leading_silence(d, self._silence) * FRAME_WIDTH
+            if silent < len(d):
+                self._audio_buffer.append(d[silent:])
+                self._position = self._read_position - len(d) + silent
+                break
+
+        logger.debug('Removed %s bytes of silence from the start' % (self._position - start))
+        if start == 0 and not self._end.is_set() and not self._stream_finished.is_set():
+            self._sound_start = self._position
+            self._report_trim(start=self._sound_start)
+
+    def _write(self, data, generation=None):
+        if self._callback_output:
+            self.stream.write(data, generation)
+            return
+
+        seeks = self._seeks
+        part = max(len(data) // WRITE_PARTS // FRAME_WIDTH, 1) * FRAME_WIDTH
+        for idx in range(0, len(data), part):
+            if seeks != self._seeks:
+                break
+
+            self.stream.write(self._volume.apply(data[idx:idx + part]))
+
     def _start_playing(self):
-        if self.remove_start_silence:
-            # Drop all data that is silent
-            while not self._end.is_set():
-                d = self.buff.read(self.rate)
-                if len(d) > 0:
-                    rms = audioop.rms(d, 2)
-                    # 50 is the silence detection sensitivity.
-                    if rms > 50:
-                        self._audio_buffer.append(d)
-                        break
-                    self._loops += 1
-                else:
-                    self._stream_finished.set()
-                    break
+        if self._callback_output:
+            # The output stays paused if the previous song was stopped while paused
+            self.stream.resume()
 
-            logger.debug('Removed %s loops from start' % self._loops)
+        if self.remove_start_silence:
+            self._trim_start()
 
         while not self._end.is_set():
 
             if self.seeking.is_set():
-                self.seeking.wait()
+                self._seek_done.wait()
+
+            generation = self._generation
+            seeks = self._seeks
 
             if not self._resume.is_set():
                 while self.can_buffer:
@@ -128,7 +331,7 @@ class StreamPlayer(threading.Thread):
                 continue
 
             if self.seeking.is_set():
-                self.seeking.wait()
+                self._seek_done.wait()
 
             if self._audio_buffer:
                 data = self._audio_buffer.popleft()
@@ -139,10 +342,15 @@ class StreamPlayer(threading.Thread):
                     continue
 
                 if self._stream_finished.is_set():
-                    self.stop()
+                    self.stop(flush=False)
                     break
 
-                data = self.buff.read(self.rate)
+                with self._read_lock:
+                    if self.seeking.is_set():
+                        continue
+
+                    data = self._read()
+
                 while not self._audio_buffer.full() and not self._stream_finished.is_set():
                     self._buffer_next()
 
@@ -150,14 +358,23 @@ class StreamPlayer(threading.Thread):
                 if self.seeking.is_set():
                     continue
 
-                self.stop()
+                self.stop(flush=False)
                 break
 
-            if self._volume != 1.0:
-                data = audioop.mul(data, 2, self._volume)
+            if seeks != self._seeks:
+                # Read before the seek
+                continue
+
+            size = len(data)
+            if self.crossfade is not None:
+                data = self.crossfade.mix(data, self._incoming.read(size))
 
-            self.stream.write(data)
-            self._loops += 1
+            self._write(data, generation)
+            if seeks != self._seeks:
+                # The position was set by the seek
+                continue
+
+            self._position += size
             if self._on_write:
                     self._on_write(self)
 
@@ -171,22 +388,89 @@ class StreamPlayer(threading.Thread):
         except:
             logger.exception('Exception in stream player')
             self.stop()
+        finally:
+            self._close_cached_reader()
+
+    def _close_cached_reader(self):
+        if self._cached_reader is None:
+            return
+
+        with self._read_lock:
+            # The buffered data are views of the mapped file
+            self._audio_buffer.clear()
+            self._cached_reader.close()
+
+    def start_crossfade(self, crossfade, incoming):
+        """
+        Mixes the rest of this stream with the start of the next song
+
+        Args:
+            crossfade:
+                :class:`src.dsp.Crossfade` used for mixing
+            incoming:
+                File like object of the next song
+        """
+        self._incoming = incoming
+        self.crossfade = crossfade
 
     def seek(self, seconds, ffmpeg):
+        """
+        Seeks inside the cached song or the decoded audio in memory if
+        possible. Otherwise ffmpeg is restarted from the position
+        """
+        self._seek_done.clear()
         self.seeking.set()
-        self._audio_buffer.clear()
-        self._stream_finished.clear()
-        self._end.clear()
-        self._loops = seconds * self.bytes_per_second / self.rate
-        self.buff = ffmpeg.seek(seconds).stdout
+        self._seeks += 1
+        self.crossfade = None
+        if self._callback_output:
+            self._generation = self.stream.flush()
+
+        target = self._to_bytes(seconds)
+        in_window = self._window.start <= target < self._window.end
+        if not in_window and self._mapped is None:
+            # Makes a read blocked on the old pipe return
+            ffmpeg.kill()
+
+        with self._read_lock:
+            self._audio_buffer.clear()
+            self._stream_finished.clear()
+            self._end.clear()
+
+            chunks = self._window.read_from(target) if in_window else None
+            if self._mapped is not None:
+                self._mapped.seek(target)
+                self.buff = self._mapped
+            elif chunks is not None:
+                # The decoder continues from the end of the window
+                buff = self.buff
+                if isinstance(buff, ChainedReader) and not buff.buffered:
+                    buff = buff.pipe
+
+                self.buff = ChainedReader(chunks, buff)
+                logger.debug('Seeked to %s from memory' % seconds)
+            else:
+                self._window.clear()
+                self.buff = ffmpeg.seek(seconds).stdout
+
+            self._position = self._read_position = self._start = target
+
         self.seeking.clear()
+        self._seek_done.set()
 
     @property
     def bytes_per_second(self):
         return self._bytes_per_second
 
+    @property
+    def finished(self):
+        """True when the whole song was read"""
+        return self._stream_finished.is_set() and not self.seeking.is_set()
+
     def pause(self):
         self._resume.clear()
+        if self._callback_output:
+            self.stream.pause()
+
         if self.on_pause:
             self.on_pause(self)
 
@@ -200,31 +484,207 @@ class StreamPlayer(threading.Thread):
 
     def resume(self):
         self._resume.set()
+        if self._callback_output:
+            self.stream.resume()
+
         if self.on_resume:
             self.on_resume(self)
 
     @property
     def volume(self):
-        return self._volume
+        if self._callback_output:
+            return self.stream.volume
+
+        return self._volume.gain
 
     @volume.setter
     def volume(self, value):
-        self._volume = value
+        if self._callback_output:
+            self.stream.volume = value
+        else:
+            self._volume.gain = value
 
     @property
     def loops(self):
-        return self._loops
+        return self._position / self.rate
+
+    @property
+    def position(self):
+        """Bytes of the song that have been played or trimmed"""
+        if self._callback_output:
+            # The audio in the buffer hasn't been heard yet
+            return max(self._position - self.stream.buffered, self._start)
+
+        return self._position
 
     @property
     def duration(self):
-        return self._loops * self.rate / self.bytes_per_second
+        return self.position / self.bytes_per_second
 
-    def stop(self):
+    def stop(self, flush=True):
+        """
+        Args:
+            flush:
+                Drops the audio of this stream that hasn't been played from
+                the output. False when the stream ended so the next song
+                continues right after the buffered audio
+        """
         self._end.set()
+        if flush and self._callback_output:
+            # Also cancels a write of this stream that is waiting for space
+            self.stream.flush()
+
         if self.after:
             self.after()
 
 
+class ChainedReader:
+    """
+    File like object that returns the buffered data first and continues
+    reading from the pipe the data was buffered from
+    """
+    def __init__(self, chunks, pipe):
+        self._chunks = deque(chunks)
+        self.pipe = pipe
+
+    @property
+    def buffered(self):
+        return len(self._chunks) > 0
+
+    def read(self, size):
+        if not self._chunks:
+            return self.pipe.read(size)
+
+        data = self._chunks.popleft()
+        if len(data) > size:
+            self._chunks.appendleft(data[size:])
+            data = data[:size]
+
+        return data
+
+
+class FadeInReader:
+    """
+    Applies the rest of a crossfade to the start of a song
+    when the previous song ended before the fade finished
+    """
+    def __init__(self, reader, crossfade):
+        self.reader = reader
+        self.crossfade = crossfade
+
+    def read(self, size):
+        data = self.reader.read(size)
+        if data and not self.crossfade.finished:
+            data = self.crossfade.fade_in(data)
+
+        return data
+
+
+class Preroll(threading.Thread):
+    """
+    Starts the decoder of a song and buffers the first seconds of it in
+    memory so the song can start playing as soon as the previous one ends.
+    The decoder stays blocked on the full pipe after buffering so the
+    rest of the song is decoded as it's played
+
+    Args:
+        song:
+            The :class:`Song` that is decoded. Its download must be finished
+        samplerate:
+            Rate the song is decoded to
+        seconds:
+            How many seconds are buffered
+        stderr:
+            stderr of the ffmpeg process
+        cache:
+            :class:`src.pcm_cache.PCMCache` the song is read from if it's
+            cached and copied to otherwise
+    """
+    def __init__(self, song, samplerate, seconds=PREROLL_SECONDS, stderr=None, cache=None, **kwargs):
+        super().__init__(daemon=True, **kwargs)
+        self.song = song
+        self.samplerate = samplerate
+        self.stderr = stderr
+        self.cache = cache
+        self.size = int(seconds * samplerate * WIDTH)
+        self._chunks = []
+        self._process = None
+        self._pipe = None
+        self._reader = None
+        self.cache_writer = None
+        self._ready = threading.Event()
+        self._cancelled = threading.Event()
+
+    def run(self):
+        try:
+            self.song.create_stream(self.samplerate)
+            ffmpeg = self.song.ffmpeg
+            ffmpeg.reset_seek()
+            ffmpeg.create_command()
+            if self.cache is not None:
+                key = cache_key(self.song, self.samplerate)
+                self._reader = self.cache.get(key)
+                if self._reader is not None:
+                    logger.debug('Prerolled %s from the PCM cache' % self.song.link)
+                    return
+
+            self._process = ffmpeg.create_subprocess(stderr=self.stderr)
+            self._pipe = self._process.stdout
+            if self.cache is not None:
+                self.cache_writer = self.cache.writer(key, self._process, self.song.duration)
+                if self.cache_writer is not None:
+                    self._pipe = self.cache_writer
+
+            buffered = 0
+            while buffered < self.size and not self._cancelled.is_set():
+                data = self._pipe.read(self.samplerate)
+                if not data:
+                    break
+
+                self._chunks.append(data)
+                buffered += len(data)
+
+            logger.debug('Prerolled {} bytes of {}'.format(buffered, self.song.link))
+        except:
+            logger.exception('Could not preroll %s' % self.song.link)
+            self._process = None
+            self._pipe = None
+        finally:
+            self._ready.set()
+            if self._cancelled.is_set():
+                self._close()
+
+    def _close(self):
+        self.song.ffmpeg.kill()
+        if self.cache_writer is not None:
+            self.cache_writer.close()
+
+        if isinstance(self._reader, MappedReader):
+            self._reader.close()
+
+    def take(self, timeout=None):
+        """
+        Waits until the buffering has finished. Every call returns the
+        same reader
+
+        Returns:
+            A file like object of the decoded audio or None if the
+            decoder couldn't be started in time
+        """
+        if not self._ready.wait(timeout):
+            return None
+
+        if self._reader is None and self._pipe is not None:
+            self._reader = ChainedReader(self._chunks, self._pipe)
+
+        return self._reader
+
+    def cancel(self):
+        self._cancelled.set()
+        if self._ready.is_set():
+            self._close()
+
+
 class MusicPlayer(threading.Thread):
     def __init__(self, db, default_vol=0.5, **kwargs):
         super().__init__(**kwargs)
@@ -442,6 +902,7 @@ class CMDPlayer(MusicPlayer):
             future.add_done_callback(self._after_dl)
 
         f = open('errors.txt', 'a')
+        self._stderr = f
         while self.running:
             self._next_ready.wait()
             self._set_up_current(future)
@@ -526,6 +987,14 @@ class GUIPlayer(MusicPlayer):
         self._next_queue = LockedQueue()
         self.current = None
         self.unpaused = threading.Event()
+        self.samplerate = OUTPUT_RATE
+        self._preroll = None
+        self._stderr = None
+        self._crossfade = None
+        self._crossfade_seconds = 0
+        self.output = None
+        self.pcm_cache = None
+        self._cache_writer = None
 
     @property
     def settings(self):
@@ -569,6 +1038,9 @@ class GUIPlayer(MusicPlayer):
         self.unpaused.set()
 
     def get_next(self):
+        if self.queue_mode == self.AUTO_DJ:
+            return self._get_auto_dj()
+
         self.index += 1
         try:
             song = self.queue[self.index]
@@ -579,11 +1051,222 @@ class GUIPlayer(MusicPlayer):
         song.download_song(download=self.settings.value('download', True))
         self._next_queue.append(song)
 
+    def _get_auto_dj(self):
+        item = self.db.get_random_song(no_repeat=self.settings.value('auto_dj_no_repeat', 50, type=int))
+        if item is None:
+            print('Empty library')
+            self.unpaused.clear()
+            return
+
+        song = Song(item, self.session.downloader)
+        song.download_song(download=self.settings.value('download', True))
+        self._next_queue.append(song)
+
     def _init(self):
         if self.queue is None:
             self.queue = self.session.queues.get(GV.MainQueue, [])
         self.index = self.session.index
 
+    def _on_write_frame(self, stream_player):
+        if callable(self.duration_fn):
+            self.duration_fn(stream_player)
+
+        self._start_preroll(stream_player)
+        self._start_crossfade(stream_player)
+
+    def _start_preroll(self, stream_player):
+        """
+        Starts decoding the next song when the current one is about to end
+        """
+        if self._preroll is not None or stream_player is not self.stream_player:
+            return
+
+        current = self.current
+        if current is None or not current.duration:
+            return
+
+        lead = max(PREROLL_LEAD, self._crossfade_seconds + PREROLL_SECONDS)
+        if stream_player.duration < current.duration - lead:
+            return
+
+        try:
+            song = self._next_queue[-1]
+        except IndexError:
+            return
+
+        if song is current or not song.ready_for_use:
+            return
+
+        self._preroll = Preroll(song, self.samplerate, stderr=self._stderr,
+                                cache=self._get_pcm_cache())
+        self._preroll.start()
+
+    def _start_crossfade(self, stream_player):
+        """
+        Starts mixing the prerolled song to the current one when the
+        current song is crossfade seconds from its end
+        """
+        if self._crossfade is not None or self._crossfade_seconds <= 0:
+            return
+
+        preroll = self._preroll
+        if preroll is None or stream_player is not self.stream_player:
+            return
+
+        if stream_player.duration < self.current.duration - self._crossfade_seconds:
+            return
+
+        # Another song was queued after the preroll started
+        if not self._next_queue or self._next_queue[-1] is not preroll.song:
+            return
+
+        reader = preroll.take(timeout=0)
+        if reader is None:
+            return
+
+        self._crossfade = Crossfade(self.samplerate, self._crossfade_seconds)
+        stream_player.start_crossfade(self._crossfade, reader)
+
+    def _get_output(self):
+        """
+        Returns:
+            The :class:`CallbackOutput` shared by all songs or None if
+            the blocking streams of the songs should be used
+        """
+        if self.output is None and self.settings.value('callback_output', True, type=bool):
+            try:
+                self.output = CallbackOutput(PA, self.samplerate, volume=self.volume)
+            except Exception:
+                logger.exception('Could not open callback output. Using blocking output')
+                self.settings.setValue('callback_output', False)
+
+        return self.output
+
+    def _get_pcm_cache(self):
+        """
+        Returns:
+            The :class:`PCMCache` of decoded songs or None if it's disabled
+        """
+        if self.pcm_cache is None:
+            size = self.settings.value('pcm_cache_size', PCM_CACHE_SIZE, type=int)
+            if size <= 0:
+                return None
+
+            try:
+                self.pcm_cache = PCMCache(os.path.join(os.getcwd(), 'cache', 'pcm'),
+                                          size * 1024 * 1024, self.samplerate * WIDTH)
+            except OSError:
+                logger.exception('Could not open the PCM cache')
+                self.settings.setValue('pcm_cache_size', 0)
+
+        return self.pcm_cache
+
+    def _open_decoder(self, song, stderr=None, stdin=None):
+        """
+        Returns:
+            File like object of the decoded song. Read from the PCM cache
+            if the song is cached. Otherwise ffmpeg is started and its
+            output is copied to the cache
+        """
+        song.create_stream(self.samplerate)
+        song.ffmpeg.reset_seek()
+        song.ffmpeg.create_command()
+
+        cache = self._get_pcm_cache()
+        key = None
+        if cache is not None:
+            key = cache_key(song, self.samplerate)
+            reader = cache.get(key)
+            if reader is not None:
+                logger.debug('Playing %s from the PCM cache' % song.link)
+                return reader
+
+        process = song.ffmpeg.create_subprocess(stderr=stderr, stdin=stdin)
+        if cache is not None:
+            self._cache_writer = cache.writer(key, process, song.duration)
+            if self._cache_writer is not None:
+                return self._cache_writer
+
+        return process.stdout
+
+    def _close_cache_writer(self):
+        """
+        Adds the song to the PCM cache if it was decoded to the end.
+        Otherwise the partial copy is discarded
+        """
+        writer = self._cache_writer
+        self._cache_writer = None
+        if writer is None:
+            return
+
+        stream_player = self.stream_player
+        if stream_player is not None and stream_player.finished:
+            # The silence trimmed from the end isn't read by the player
+            writer.drain()
+
+        writer.close()
+
+    def _load_seek_index(self, song):
+        """
+        Gives ffmpeg the seek index of the file. Files without one get
+        it built in the background and saved for the next time
+        """
+        ffmpeg = song.ffmpeg
+        if ffmpeg.seek_index is not None or not song.is_file or song.song.id is None:
+            return
+
+        if SeekIndex.input_format(song.file) is None:
+            return
+
+        index = self.db.get_seek_index(song.song.id)
+        if index is not None and index.is_valid(song.file):
+            ffmpeg.seek_index = index
+            return
+
+        def build():
+            index = SeekIndex.build(song.file)
+            if index is not None:
+                ffmpeg.seek_index = index
+                self.db.save_seek_index(song.song.id, index)
+
+        threading.Thread(target=build, daemon=True).start()
+
+    @staticmethod
+    def _save_trim(song, threshold, start, end):
+        if song.trim_threshold != threshold:
+            # Positions found with the previous threshold are scanned again
+            song.trim_start = None
+            song.trim_end = None
+            song.trim_threshold = threshold
+
+        if start is not None:
+            song.trim_start = start
+
+        if end is not None:
+            song.trim_end = end
+
+    def _take_preroll(self, song):
+        """
+        Returns:
+            The prerolled audio of the song or None if it wasn't prerolled
+        """
+        preroll = self._preroll
+        self._preroll = None
+        if preroll is None:
+            return None
+
+        if preroll.song is not song:
+            preroll.cancel()
+            return None
+
+        reader = preroll.take(timeout=PREROLL_SECONDS)
+        if reader is None:
+            preroll.cancel()
+        else:
+            self._cache_writer = preroll.cache_writer
+
+        return reader
+
     def _audio_loop(self):
         self._init()
 
@@ -600,6 +1283,7 @@ class GUIPlayer(MusicPlayer):
                               self.index, False)
 
         f = open('errors.txt', 'a')
+        self._stderr = f
 
         while self.running:
             self.unpaused.wait()
@@ -639,7 +1323,7 @@ class GUIPlayer(MusicPlayer):
             self.play_current(after=self.on_stop, stderr=f,
                               remove_start_silence=True,
                               remove_end_silence=True,
-                              on_write_frame=self.duration_fn, daemon=True)
+                              on_write_frame=self._on_write_frame, daemon=True)
             logger.debug('Started player')
             self.get_next()
 
@@ -657,11 +1341,16 @@ class GUIPlayer(MusicPlayer):
     def exit_player(self, lock=None):
         try:
             self._stop.set()
+            if self._preroll is not None:
+                self._preroll.cancel()
+
             if self.stream_player:
                 self.stream_player.stop()
 
             self.unpaused.set()
             self._end_finalized.wait(timeout=10)
+            if self.output is not None:
+                self.output.close()
         except Exception as e:
             print('Exception while closing player\n%s' % e)
         finally:
@@ -672,11 +1361,47 @@ class GUIPlayer(MusicPlayer):
         if self.current is None:
             return
 
-        samplerate = self.current.create_stream()
-        self.current.ffmpeg.reset_seek()
-        self.current.ffmpeg.create_command()
-        p = self.current.ffmpeg.create_subprocess(stderr=stderr, stdin=stdin)
-        self.stream_player = StreamPlayer(p.stdout, self.current.stream, samplerate, self.volume, after=after, **kwargs)
+        # A prerolled song was started while the previous one was playing
+        # so it can be written to the stream right away
+        reader = self._take_preroll(self.current)
+        crossfade = self._crossfade
+        self._crossfade = None
+        position = 0
+        if reader is not None and crossfade is not None and crossfade.position > 0:
+            if self.stream_player is not None and self.stream_player.crossfade is crossfade:
+                # The start of the song was already mixed with the previous song
+                position = crossfade.position / self.samplerate
+                reader = FadeInReader(reader, crossfade)
+                kwargs['remove_start_silence'] = False
+            else:
+                # Seeking interrupted the crossfade so the song is started from the beginning
+                self.current.ffmpeg.kill()
+                if self._cache_writer is not None:
+                    self._cache_writer.close()
+                    self._cache_writer = None
+
+                if isinstance(reader, MappedReader):
+                    reader.close()
+
+                reader = None
+
+        self._crossfade_seconds = self.settings.value('crossfade', 0, type=float)
+        threshold = self.settings.value('silence_threshold', SILENCE_THRESHOLD, type=float)
+        kwargs['silence_threshold'] = threshold
+        if self.current.trim_threshold == threshold:
+            kwargs['trim'] = (self.current.trim_start, self.current.trim_end)
+
+        if self.current.is_file:
+            # Streams can end early when the connection drops so only files are cached
+            kwargs['on_trim'] = lambda start, end, song=self.current: self._save_trim(song, threshold, start, end)
+
+        if reader is None:
+            reader = self._open_decoder(self.current, stderr=stderr, stdin=stdin)
+
+        self._load_seek_index(self.current)
+        stream = self._get_output() or self.current.stream
+        self.stream_player = StreamPlayer(reader, stream, self.samplerate, self.volume,
+                                          after=after, position=position, **kwargs)
         self._not_playing.clear()
         self.stream_player.start()
         self.on_start(self)
@@ -689,6 +1414,11 @@ class GUIPlayer(MusicPlayer):
             print('Exception while running music player: %s ' % e)
 
     def on_stop(self):
+        try:
+            self._close_cache_writer()
+        except Exception:
+            logger.exception('Could not close the PCM cache file')
+
         try:
             self.current.ffmpeg.kill()
         except Exception as e:
@@ -0,0 +1,234 @@
+import logging
+import weakref
+from collections import OrderedDict
+
+from src.song import Song
+
+logger = logging.getLogger('debug')
+
+
+class QueueView:
+    """
+    Sequence of the songs in the queue that can be used in place of a
+    list of :class:`Song`. Only the song ids are loaded up front. The
+    columns shown in the queue list and the songs are fetched in chunks
+    with one query per chunk when they are needed.
+    :class:`Song` objects are created when an item is accessed and are
+    kept only as long as something else references them.
+
+    Changes are saved with the queue storage of the database so each one
+    updates a single row. See :class:`src.database.QueueStorage`
+
+    Args:
+        db:
+            :class:`src.database.Database` the queue is read from
+        downloader:
+            Downloader given to the created songs
+        chunk_size:
+            How many rows are fetched at once
+        max_chunks:
+            How many chunks of rows and songs are cached
+    """
+    def __init__(self, db, downloader, chunk_size=200, max_chunks=20):
+        self.db = db
+        self.downloader = downloader
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+
+        self.ids = None
+        self._chunks = OrderedDict()
+        self._models = OrderedDict()
+        self._songs = weakref.WeakValueDictionary()
+        self.load()
+
+    def load(self):
+        """Reads the song ids of the queue from the database"""
+        self.ids = self.db.get_queue_ids()
+        self._chunks.clear()
+        self._models.clear()
+        self._songs = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __bool__(self):
+        return len(self.ids) > 0
+
+    def song_id(self, index):
+        return self.ids[index]
+
+    def _get_chunk(self, cache, index, load):
+        chunk = index // self.chunk_size
+        items = cache.get(chunk)
+        if items is not None:
+            cache.move_to_end(chunk)
+            return items
+
+        items = load(self.ids[chunk * self.chunk_size:(chunk + 1) * self.chunk_size])
+        cache[chunk] = items
+        while len(cache) > self.max_chunks:
+            cache.popitem(last=False)
+
+        return items
+
+    def row(self, index):
+        """
+        Returns:
+            :class:`src.database.SongRow` of the song at index or None
+            if the song has been deleted
+        """
+        if index < 0:
+            index += len(self.ids)
+
+        rows = self._get_chunk(self._chunks, index, self.db.get_song_rows)
+        return rows.get(self.ids[index])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.ids)))]
+
+        if index < 0:
+            index += len(self.ids)
+
+        if not 0 <= index < len(self.ids):
+            raise IndexError('Queue index out of range')
+
+        song = self._songs.get(index)
+        if song is not None:
+            return song
+
+        models = self._get_chunk(self._models, index, self.db.prefetch_songs)
+        item = models.get(self.ids[index])
+        if item is None:
+            raise IndexError('Song %s not in database' % self.ids[index])
+
+        song = Song(item, self.downloader, index)
+        self._songs[index] = song
+        return song
+
+    def loaded_song(self, index):
+        """
+        Returns:
+            The :class:`Song` at index if one has been created and is still
+            referenced, otherwise None
+        """
+        return self._songs.get(index)
+
+    def __iter__(self):
+        for index in range(len(self.ids)):
+            try:
+                yield self[index]
+            except IndexError:
+                logger.debug('Skipped deleted song at queue index %s' % index)
+
+    def adopt(self, song):
+        """
+        Makes the queue return the given song object at its position.
+        Used to keep the playing song after the queue is reordered
+
+        Raises:
+            ValueError if the song isn't in the queue
+        """
+        index = self.ids.index(song.song.id)
+        song.index = index
+        self._songs[index] = song
+        return index
+
+    def index(self, song):
+        """
+        Returns:
+            The position of the song in the queue
+        """
+        index = getattr(song, 'index', -1)
+        if 0 <= index < len(self.ids) and self._songs.get(index) is song:
+            return index
+
+        return self.ids.index(song.song.id)
+
+    def _remap(self, new_index):
+        """
+        Moves the created songs to their new positions after a change
+
+        Args:
+            new_index:
+                Function that returns the new position of an old one or
+                None if the item was removed
+        """
+        songs = weakref.WeakValueDictionary()
+        for index, song in list(self._songs.items()):
+            index = new_index(index)
+            if index is not None:
+                song.index = index
+                songs[index] = song
+
+        self._songs = songs
+        # The cached chunks are by position
+        self._chunks.clear()
+        self._models.clear()
+
+    def _check_index(self, index):
+        if index < 0:
+            index += len(self.ids)
+
+        if not 0 <= index < len(self.ids):
+            raise IndexError('Queue index out of range')
+
+        return index
+
+    def append(self, song):
+        """Adds the song to the end of the queue"""
+        self.db.fullsongs_to_queue([song.song])
+        index = len(self.ids)
+        self.ids.append(song.song.id)
+        song.index = index
+        self._songs[index] = song
+        self._chunks.pop(index // self.chunk_size, None)
+        self._models.pop(index // self.chunk_size, None)
+
+    def insert(self, index, song):
+        """Inserts the song before the item at index"""
+        index = max(min(index, len(self.ids)), 0)
+        self.db.insert_to_queue(index, song.song.id)
+        self.ids.insert(index, song.song.id)
+        self._remap(lambda i: i + 1 if i >= index else i)
+        song.index = index
+        self._songs[index] = song
+
+    def remove(self, index):
+        """
+        Removes the item at index
+
+        Returns:
+            The FullSong id of the removed item
+        """
+        index = self._check_index(index)
+        song_id = self.db.remove_from_queue(index)
+        del self.ids[index]
+        self._remap(lambda i: None if i == index else i - 1 if i > index else i)
+        return song_id
+
+    def move(self, index, new_index):
+        """Moves the item at index so that it will be at new_index"""
+        index = self._check_index(index)
+        new_index = self._check_index(new_index)
+        if index == new_index:
+            return
+
+        self.db.move_in_queue(index, new_index)
+        self.ids.insert(new_index, self.ids.pop(index))
+
+        def new_position(i):
+            if i == index:
+                return new_index
+            if index < i <= new_index:
+                return i - 1
+            if new_index <= i < index:
+                return i + 1
+
+            return i
+
+        self._remap(new_position)
+
+    def clear(self):
+        self.db.clear_queue()
+        self.load()
@@ -1,3 +1,5 @@
+import math
+import random
 from collections import deque
 
 
@@ -142,7 +144,9 @@ class ScrollingIconPage:
             for item in page:
                 item.load_icon()
 
-            self._loaded_pages.append(page)
+            # Overlapping pages are loaded again when scrolling
+            if not any(loaded is page for loaded in self._loaded_pages):
+                self._loaded_pages.append(page)
 
     @property
     def page_count(self):
@@ -167,3 +171,189 @@ class Item:
 
         else:
             print('already loaded')
+
+
+class _SkipNode:
+    __slots__ = ['key', 'value', 'next', 'width']
+
+    def __init__(self, key, value, levels):
+        self.key = key
+        self.value = value
+        self.next = [None] * levels
+        self.width = [0] * levels
+
+
+class IndexableSkipList:
+    """
+    Sorted mapping of unique keys to values that also supports access by
+    position. Insert, remove, item at index and index of a key are all
+    O(log n). Every link stores how many items it skips over so the
+    position of a node is the sum of the widths on the search path.
+
+    Based on the indexable skiplist recipe by Raymond Hettinger
+    """
+    def __init__(self, max_levels=24, rng=None):
+        self.max_levels = max_levels
+        self._random = (rng or random.Random()).random
+        self._nil = _SkipNode(None, None, 0)
+        self.head = _SkipNode(None, None, max_levels)
+        self.head.next = [self._nil] * max_levels
+        self.head.width = [1] * max_levels
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _search(self, key):
+        """
+        Returns:
+            The last node before key on every level and how many steps
+            were taken on each level
+        """
+        chain = [None] * self.max_levels
+        steps = [0] * self.max_levels
+        node = self.head
+        nil = self._nil
+        for level in reversed(range(self.max_levels)):
+            while node.next[level] is not nil and node.next[level].key < key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+
+            chain[level] = node
+
+        return chain, steps
+
+    def insert(self, key, value=None):
+        chain, steps_at_level = self._search(key)
+        if chain[0].next[0] is not self._nil and chain[0].next[0].key == key:
+            raise KeyError('Duplicate key %s' % (key,))
+
+        levels = min(self.max_levels, 1 - int(math.log(1.0 - self._random(), 2.0)))
+        node = _SkipNode(key, value, levels)
+        steps = 0
+        for level in range(levels):
+            prev = chain[level]
+            node.next[level] = prev.next[level]
+            prev.next[level] = node
+            node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+
+        for level in range(levels, self.max_levels):
+            chain[level].width[level] += 1
+
+        self.size += 1
+
+    def extend(self, items):
+        """
+        Appends (key, value) pairs in O(1) each. The keys must be sorted and
+        greater than the last key in the list
+        """
+        nil = self._nil
+        tails = [None] * self.max_levels
+        positions = [0] * self.max_levels
+        node = self.head
+        pos = 0
+        for level in reversed(range(self.max_levels)):
+            while node.next[level] is not nil:
+                pos += node.width[level]
+                node = node.next[level]
+
+            tails[level] = node
+            positions[level] = pos
+
+        last = tails[0].key if tails[0] is not self.head else None
+        for key, value in items:
+            if last is not None and not last < key:
+                raise KeyError('Keys not in ascending order %s' % (key,))
+
+            last = key
+            self.size += 1
+            levels = min(self.max_levels, 1 - int(math.log(1.0 - self._random(), 2.0)))
+            node = _SkipNode(key, value, levels)
+            for level in range(levels):
+                tails[level].next[level] = node
+                tails[level].width[level] = self.size - positions[level]
+                tails[level] = node
+                positions[level] = self.size
+
+        for level in range(self.max_levels):
+            tails[level].next[level] = nil
+            tails[level].width[level] = self.size + 1 - positions[level]
+
+    def remove(self, key):
+        """
+        Removes the key
+
+        Returns:
+            The value of the key
+        """
+        chain, _ = self._search(key)
+        node = chain[0].next[0]
+        if node is self._nil or node.key != key:
+            raise KeyError(key)
+
+        levels = len(node.next)
+        for level in range(levels):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+
+        for level in range(levels, self.max_levels):
+            chain[level].width[level] -= 1
+
+        self.size -= 1
+        return node.value
+
+    def index(self, key):
+        """
+        Returns:
+            Position of the key
+        """
+        chain, steps = self._search(key)
+        node = chain[0].next[0]
+        if node is self._nil or node.key != key:
+            raise KeyError(key)
+
+        return sum(steps)
+
+    def _node_at(self, index):
+        if index < 0:
+            index += self.size
+
+        if not 0 <= index < self.size:
+            raise IndexError('Index out of range')
+
+        node = self.head
+        index += 1
+        for level in reversed(range(self.max_levels)):
+            while node.width[level] <= index:
+                index -= node.width[level]
+                node = node.next[level]
+
+        return node
+
+    def item(self, index):
+        """
+        Returns:
+            (key, value) tuple at the index
+        """
+        node = self._node_at(index)
+        return node.key, node.value
+
+    def __getitem__(self, index):
+        return self._node_at(index).value
+
+    def key(self, index):
+        return self._node_at(index).key
+
+    def __iter__(self):
+        node = self.head.next[0]
+        while node is not self._nil:
+            yield node.key, node.value
+            node = node.next[0]
+
+    def clear(self):
+        self.head.next = [self._nil] * self.max_levels
+        self.head.width = [1] * self.max_levels
+        self.size = 0
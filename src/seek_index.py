@@ -0,0 +1,130 @@
+import bisect
+import logging
+import os
+import subprocess
+from array import array
+
+logger = logging.getLogger('debug')
+
+# Formats that can be decoded from any frame after skipping bytes with
+# -skip_initial_bytes. Containers with headers such as mp4, ogg and flac
+# can't be started from the middle and use ffmpeg's own seeking instead
+BYTE_SEEKABLE_FORMATS = {'.mp3': 'mp3', '.mp2': 'mp3', '.aac': 'aac', '.ac3': 'ac3'}
+
+
+class SeekIndex:
+    """
+    Sparse index of the byte offsets of audio packets in a file.
+    Seeking with it skips straight to the packet before the target and
+    only the rest is decoded and discarded, instead of ffmpeg
+    estimating the position from the bitrate or reading from the start.
+
+    Args:
+        times:
+            Sorted start times of the indexed packets in seconds
+        offsets:
+            Byte offsets of the indexed packets
+        file_size:
+            Size of the file the index was built from. Used to notice
+            when the file has changed
+    """
+    TIME_TYPE = 'd'
+    OFFSET_TYPE = 'q'
+
+    def __init__(self, times, offsets, file_size):
+        self.times = array(self.TIME_TYPE, times)
+        self.offsets = array(self.OFFSET_TYPE, offsets)
+        self.file_size = file_size
+
+    def __len__(self):
+        return len(self.times)
+
+    @staticmethod
+    def input_format(file):
+        """
+        Returns:
+            The ffmpeg demuxer used after skipping bytes or None if the
+            file can't be seeked by bytes
+        """
+        if not isinstance(file, str):
+            return None
+
+        return BYTE_SEEKABLE_FORMATS.get(os.path.splitext(file)[1].lower())
+
+    @classmethod
+    def build(cls, file, interval=1.0, ffprobe='ffprobe'):
+        """
+        Reads the packet positions of the file with ffprobe. Only the
+        container is parsed so this is much faster than decoding
+
+        Args:
+            file:
+                Path of the file
+            interval:
+                Seconds between the indexed packets
+
+        Returns:
+            SeekIndex or None if the file couldn't be indexed
+        """
+        args = [ffprobe, '-v', 'error', '-select_streams', 'a:0',
+                '-show_entries', 'packet=pts_time,pos', '-of', 'csv=p=0', file]
+        times = []
+        offsets = []
+        try:
+            size = os.path.getsize(file)
+            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            next_time = 0
+            for line in p.stdout:
+                try:
+                    time, pos = line.split(b',')[:2]
+                    time = float(time)
+                    pos = int(pos)
+                except ValueError:
+                    continue
+
+                if time >= next_time:
+                    times.append(time)
+                    offsets.append(pos)
+                    next_time = time + interval
+
+            p.wait()
+        except OSError as e:
+            logger.info('Could not build seek index for %s. %s' % (file, e))
+            return None
+
+        if not times:
+            return None
+
+        return cls(times, offsets, size)
+
+    def is_valid(self, file):
+        try:
+            return os.path.getsize(file) == self.file_size
+        except OSError:
+            return False
+
+    def lookup(self, seconds):
+        """
+        Returns:
+            tuple (time, offset) of the last indexed packet at or before seconds
+        """
+        idx = max(bisect.bisect_right(self.times, seconds) - 1, 0)
+        return self.times[idx], self.offsets[idx]
+
+    def to_bytes(self):
+        header = array(self.OFFSET_TYPE, [self.file_size, len(self.times)])
+        return header.tobytes() + self.times.tobytes() + self.offsets.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        header = array(cls.OFFSET_TYPE)
+        header_size = header.itemsize * 2
+        header.frombytes(data[:header_size])
+        file_size, count = header
+
+        times = array(cls.TIME_TYPE)
+        end = header_size + times.itemsize * count
+        times.frombytes(data[header_size:end])
+        offsets = array(cls.OFFSET_TYPE)
+        offsets.frombytes(data[end:])
+        return cls(times, offsets, file_size)
@@ -0,0 +1,76 @@
+import random
+from array import array
+
+
+class ShuffleEngine:
+    """
+    Seeded Fisher–Yates shuffles. A shuffle is a permutation of the
+    positions of a list where position i of the shuffled list has the
+    item permutation[i] of the original list. The same seed and size
+    always produce the same permutation so a shuffle can be stored as the
+    seed and a compact array instead of rewriting the shuffled rows.
+    """
+    TYPECODE = 'I'
+
+    @staticmethod
+    def new_seed():
+        # Fits in a signed 64 bit integer column
+        return random.SystemRandom().getrandbits(62)
+
+    @classmethod
+    def permutation(cls, size, seed):
+        """
+        Returns:
+            array of the shuffled positions 0..size-1
+        """
+        positions = list(range(size))
+        # random.shuffle is a Fisher–Yates shuffle
+        random.Random(seed).shuffle(positions)
+        return array(cls.TYPECODE, positions)
+
+    @classmethod
+    def to_bytes(cls, permutation):
+        return array(cls.TYPECODE, permutation).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        permutation = array(cls.TYPECODE)
+        permutation.frombytes(data)
+        return permutation
+
+    @staticmethod
+    def extend(permutation, size):
+        """
+        Adds the positions of items appended after the shuffle to the end
+        in their original order
+        """
+        if len(permutation) < size:
+            permutation.extend(range(len(permutation), size))
+
+        return permutation
+
+    @staticmethod
+    def inverse(permutation):
+        """
+        Returns:
+            List where index i has the shuffled position of original item i
+        """
+        inverse = [0] * len(permutation)
+        for position, original in enumerate(permutation):
+            inverse[original] = position
+
+        return inverse
+
+    @staticmethod
+    def apply(items, permutation):
+        """Returns the items in the shuffled order"""
+        return [items[i] for i in permutation]
+
+    @staticmethod
+    def unapply(items, permutation):
+        """Returns shuffled items in their original order"""
+        original = [None] * len(permutation)
+        for position, i in enumerate(permutation):
+            original[i] = items[position]
+
+        return original
@@ -1,7 +1,7 @@
 import logging
 import os
 import threading
-from io import BytesIO
+from concurrent.futures import Future
 from functools import wraps
 
 import pyaudio
@@ -11,10 +11,11 @@ from PIL import Image
 
 from src.exiftool import ExifTool
 from src.ffmpeg import FFmpeg
-from src.utils import md5_hash, parse_duration, get_duration, trim_image
+from src.cache import get_art_cache
+from src.utils import parse_duration, get_duration, trim_image, save_cover_art
 from src.database import CoverArt, Artist, AlbumArtist, Album, Genre, Composer
 from apsw import BusyError, SQLError
-from src.database import _database
+from src.database import _database, mark_dirty
 
 
 PA = pyaudio.PyAudio()
@@ -31,9 +32,10 @@ def item_updated(func):
     def wrapper(self, *args, **kwargs):
         try:
             func(self, *args, **kwargs)
-            self.song.save()
         except (BusyError, SQLError, ValueError) as e:
             print('Could not update song. %s' % e)
+        else:
+            mark_dirty(self.song)
 
     return wrapper
 
@@ -214,6 +216,36 @@ class SongBase:
     def metadata_set(self, is_set: bool):
         self.song.metadata_set = is_set
 
+    @property
+    def trim_start(self):
+        """Second where the sound of the song starts or None if it hasn't been scanned"""
+        return getattr(self.song, 'trim_start', None)
+
+    @trim_start.setter
+    @item_updated
+    def trim_start(self, seconds):
+        self.song.trim_start = seconds
+
+    @property
+    def trim_end(self):
+        """Second where the sound of the song ends or None if it hasn't been scanned"""
+        return getattr(self.song, 'trim_end', None)
+
+    @trim_end.setter
+    @item_updated
+    def trim_end(self, seconds):
+        self.song.trim_end = seconds
+
+    @property
+    def trim_threshold(self):
+        """Silence threshold in dBFS trim_start and trim_end were found with"""
+        return getattr(self.song, 'trim_threshold', None)
+
+    @trim_threshold.setter
+    @item_updated
+    def trim_threshold(self, dbfs):
+        self.song.trim_threshold = dbfs
+
     def __getattr__(self, item):
         if item in self.__slots__:
             return self.__getattribute__(item)
@@ -228,7 +260,7 @@ class Song(SongBase):
     __slots__ = ['index', 'downloader', '_ffmpeg', '_stream', 'metadata',
                  '_formatted_duration', 'info', 'future', '_dl_error','_dl_ready',
                  '_downloading', 'on_cover_art_changed', 'after_download',
-                 'is_link']
+                 'is_link', '__weakref__']
 
     def __init__(self, db_item, downloader, index=-1, on_cover_art_change=None,
                  after_download=None, **kwargs):
@@ -265,47 +297,13 @@ class Song(SongBase):
         if self.cover_art is None:
             return
 
-        image = Image.open(self.cover_art)
-        image_trimmed = trim_image(image)
-        buffer = BytesIO()
-        image_trimmed.save(buffer, format='PNG')
-
-        buffer.seek(0)
-        md5 = md5_hash(buffer)
-        buffer.seek(0)
-
-        path = os.path.join(os.getcwd(), 'cache', 'cover_art', 'downloaded')
-        if not os.path.exists(path):
-            os.makedirs(path)
-
-        fname = os.path.join(path, md5)
-        if os.path.exists(fname):
-            self.delete_cover_art()
-            self.cover_art = fname
-            return None, fname
-
-        with open(fname, 'wb') as f:
-            for chunk in iter(lambda: buffer.read(4096), b""):
-                f.write(chunk)
-
-        self.delete_cover_art()
-        self.cover_art = fname
-
-    def delete_cover_art(self):
-        if self.cover_art is not None:
-            try:
-                res = self.db_handler.filter_from_database(cover_art=self.cover_art)
-                if len(res) == 1:
-                    os.remove(self.cover_art)
-                    self.cover_art = None
-            except OSError as e:
-                logger.debug('Could not delete cover art %s. %s' % (self.cover_art, e))
+        art_cache = get_art_cache()
+        image = Image.open(art_cache.get(self.cover_art))
+        image_trimmed = trim_image(image) or image
+        # The untrimmed image is deleted by garbage collection if nothing else uses it
+        self.cover_art = art_cache.add_image(image_trimmed)
 
     def _get_file_cover_art(self):
-        path = os.path.join(os.getcwd(), 'cache', 'cover_art', 'embedded')
-        if not os.path.exists(path):
-            os.makedirs(path)
-
         if 'Picture' not in self.metadata:
             exiftool = ExifTool()
             exiftool.start()
@@ -316,21 +314,12 @@ class Song(SongBase):
             exiftool.terminate()
 
             if not pic:
-                return None, None
+                return None
 
         else:
             pic = self.metadata.pop('Picture')
 
-        buffer = BytesIO(pic)
-        md5 = md5_hash(buffer)
-        buffer.seek(0)
-
-        fname = os.path.join(path, md5)
-        if os.path.exists(fname):
-            logger.debug('Cover art for {} {} already exists with filename {}'.format(self.name, self.link, fname))
-            return None, fname
-
-        return buffer, fname
+        return save_cover_art(pic)
 
     def set_duration(self, duration=None):
         if duration is None:
@@ -419,22 +408,10 @@ class Song(SongBase):
 
         pic = self.info.get('thumbnail', None)
         if pic is None:
-            return None, None
+            return None
 
         r = requests.get(pic, stream=True)
-        buffer = BytesIO(r.content)
-        md5 = md5_hash(buffer)
-        buffer.seek(0)
-
-        path = os.path.join(os.getcwd(), 'cache', 'cover_art', 'downloaded')
-        if not os.path.exists(path):
-            os.makedirs(path)
-
-        fname = os.path.join(path, md5)
-        if os.path.exists(fname):
-            return None, fname
-
-        return buffer, fname
+        return get_art_cache().add(r.content)
 
     def set_cover_art(self, file: str=None, forced=False):
         if file is None:
@@ -443,28 +420,19 @@ class Song(SongBase):
 
             try:
                 if self.is_file:
-                    buffer, fname = self._get_file_cover_art()
+                    fname = self._get_file_cover_art()
                 else:
-                    resp = self._get_link_cover_art()
-                    if isinstance(resp, tuple):
-                        buffer, fname = resp
-                    else:
-                        return resp
+                    fname = self._get_link_cover_art()
+                    if isinstance(fname, Future):
+                        # Called again when the info has been downloaded
+                        return fname
 
             except Exception as e:
                 logger.exception('Could not get cover art. %s' % e)
                 return
 
-            if buffer is None:
-                if fname is not None:
-                    self.cover_art = fname
-                return
-
-            with open(fname, 'wb') as f:
-                for chunk in iter(lambda: buffer.read(4096), b""):
-                    f.write(chunk)
-
-            self.cover_art = fname
+            if fname is not None:
+                self.cover_art = fname
 
         else:
             self.cover_art = file
@@ -485,9 +453,28 @@ class Song(SongBase):
         exiftool.terminate()
         return self.metadata
 
-    def create_stream(self):
-        self.set_metadata()
-        samplerate = int(self.metadata.get('Sample Rate', '44100'))
+    def create_stream(self, samplerate=None):
+        """
+        Selects the output stream and the rate ffmpeg decodes to.
+        ExifTool isn't started here since that delays the start of the song.
+        If samplerate isn't given the rate of the file is used when its
+        metadata has already been read
+
+        Args:
+            samplerate:
+                Rate the song is resampled to
+
+        Returns:
+            The sample rate used
+        """
+        if samplerate is None:
+            samplerate = self.metadata.get('SampleRate', 44100)
+
+        try:
+            samplerate = int(samplerate)
+        except (TypeError, ValueError):
+            samplerate = 44100
+
         if samplerate not in RATES:
             samplerate = 44100
 
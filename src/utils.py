@@ -1,6 +1,5 @@
 import hashlib
 import os
-from io import BytesIO
 import shlex
 import subprocess
 import sys
@@ -9,10 +8,10 @@ from itertools import zip_longest
 import base64
 from signal import *
 import ntpath
-import binascii
 
 from PIL import Image, ImageChops
 
+from src.cache import get_art_cache
 from src.exiftool import ExifTool
 
 
@@ -261,11 +260,33 @@ def trim_image(im):
         return im.crop(bbox)
 
 
-def get_file_cover_art(metadata, file):
-    path = os.path.join(os.getcwd(), 'cache', 'cover_art', 'embedded')
-    if not os.path.exists(path):
-        os.makedirs(path)
+def save_cover_art(pic):
+    """
+    Adds cover art read by ExifTool to the art cache
+
+    Args:
+        pic:
+            Image data, a base64 string or the output of ExifTool.get_cover_art
+
+    Returns:
+        Path of the cover art or None if pic isn't an image
+    """
+    if isinstance(pic, list):
+        pic = pic[0] if pic else None
+
+    if isinstance(pic, dict):
+        pic = pic.get('Picture')
+
+    if not pic:
+        return None
+
+    if isinstance(pic, str):
+        return get_art_cache().add_b64(pic)
+
+    return get_art_cache().add(pic)
+
 
+def get_file_cover_art(metadata, file):
     if 'Picture' not in metadata:
         exiftool = ExifTool()
         exiftool.start()
@@ -274,46 +295,13 @@ def get_file_cover_art(metadata, file):
         exiftool.terminate()
 
         if not pic:
-            return None, None
+            return None
 
     else:
         pic = metadata['Picture']
 
-    buffer = BytesIO(pic)
-    md5 = md5_hash(buffer)
-    buffer.seek(0)
-
-    fname = os.path.join(path, md5)
-    if os.path.exists(fname):
-        return fname
-
-    with open(fname, 'wb') as f:
-        for chunk in iter(lambda: buffer.read(4096), b""):
-            f.write(chunk)
-
-    return fname
+    return save_cover_art(pic)
 
 
 def b64_to_cover_art(s):
-    path = os.path.join(os.getcwd(), 'cache', 'cover_art', 'embedded')
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    if s[:7] == 'base64:':
-        s = s[7:]
-
-    b = binascii.a2b_base64(s)
-    buffer = BytesIO(b)
-
-    md5 = md5_hash(buffer)
-    buffer.seek(0)
-
-    fname = os.path.join(path, md5)
-    if os.path.exists(fname):
-        return fname
-
-    with open(fname, 'wb') as f:
-        for chunk in iter(lambda: buffer.read(4096), b""):
-            f.write(chunk)
-
-    return fname
+    return get_art_cache().add_b64(s)